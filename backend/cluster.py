@@ -0,0 +1,144 @@
+"""Запуск сервера в несколько процессов.
+
+API масштабируется запуском нескольких процессов uvicorn (WEB_CONCURRENCY),
+а задачи, которые должны выполняться в одном экземпляре, распределяются
+через блокировки файлов в DATA_DIR (fcntl.flock):
+
+- "bot" - опрос Telegram (два опрашивающих процесса мешают друг другу);
+- "maintenance" - фоновая проверка согласованности и удаление брошенных
+  временных файлов.
+
+Роль получает процесс, первым захвативший блокировку; остальные
+периодически пробуют снова, поэтому при падении лидера роль переходит к
+другому процессу. Блокировку снимает ОС при завершении процесса.
+
+BOT_MODE: "leader" (по умолчанию) - бот работает в процессе веб-сервера,
+получившем роль "bot"; "standalone" - бот запускается отдельно
+(python bot.py), веб-процессы его не запускают; "off" - бот не нужен.
+
+События изменений между процессами передает backend.relay (EVENT_RELAY:
+"auto" - включен, если процессов больше одного).
+"""
+import asyncio
+import logging
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - не POSIX: считаем, что процесс один
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Число процессов веб-сервера
+WEB_CONCURRENCY = max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1)
+BOT_MODE = os.environ.get("BOT_MODE", "leader").lower()
+# Как часто процесс без роли пробует ее захватить (секунды)
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "10"))
+
+MULTI_PROCESS = WEB_CONCURRENCY > 1 or BOT_MODE == "standalone"
+
+_relay_setting = os.environ.get("EVENT_RELAY", "auto").lower()
+EVENT_RELAY = MULTI_PROCESS if _relay_setting == "auto" else _relay_setting in ("1", "true", "on")
+
+LOCK_DIR = os.path.join(os.environ.get("DATA_DIR", "data"), "locks")
+
+
+@contextmanager
+def file_lock(path):
+    """Межпроцессная блокировка на время блока (ждет, пока ее отпустят)"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class LeaderLock:
+    """Роль, которую одновременно держит только один процесс"""
+
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.path = os.path.join(directory or LOCK_DIR, f"{name}.lock")
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            self._file = True
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # pid - только для диагностики
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        self._file = None
+
+
+class LeaderRole:
+    """Фоновая задача: ждет роль и запускает связанные с ней службы.
+
+    on_elected и on_resigned - асинхронные функции без аргументов.
+    """
+
+    def __init__(self, name, on_elected, on_resigned=None, retry_interval=LEADER_RETRY_INTERVAL):
+        self.lock = LeaderLock(name)
+        self.on_elected = on_elected
+        self.on_resigned = on_resigned
+        self.retry_interval = retry_interval
+        self._task = None
+
+    async def _run(self):
+        while not self.lock.try_acquire():
+            await asyncio.sleep(self.retry_interval)
+        logger.info(f"Process {os.getpid()} took the '{self.lock.name}' role")
+        await self.on_elected()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            if not self._task.done():
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error(f"Role '{self.lock.name}' failed to start: {e}")
+            self._task = None
+        if self.lock.held:
+            try:
+                if self.on_resigned:
+                    await self.on_resigned()
+            finally:
+                self.lock.release()
@@ -0,0 +1,199 @@
+"""Сжатие ответов и раздача предварительно сжатой статики.
+
+CompressionMiddleware сжимает ответы API (brotli, если установлен модуль
+brotli, иначе gzip) начиная с COMPRESSION_MIN_SIZE байт. Не трогает:
+потоки SSE (сжатие буферизовало бы события), частичные ответы 206 (Range
+относится к несжатому телу) и ответы, у которых уже есть Content-Encoding.
+Потоковые ответы сжимаются по кускам со сбросом буфера компрессора после
+каждого, чтобы клиент получал данные без задержки.
+
+PrecompressedStaticFiles отдает собранный фронтенд: вместо файла - его
+соседа .br или .gz, созданного при сборке (frontend/scripts/precompress.js),
+если клиент его принимает. Файлы с хешем в имени кэшируются навсегда.
+"""
+import mimetypes
+import os
+import re
+import zlib
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - необязательная зависимость
+    brotli = None
+
+# Ответы меньше этого размера не сжимаются: выигрыш меньше накладных расходов
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+# Уровни для сжатия на лету (статика сжимается при сборке с максимальным уровнем)
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript", "application/xml", "image/svg+xml",
+)
+
+# Имена вида main.3f2a1b9c.js или 787.1a2b3c4d.chunk.css (create-react-app)
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+def accepted_encodings(headers: Headers):
+    """Кодировки из Accept-Encoding с ненулевым q"""
+    encodings = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def _is_compressible(content_type):
+    content_type = (content_type or "").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.split(";")[0].endswith("+json")
+
+
+class _Compressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 - формат gzip
+
+    def chunk(self, data):
+        """Сжатый кусок, сразу пригодный для отправки"""
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b""):
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accepted = accepted_encodings(Headers(scope=scope))
+        encoding = "br" if brotli is not None and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size))
+
+
+class _CompressingSend:
+    """Обертка над send: решает по первому куску тела, сжимать ли ответ"""
+
+    def __init__(self, send, encoding, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _should_compress(self, status, headers, body, more_body):
+        if status < 200 or status in (204, 206, 304):
+            return False
+        if "content-encoding" in headers or "content-range" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("text/event-stream") or not _is_compressible(content_type):
+            return False
+        size = len(body) if not more_body else int(headers.get("content-length", self.minimum_size))
+        return size >= self.minimum_size
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            if not self._should_compress(start["status"], headers, body, more_body):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            self.compressor = _Compressor(self.encoding)
+            if more_body:
+                # Длина сжатого потока заранее неизвестна
+                del headers["Content-Length"]
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": self.compressor.chunk(body), "more_body": True})
+            else:
+                body = self.compressor.finish(body)
+                headers["Content-Length"] = str(len(body))
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": body})
+            return
+
+        if self.passthrough:
+            await self.send(message)
+            return
+        data = self.compressor.chunk(body) if more_body else self.compressor.finish(body)
+        await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles, отдающий .br/.gz соседей файлов и кэширующий файлы с хешем в имени"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers)
+        path, encoding = full_path, None
+        for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if candidate in accepted and os.path.isfile(f"{full_path}{suffix}"):
+                path, encoding = f"{full_path}{suffix}", candidate
+                break
+
+        # Тип содержимого - по исходному имени файла, а не по .br/.gz
+        response = FileResponse(
+            path,
+            status_code=status_code,
+            stat_result=os.stat(path) if encoding else stat_result,
+            method=scope["method"],
+            media_type=mimetypes.guess_type(str(full_path))[0] or "text/plain",
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.headers.add_vary_header("Accept-Encoding")
+        if status_code == 200 and HASHED_NAME.search(os.path.basename(str(full_path))):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE
+        else:
+            # index.html и файлы без хеша проверяются при каждом открытии (по ETag)
+            response.headers["Cache-Control"] = "no-cache"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
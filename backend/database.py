@@ -3,15 +3,24 @@ import os
 from sqlite3 import Row
 import shutil
 
+from backend.cluster import file_lock
+from backend.folder_tree import rebuild_folder_closure
+from backend.ordering import rebalance_folder_keys
+
 # Путь к файлу базы данных
 DATABASE_URL = os.environ.get("DATABASE_URL", "data/notes.db")
 DATA_DIR = os.path.dirname(DATABASE_URL)
 USER_DB_DIR = os.path.join(DATA_DIR, "users")
+# Сколько секунд ждать, пока БД занята записью другого потока или процесса
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "30"))
 
 # Убедитесь, что директории существуют
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(USER_DB_DIR, exist_ok=True)
 
+# Пользовательские БД, схема которых уже проверена в этом процессе
+_initialized_user_dbs = set()
+
 def get_db_connection(user_id=None):
     """Создает соединение с базой данных
     
@@ -29,17 +38,21 @@ def get_db_connection(user_id=None):
         # Проверяем существование директории для БД пользователей
         os.makedirs(USER_DB_DIR, exist_ok=True)
             
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT)
         conn.row_factory = Row
         
-        # Если это новая БД, инициализируем таблицы
-        if not os.path.exists(db_path) or os.path.getsize(db_path) == 0:
-            init_user_db(conn)
+        # Создаем недостающие таблицы (в том числе в уже существующих БД)
+        # один раз за время жизни процесса. Обновление схемы не атомарно
+        # (ALTER TABLE, executescript), поэтому процессы выполняют его по очереди
+        if db_path not in _initialized_user_dbs:
+            with file_lock(f"{db_path}.init.lock"):
+                init_user_db(conn)
+            _initialized_user_dbs.add(db_path)
         
         return conn
     else:
         # Подключение к общей БД (для аутентификации и т.п.)
-        conn = sqlite3.connect(DATABASE_URL)
+        conn = sqlite3.connect(DATABASE_URL, timeout=DB_BUSY_TIMEOUT)
         conn.row_factory = Row
         return conn
 
@@ -55,6 +68,9 @@ def init_user_db(conn):
             parent_id TEXT,
             color TEXT,
             position INTEGER DEFAULT 0,
+            order_key TEXT,
+            child_count INTEGER DEFAULT 0,
+            note_count INTEGER DEFAULT 0,
             FOREIGN KEY (parent_id) REFERENCES folders(id) ON DELETE CASCADE
         )
     ''')
@@ -103,14 +119,190 @@ def init_user_db(conn):
     )
     ''')
     
-    # Включаем WAL режим
+    # Таблица замыкания иерархии папок (см. backend/folder_tree.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS folder_closure (
+        ancestor TEXT NOT NULL,
+        descendant TEXT NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor, descendant)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_folder_closure_descendant ON folder_closure (descendant, depth)')
+    
+    # Журнал отложенной записи содержимого заметок (см. backend/write_buffer.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS note_journal (
+        file_id TEXT PRIMARY KEY,
+        content TEXT NOT NULL,
+        seq INTEGER NOT NULL DEFAULT 1,
+        updated_at TEXT NOT NULL
+    )
+    ''')
+    
+    # Содержимое заметок, адресуемое sha256: одинаковые тексты хранятся одним файлом
+    # (files.blob_hash), refcount - число заметок, ссылающихся на файл
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS note_blobs (
+        hash TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        size_bytes INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_note_blobs_unreferenced ON note_blobs (refcount) WHERE refcount <= 0')
+    
+    # Вложения заметок: содержимое лежит в файлах по sha256 (одинаковые файлы хранятся один раз)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS attachments (
+        id TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes INTEGER NOT NULL,
+        content_hash TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_file ON attachments (file_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments (content_hash)')
+    
+    # История версий заметок: снимки и сжатые дельты к предыдущей ревизии (см. backend.revisions)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS note_revisions (
+        file_id TEXT NOT NULL,
+        rev INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        data BLOB NOT NULL,
+        content_hash TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (file_id, rev)
+    ) WITHOUT ROWID
+    ''')
+    
+    _upgrade_user_db(cursor)
+    conn.commit()
+    
+    # Включаем WAL режим (вне транзакции)
     cursor.execute('PRAGMA journal_mode = WAL;')
     
     conn.commit()
 
+def _upgrade_user_db(cursor):
+    """Доводит схему существующей пользовательской БД до актуальной"""
+    # Таблица замыкания должна содержать по строке (папка, папка) на каждую папку
+    cursor.execute("SELECT (SELECT COUNT(*) FROM folders), (SELECT COUNT(*) FROM folder_closure WHERE depth = 0)")
+    folders_count, closure_count = cursor.fetchone()
+    if folders_count != closure_count:
+        rebuild_folder_closure(cursor)
+    
+    _add_column_if_not_exists(cursor, 'folders', 'child_count', 'INTEGER DEFAULT 0')
+    _add_column_if_not_exists(cursor, 'folders', 'note_count', 'INTEGER DEFAULT 0')
+    
+    _add_column_if_not_exists(cursor, 'folders', 'order_key', 'TEXT')
+    
+    # Папкам без ключа порядка выдаем ключи по старому position
+    cursor.execute("SELECT DISTINCT parent_id FROM folders WHERE order_key IS NULL")
+    for (parent_id,) in cursor.fetchall():
+        cursor.execute(
+            "UPDATE folders SET order_key = printf('%010d', position) WHERE parent_id IS ?",
+            (parent_id,)
+        )
+        rebalance_folder_keys(cursor, parent_id)
+    
+    # Денормализованные метаданные содержимого заметки (см. storage.note_metadata)
+    _add_column_if_not_exists(cursor, 'files', 'size_bytes', 'INTEGER')
+    _add_column_if_not_exists(cursor, 'files', 'word_count', 'INTEGER')
+    _add_column_if_not_exists(cursor, 'files', 'updated_at', 'TEXT')
+    _add_column_if_not_exists(cursor, 'files', 'content_hash', 'TEXT')
+    _add_column_if_not_exists(cursor, 'files', 'preview', 'TEXT')
+    # Хеш содержимого, на которое указывает path (NULL - старый файл <id>.md, см. backend.maintenance)
+    _add_column_if_not_exists(cursor, 'files', 'blob_hash', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_blob ON files (blob_hash)')
+    # Остальные поля заполняет backend.maintenance: для них нужно читать файлы
+    cursor.execute("UPDATE files SET updated_at = date_added WHERE updated_at IS NULL")
+    
+    # Индексы для постраничной выдачи дерева по уровням
+    cursor.execute('DROP INDEX IF EXISTS idx_folders_parent')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_folders_order ON folders (parent_id, order_key, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_folder ON files (folder_id, name, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_folder_updated ON files (folder_id, updated_at, id)')
+    # Последние измененные заметки всех папок (бот: /notes и inline-поиск)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_updated ON files (updated_at)')
+    # Иерархия заметок (files.parent_id) для рекурсивных запросов потомков и предков
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_parent ON files (parent_id, name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_tags_file ON file_tags (file_id, tag_id)')
+    # Лента сообщений папки: keyset-пагинация по (created_at, id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_folder_messages_feed ON folder_messages (folder_id, created_at, id)')
+    
+    # Счетчики дочерних папок и заметок поддерживаются триггерами,
+    # поэтому их не нужно обновлять вручную ни в одном обработчике
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_folders_count_insert'")
+    if cursor.fetchone():
+        return
+    
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS trg_folders_count_insert AFTER INSERT ON folders
+        WHEN NEW.parent_id IS NOT NULL
+        BEGIN
+            UPDATE folders SET child_count = child_count + 1 WHERE id = NEW.parent_id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS trg_folders_count_delete AFTER DELETE ON folders
+        WHEN OLD.parent_id IS NOT NULL
+        BEGIN
+            UPDATE folders SET child_count = child_count - 1 WHERE id = OLD.parent_id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS trg_folders_count_move AFTER UPDATE OF parent_id ON folders
+        WHEN OLD.parent_id IS NOT NEW.parent_id
+        BEGIN
+            UPDATE folders SET child_count = child_count - 1 WHERE id = OLD.parent_id;
+            UPDATE folders SET child_count = child_count + 1 WHERE id = NEW.parent_id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS trg_files_count_insert AFTER INSERT ON files
+        WHEN NEW.folder_id IS NOT NULL
+        BEGIN
+            UPDATE folders SET note_count = note_count + 1 WHERE id = NEW.folder_id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS trg_files_count_delete AFTER DELETE ON files
+        WHEN OLD.folder_id IS NOT NULL
+        BEGIN
+            UPDATE folders SET note_count = note_count - 1 WHERE id = OLD.folder_id;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS trg_files_count_move AFTER UPDATE OF folder_id ON files
+        WHEN OLD.folder_id IS NOT NEW.folder_id
+        BEGIN
+            UPDATE folders SET note_count = note_count - 1 WHERE id = OLD.folder_id;
+            UPDATE folders SET note_count = note_count + 1 WHERE id = NEW.folder_id;
+        END;
+    ''')
+    
+    # Заполняем счетчики для уже существующих данных
+    cursor.execute('''
+        UPDATE folders SET
+            child_count = (SELECT COUNT(*) FROM folders AS c WHERE c.parent_id = folders.id),
+            note_count = (SELECT COUNT(*) FROM files WHERE files.folder_id = folders.id)
+    ''')
+
+def user_db_exists(user_id):
+    """Есть ли у пользователя персональная БД (get_db_connection создала бы пустую)"""
+    return os.path.exists(os.path.join(USER_DB_DIR, f"user_{user_id}.db"))
+
+def list_user_ids():
+    """Возвращает идентификаторы пользователей, у которых есть персональная БД"""
+    user_ids = []
+    for filename in sorted(os.listdir(USER_DB_DIR)):
+        if filename.startswith("user_") and filename.endswith(".db"):
+            user_ids.append(filename[len("user_"):-len(".db")])
+    return user_ids
+
 def init_db():
     """Инициализация основной базы данных и создание таблиц"""
-    conn = sqlite3.connect(DATABASE_URL)
+    conn = sqlite3.connect(DATABASE_URL, timeout=DB_BUSY_TIMEOUT)
     cursor = conn.cursor()
     
     # Добавляем таблицу пользователей
@@ -0,0 +1,340 @@
+"""Внутрипроцессный хаб событий и отдача их через Server-Sent Events.
+
+Обработчики публикуют события в канал (например, лента сообщений папки),
+подписчики - открытые SSE-соединения - получают их через собственную
+asyncio.Queue без опроса БД. Очередь подписчика ограничена: если клиент не
+успевает читать, поток закрывается, и клиент переподключается с
+Last-Event-ID, дочитывая пропущенное из БД.
+
+Хаб живет в памяти процесса. Если сервер запущен в несколько процессов,
+к хабу подключается backend.relay (attach_relay): публикация идет через
+общую БД событий, и подписчики всех процессов получают события в одном
+порядке.
+
+Поверх хаба работает канал изменений пользователя (UserEventLog): роутеры
+заметок и папок после коммита публикуют компактные события (строка дерева
+измененной заметки или папки, id удаленных), клиенты применяют их к
+локальному состоянию вместо перезапроса всего дерева. Последние события
+хранятся в кольцевом буфере, чтобы при коротком обрыве дослать пропущенное;
+если пропущено больше, клиент получает событие resync и перечитывает дерево.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько событий может ждать в очереди одного подписчика
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "256"))
+# Интервал комментариев-пингов в SSE (секунды), чтобы прокси не закрывали соединение
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))
+# Сколько последних событий изменений пользователя хранится для досылки при переподключении
+EVENT_REPLAY_SIZE = int(os.environ.get("EVENT_REPLAY_SIZE", "500"))
+
+# Служебные значения очереди: подписчик отстал / хаб остановлен
+_OVERFLOW = object()
+_CLOSED = object()
+
+
+class Subscription:
+    """Подписка одного соединения на канал; создается и читается в цикле событий"""
+
+    def __init__(self, hub, channel, queue_size):
+        self.hub = hub
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def _put(self, item):
+        if self.queue.full():
+            # Отставший подписчик: очищаем очередь и закрываем поток, клиент дочитает из БД
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            item = _OVERFLOW
+        self.queue.put_nowait(item)
+
+    async def events(self, heartbeat=SSE_HEARTBEAT):
+        """События по мере поступления; None - пора отправить пинг. Завершается при переполнении"""
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if item is _OVERFLOW:
+                logger.info(f"Event subscriber on {self.channel} lagged behind, closing stream")
+                return
+            if item is _CLOSED:
+                return
+            yield item
+
+    def close(self):
+        self.hub._unsubscribe(self)
+
+
+class EventHub:
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        # backend.relay.EventRelay, если события нужно передавать другим процессам
+        self.relay = None
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.queue_size)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def _deliver(self, subscription, item):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is subscription.loop:
+            subscription._put(item)
+        else:
+            # Публикация из потока (пул потоков, фоновые задачи): передаем в цикл подписчика
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, item)
+            except RuntimeError:
+                pass  # цикл подписчика уже закрыт
+
+    def publish(self, channel, event):
+        """Отправляет событие всем подписчикам канала; можно вызывать из любого потока"""
+        if self.relay is not None:
+            self.relay.append(channel, event)
+            return
+        self.deliver(channel, event)
+
+    def deliver(self, channel, event):
+        """Раздает событие подписчикам этого процесса"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            self._deliver(subscription, event)
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+    def close_all(self):
+        """Завершает все потоки (при остановке сервера, чтобы она не ждала открытых соединений)"""
+        with self._lock:
+            subscribers = [s for channel in self._subscribers.values() for s in channel]
+        for subscription in subscribers:
+            self._deliver(subscription, _CLOSED)
+
+
+event_hub = EventHub()
+
+
+class UserEventLog:
+    """Нумерованные события изменений по пользователям с буфером для досылки.
+
+    id события - "<эпоха>:<номер>": после перезапуска сервера старые id
+    не совпадут по эпохе, и клиент получит resync. С подключенным relay
+    номер и эпоху выдает общая БД событий, а досылка читается из нее.
+    """
+
+    def __init__(self, hub, replay_size=EVENT_REPLAY_SIZE):
+        self.hub = hub
+        self.replay_size = replay_size
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = defaultdict(int)
+        self._recent = defaultdict(lambda: deque(maxlen=self.replay_size))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def channel(user_id):
+        return ("changes", str(user_id))
+
+    def publish(self, user_id, event_type, **data):
+        user_id = str(user_id)
+        event = dict(data, type=event_type)
+        if self.hub.relay is not None:
+            # Номер выдаст общая БД, подписчикам событие раздаст record()
+            number = self.hub.relay.append(self.channel(user_id), event)
+            # Версия данных меняется сразу, не дожидаясь потока relay: чтение после
+            # записи в этом процессе не должно присоединиться к более старой загрузке
+            with self._lock:
+                self._seq[user_id] = max(self._seq[user_id], number)
+            return
+        with self._lock:
+            event_id = self._remember(user_id, self._seq[user_id] + 1, event)
+        self.hub.deliver(self.channel(user_id), (event_id, event))
+
+    def record(self, user_id, number, event):
+        """Запоминает событие, пришедшее через relay, и раздает его подписчикам процесса"""
+        user_id = str(user_id)
+        with self._lock:
+            event_id = self._remember(user_id, number, event)
+        self.hub.deliver(self.channel(user_id), (event_id, event))
+
+    def _remember(self, user_id, number, event):
+        # publish() с relay мог уже поднять номер до этого события или дальше
+        self._seq[user_id] = max(self._seq[user_id], number)
+        event_id = f"{self.epoch}:{number}"
+        self._recent[user_id].append((number, event_id, event))
+        return event_id
+
+    def data_version(self, user_id):
+        """Номер последнего события пользователя: меняется при каждом опубликованном изменении"""
+        with self._lock:
+            return self._seq.get(str(user_id), 0)
+
+    def since(self, user_id, last_event_id):
+        """События после last_event_id или None, если их уже не восстановить"""
+        epoch, _, seq = (last_event_id or "").partition(":")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq, user_id = int(seq), str(user_id)
+        if self.hub.relay is not None:
+            events = self.hub.relay.since(self.channel(user_id), seq)
+            if events is None:
+                return None
+            return [(f"{self.epoch}:{number}", event) for number, event in events]
+        with self._lock:
+            recent = list(self._recent.get(user_id, ()))
+            current = self._seq.get(user_id, 0)
+        if seq > current:
+            return None
+        if seq < current and (not recent or recent[0][0] > seq + 1):
+            return None
+        return [(event_id, event) for number, event_id, event in recent if number > seq]
+
+
+user_events = UserEventLog(event_hub)
+
+
+def _deliver_relayed(channel, number, event):
+    if channel[0] == "changes":
+        user_events.record(channel[1], number, event)
+    else:
+        event_hub.deliver(channel, event)
+
+
+def attach_relay(relay):
+    """Переключает публикацию событий на общую для процессов БД (backend.relay)"""
+    relay.start(_deliver_relayed)
+    user_events.epoch = relay.epoch
+    event_hub.relay = relay
+
+
+def detach_relay():
+    relay, event_hub.relay = event_hub.relay, None
+    if relay is not None:
+        relay.stop()
+
+
+def _note_rows(cursor, note_ids):
+    """Заметки в виде строк дерева (как в /api/tree)"""
+    rows = []
+    note_ids = list(note_ids)
+    for start in range(0, len(note_ids), 500):
+        chunk = note_ids[start:start + 500]
+        placeholders = ','.join(['?'] * len(chunk))
+        cursor.execute(f"""
+            SELECT id, name, folder_id, parent_id, updated_at, size_bytes, word_count
+            FROM files WHERE id IN ({placeholders})
+        """, chunk)
+        rows.extend({
+            "id": row[0],
+            "name": row[1],
+            "folder_id": row[2],
+            "parent_id": row[3],
+            "updated_at": row[4],
+            "size_bytes": row[5],
+            "word_count": row[6]
+        } for row in cursor.fetchall())
+    return rows
+
+
+def publish_note_changes(user_id, cursor, note_ids):
+    """Публикует note.changed по закоммиченным заметкам; ошибки только логируются"""
+    try:
+        notes = _note_rows(cursor, note_ids)
+        if notes:
+            user_events.publish(user_id, "note.changed", notes=notes)
+    except Exception as e:
+        logger.warning(f"Failed to publish note changes for user {user_id}: {e}")
+
+
+def publish_notes_deleted(user_id, note_ids):
+    """Публикует note.deleted; ошибки только логируются"""
+    if not note_ids:
+        return
+    try:
+        user_events.publish(user_id, "note.deleted", ids=list(note_ids))
+    except Exception as e:
+        logger.warning(f"Failed to publish deleted notes for user {user_id}: {e}")
+
+
+def publish_folder_deleted(user_id, folder_id, parent_id):
+    """Публикует folder.deleted; ошибки только логируются"""
+    try:
+        user_events.publish(user_id, "folder.deleted", id=folder_id, parent_id=parent_id)
+    except Exception as e:
+        logger.warning(f"Failed to publish deleted folder for user {user_id}: {e}")
+
+
+def publish_folder_changes(user_id, cursor, folder_ids):
+    """Публикует folder.changed со строками папок (как в /api/tree); ошибки только логируются.
+
+    None (корень) и повторы в folder_ids пропускаются: вызывающий код передает
+    сразу старого и нового родителя, чьи child_count/note_count поменяли триггеры.
+    """
+    folder_ids = [folder_id for folder_id in dict.fromkeys(folder_ids) if folder_id is not None]
+    if not folder_ids:
+        return
+    try:
+        placeholders = ','.join(['?'] * len(folder_ids))
+        cursor.execute(f"""
+            SELECT id, name, parent_id, color, position, order_key, child_count, note_count
+            FROM folders WHERE id IN ({placeholders})
+        """, folder_ids)
+        folders = [{
+            "id": row[0],
+            "name": row[1],
+            "parent_id": row[2],
+            "color": row[3],
+            "position": row[4],
+            "order_key": row[5],
+            "child_count": row[6],
+            "note_count": row[7]
+        } for row in cursor.fetchall()]
+        if folders:
+            user_events.publish(user_id, "folder.changed", folders=folders)
+    except Exception as e:
+        logger.warning(f"Failed to publish folder changes for user {user_id}: {e}")
+
+
+def format_sse(data, event=None, event_id=None):
+    """Одно сообщение SSE с данными в JSON"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # nginx не должен буферизовать поток
+}
+
+SSE_PING = ": ping\n\n"
@@ -0,0 +1,34 @@
+"""Быстрая сериализация JSON-ответов.
+
+FastAPI прогоняет возвращенные словари через jsonable_encoder (рекурсивный
+обход каждого значения) и затем json.dumps. Для больших ответов (дерево,
+граф, поиск) обработчики возвращают FastJSONResponse сразу: строки из
+sqlite3 уже состоят из str/int/float/None, и их можно отдавать в orjson
+без предварительного обхода.
+
+orjson - необязательная зависимость: без нее используется json из
+стандартной библиотеки с теми же настройками, что у JSONResponse.
+"""
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - необязательная зависимость
+    orjson = None
+
+ORJSON_AVAILABLE = orjson is not None
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse, сериализующий через orjson (если он установлен)"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,81 @@
+"""Таблица замыкания (closure table) для иерархии папок.
+
+folder_closure хранит все пары (предок, потомок) с расстоянием между ними,
+включая пару (папка, папка) с depth = 0. Поэтому поддерево, путь к корню
+и проверка на цикл при перемещении - это один индексированный запрос.
+Все функции работают в транзакции вызывающего кода.
+"""
+
+# Ограничение глубины при восстановлении таблицы из parent_id (защита от циклов в старых данных)
+MAX_FOLDER_DEPTH = 256
+
+
+def insert_folder_closure(cursor, folder_id, parent_id):
+    """Добавляет связи для новой папки"""
+    cursor.execute("""
+        INSERT INTO folder_closure (ancestor, descendant, depth)
+        SELECT ancestor, ?, depth + 1 FROM folder_closure WHERE descendant = ?
+        UNION ALL
+        SELECT ?, ?, 0
+    """, (folder_id, parent_id, folder_id, folder_id))
+
+
+def is_descendant(cursor, ancestor_id, folder_id):
+    """True, если folder_id лежит в поддереве ancestor_id (или совпадает с ней)"""
+    cursor.execute(
+        "SELECT 1 FROM folder_closure WHERE ancestor = ? AND descendant = ?",
+        (ancestor_id, folder_id)
+    )
+    return cursor.fetchone() is not None
+
+
+def move_folder_closure(cursor, folder_id, new_parent_id):
+    """Переносит поддерево folder_id под new_parent_id (None - в корень)"""
+    # Отрываем поддерево от всех его прежних внешних предков
+    cursor.execute("""
+        DELETE FROM folder_closure
+        WHERE descendant IN (SELECT descendant FROM folder_closure WHERE ancestor = ?)
+          AND ancestor NOT IN (SELECT descendant FROM folder_closure WHERE ancestor = ?)
+    """, (folder_id, folder_id))
+
+    if new_parent_id is not None:
+        # Подвешиваем поддерево ко всем предкам нового родителя
+        cursor.execute("""
+            INSERT INTO folder_closure (ancestor, descendant, depth)
+            SELECT above.ancestor, below.descendant, above.depth + below.depth + 1
+            FROM folder_closure AS above, folder_closure AS below
+            WHERE above.descendant = ? AND below.ancestor = ?
+        """, (new_parent_id, folder_id))
+
+
+def remove_folder_closure(cursor, folder_id):
+    """Удаляет папку из иерархии; ее дочерние папки поднимаются на уровень выше"""
+    cursor.execute("""
+        UPDATE folder_closure SET depth = depth - 1
+        WHERE descendant IN (SELECT descendant FROM folder_closure WHERE ancestor = ? AND depth > 0)
+          AND ancestor IN (SELECT ancestor FROM folder_closure WHERE descendant = ? AND depth > 0)
+    """, (folder_id, folder_id))
+    cursor.execute("DELETE FROM folder_closure WHERE ancestor = ? OR descendant = ?", (folder_id, folder_id))
+
+
+def get_subtree_ids(cursor, folder_id):
+    """Идентификаторы папки и всех ее потомков"""
+    cursor.execute("SELECT descendant FROM folder_closure WHERE ancestor = ?", (folder_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def rebuild_folder_closure(cursor):
+    """Полностью пересобирает таблицу по folders.parent_id"""
+    cursor.execute("DELETE FROM folder_closure")
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO folder_closure (ancestor, descendant, depth)
+        WITH RECURSIVE closure(ancestor, descendant, depth) AS (
+            SELECT id, id, 0 FROM folders
+            UNION ALL
+            SELECT closure.ancestor, folders.id, closure.depth + 1
+            FROM closure
+            JOIN folders ON folders.parent_id = closure.descendant
+            WHERE closure.depth < {MAX_FOLDER_DEPTH}
+        )
+        SELECT ancestor, descendant, depth FROM closure
+    """)
@@ -0,0 +1,232 @@
+"""Быстрое сохранение сообщений бота в папку "Входящие".
+
+Текст, присланный боту, и пересланные сообщения (BOT_QUICK_CAPTURE)
+становятся заметками. Сохранение идет через буфер на пользователя:
+сообщения, пришедшие за INBOX_FLUSH_INTERVAL секунд, записываются одной
+пачкой - содержимое одним проходом записи файлов (storage.write_blobs) и
+все заметки одной транзакцией. Сотня пересланных подряд постов - это
+несколько коммитов, а не сотня.
+
+Пачка сохраняется раньше, если в ней набралось INBOX_MAX_BATCH сообщений.
+Сообщения, которые еще не записаны, живут только в памяти процесса: при
+остановке stop() записывает все накопленное.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from backend.database import get_db_connection
+from backend.events import publish_note_changes, publish_folder_changes
+from backend.folder_tree import insert_folder_closure
+from backend.ordering import key_between
+from backend.revisions import record_revision
+from backend.storage import write_blobs, acquire_blob, update_note_metadata
+
+logger = logging.getLogger(__name__)
+
+INBOX_FOLDER_NAME = os.environ.get("INBOX_FOLDER_NAME", "Входящие")
+# Сколько секунд копить сообщения пользователя перед записью
+INBOX_FLUSH_INTERVAL = float(os.environ.get("INBOX_FLUSH_INTERVAL", "1.0"))
+# Размер пачки, при котором запись начинается сразу
+INBOX_MAX_BATCH = int(os.environ.get("INBOX_MAX_BATCH", "200"))
+# Попыток записи пачки при ошибках БД или диска
+INBOX_MAX_ATTEMPTS = 3
+
+
+@dataclass
+class Capture:
+    id: str
+    name: str
+    content: str
+    date_added: str
+    # Вызывается в цикле событий после коммита с id заметки
+    on_saved: Optional[Callable[[str], None]] = None
+    attempts: int = 0
+
+
+def _inbox_folder(cursor):
+    """ID папки "Входящие" в корне; создает ее, если нет (в транзакции вызывающего кода)"""
+    cursor.execute(
+        "SELECT id FROM folders WHERE parent_id IS NULL AND name = ? ORDER BY order_key LIMIT 1",
+        (INBOX_FOLDER_NAME,)
+    )
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    cursor.execute("""
+        SELECT order_key FROM folders
+        WHERE parent_id IS NULL AND order_key IS NOT NULL
+        ORDER BY order_key DESC
+        LIMIT 1
+    """)
+    last = cursor.fetchone()
+    folder_id = str(uuid.uuid4())
+    cursor.execute(
+        "INSERT INTO folders (id, name, parent_id, order_key) VALUES (?, ?, NULL, ?)",
+        (folder_id, INBOX_FOLDER_NAME, key_between(last[0] if last else None, None))
+    )
+    insert_folder_closure(cursor, folder_id, None)
+    return folder_id
+
+
+def save_captures(user_id, captures):
+    """Записывает пачку сообщений пользователя заметками во "Входящие" одной транзакцией"""
+    # Файлы пишутся до блокировки БД; acquire_blob только добавит ссылки
+    hashes = write_blobs(user_id, [capture.content for capture in captures])
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    try:
+        # Поиск и создание папки должны быть атомарны и для других процессов
+        cursor.execute("BEGIN IMMEDIATE")
+        folder_id = _inbox_folder(cursor)
+        for capture, content_hash in zip(captures, hashes):
+            blob_hash, path = acquire_blob(cursor, user_id, capture.content, content_hash)
+            cursor.execute("""
+                INSERT INTO files (id, name, path, blob_hash, date_added, folder_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (capture.id, capture.name, path, blob_hash, capture.date_added, folder_id))
+            update_note_metadata(cursor, capture.id, capture.content, capture.date_added)
+            record_revision(cursor, capture.id, capture.content, blob_hash)
+        conn.commit()
+        # Новая папка или ее note_count - клиенты получают строку папки до заметок
+        publish_folder_changes(user_id, cursor, [folder_id])
+        publish_note_changes(user_id, cursor, [capture.id for capture in captures])
+    except Exception:
+        # Файлы без ссылок уберет backend.maintenance
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+class InboxWriter:
+    """Буферизованная запись сообщений во "Входящие"; работает в цикле событий первого capture()"""
+
+    def __init__(self, flush_interval=INBOX_FLUSH_INTERVAL, max_batch=INBOX_MAX_BATCH):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # user_id -> (время первого сообщения пачки, [Capture])
+        self._pending = {}
+        self._flushing = set()
+        self._loop = None
+        self._worker = None
+        self._wakeup = None
+        self._tasks = set()
+        self._draining = False
+
+    def capture(self, user_id, name, content, on_saved=None):
+        """Ставит сообщение в очередь на сохранение; возвращает id будущей заметки"""
+        if self._worker is None or self._worker.done():
+            self.start()
+        capture = Capture(str(uuid.uuid4()), name, content, datetime.now().isoformat(), on_saved)
+        self._enqueue(str(user_id), [capture])
+        return capture.id
+
+    def _enqueue(self, user_id, captures, front=False):
+        entry = self._pending.get(user_id)
+        if entry is None:
+            self._pending[user_id] = (self._loop.time(), list(captures))
+        elif front:
+            entry[1][:0] = captures
+        else:
+            entry[1].extend(captures)
+        self._wakeup.set()
+
+    def pending_count(self):
+        return sum(len(captures) for _, captures in self._pending.values())
+
+    def start(self):
+        """Запускает запись в текущем цикле событий"""
+        if self._worker is not None and not self._worker.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._draining = False
+        self._worker = self._loop.create_task(self._run())
+
+    async def stop(self, timeout=10.0):
+        """Записывает накопленное (не дольше timeout секунд) и останавливает запись"""
+        if self._worker is None:
+            return
+        self._draining = True
+        self._wakeup.set()
+        deadline = self._loop.time() + timeout
+        while (self._pending or self._tasks) and self._loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        self._worker.cancel()
+        for task in list(self._tasks) + [self._worker]:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._pending:
+            logger.error(f"Inbox stopped with {self.pending_count()} unsaved message(s)")
+        self._worker = None
+        self._loop = None
+
+    def _next_due(self, now):
+        """Пользователи, чьи пачки пора записать, и сколько ждать следующей"""
+        due, wait = [], None
+        for user_id, (first_at, captures) in self._pending.items():
+            if user_id in self._flushing:
+                continue
+            ready_at = first_at if self._draining or len(captures) >= self.max_batch \
+                else first_at + self.flush_interval
+            if ready_at <= now:
+                due.append(user_id)
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return due, wait
+
+    async def _run(self):
+        while True:
+            due, wait = self._next_due(self._loop.time())
+            if not due:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Пачки разных пользователей пишутся параллельно, одного - по очереди
+            for user_id in due:
+                _, captures = self._pending.pop(user_id)
+                self._flushing.add(user_id)
+                task = self._loop.create_task(self._flush(user_id, captures))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, user_id, captures):
+        try:
+            for start in range(0, len(captures), self.max_batch):
+                batch = captures[start:start + self.max_batch]
+                try:
+                    await run_in_threadpool(save_captures, user_id, batch)
+                except Exception as e:
+                    retry = [capture for capture in captures[start:] if capture.attempts + 1 < INBOX_MAX_ATTEMPTS]
+                    for capture in retry:
+                        capture.attempts += 1
+                    logger.error(f"Inbox flush failed for user {user_id}, "
+                                 f"{len(retry)} message(s) will be retried: {e}")
+                    if retry:
+                        self._enqueue(user_id, retry, front=True)
+                    return
+                for capture in batch:
+                    if capture.on_saved:
+                        try:
+                            capture.on_saved(capture.id)
+                        except Exception as e:
+                            logger.error(f"Inbox callback failed: {e}")
+        finally:
+            self._flushing.discard(user_id)
+            self._wakeup.set()
+
+
+# Общий буфер процесса
+inbox_writer = InboxWriter()
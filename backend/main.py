@@ -1,13 +1,22 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from routers import notes, folders, graph, tree, auth  # Импортируем все роутеры
+from routers import notes, folders, graph, tree, auth, batch, attachments, messages, events  # Импортируем все роутеры
 from database import init_db
+from backend.write_buffer import write_buffer, recover as recover_write_buffer
+from backend.maintenance import maintenance_job
+from backend.thumbnails import shutdown_thumbnail_pool
+from backend.events import event_hub, attach_relay, detach_relay
+from backend.relay import EventRelay
+from backend.cluster import EVENT_RELAY, WEB_CONCURRENCY, LeaderRole
+from backend.fastjson import FastJSONResponse
+from backend.compression import CompressionMiddleware
 
 # Задаем режим разработки через переменную окружения
 DEV_MODE = os.environ.get("DEV_MODE", "False").lower() == "true"
 
-app = FastAPI(title="Notes Manager API")
+# Ответы сериализуются через orjson (см. backend/fastjson.py)
+app = FastAPI(title="Notes Manager API", default_response_class=FastJSONResponse)
 
 # Настройка CORS
 app.add_middleware(
@@ -18,6 +27,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Сжатие ответов API (gzip/brotli, см. backend/compression.py)
+app.add_middleware(CompressionMiddleware)
+
 # Инициализируем базу данных при запуске
 init_db()
 
@@ -26,7 +38,60 @@ app.include_router(notes.router)
 app.include_router(folders.router)
 app.include_router(graph.router)
 app.include_router(tree.router)
-app.include_router(auth.router) 
+app.include_router(auth.router)
+app.include_router(batch.router)
+app.include_router(attachments.router)
+app.include_router(messages.router)
+app.include_router(events.router)
+
+async def _start_maintenance():
+    maintenance_job.start()
+
+async def _stop_maintenance():
+    maintenance_job.stop()
+
+# Фоновая проверка работает только в одном процессе (см. backend/cluster.py)
+maintenance_role = LeaderRole("maintenance", _start_maintenance, _stop_maintenance)
+
+@app.on_event("startup")
+async def start_event_relay():
+    """При нескольких процессах события передаются через общую БД (backend/relay.py)"""
+    if EVENT_RELAY:
+        attach_relay(EventRelay())
+
+@app.on_event("startup")
+async def start_write_buffer():
+    """Дописывает версии, оставшиеся в журнале после прошлого запуска, и запускает фоновый сброс"""
+    # Свежие временные файлы могут принадлежать другим работающим процессам
+    recover_write_buffer(temp_min_age=300 if WEB_CONCURRENCY > 1 else 0)
+    write_buffer.start()
+
+@app.on_event("startup")
+async def start_maintenance():
+    """Запускает фоновую проверку согласованности (если задан MAINTENANCE_INTERVAL)"""
+    maintenance_role.start()
+
+@app.on_event("shutdown")
+async def stop_write_buffer():
+    """Записывает в файлы все, что осталось в буфере отложенной записи"""
+    write_buffer.stop()
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    await maintenance_role.stop()
+
+@app.on_event("shutdown")
+async def stop_thumbnails():
+    shutdown_thumbnail_pool()
+
+@app.on_event("shutdown")
+async def stop_event_streams():
+    """Закрывает открытые SSE-потоки, чтобы остановка не ждала их"""
+    event_hub.close_all()
+
+@app.on_event("shutdown")
+async def stop_event_relay():
+    detach_relay()
 
 @app.get("/")
 async def root():
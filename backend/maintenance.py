@@ -0,0 +1,380 @@
+"""Проверка согласованности файлов заметок и записей БД, сборка мусора.
+
+Для каждого пользователя ищет:
+  - missing_files: записи files, у которых нет файла (и нет версии в журнале);
+  - orphan_files: старые файлы <id>.md, на которые не ссылается ни одна запись;
+  - legacy_files: заметки, содержимое которых еще лежит в файлах <id>.md, а не
+    по хешу (при --repair переносятся);
+  - blob_refcount_mismatches: счетчики ссылок note_blobs, не совпадающие с files
+    (при --repair пересчитываются, содержимое без ссылок удаляется);
+  - orphan_blobs: файлы содержимого по хешу без строки в note_blobs;
+  - dangling_tag_links: строки file_tags, ссылающиеся на удаленные заметки или теги;
+  - unused_tags: теги, не привязанные ни к одной заметке;
+  - orphan_messages: сообщения удаленных папок;
+  - orphan_journal: версии в журнале отложенной записи для удаленных заметок;
+  - orphan_attachments: вложения удаленных заметок;
+  - orphan_revisions: история версий удаленных заметок;
+  - orphan_attachment_files: содержимое вложений, на которое не ссылается ни одна запись;
+  - stale_metadata: заметки без размера/хеша/превью в files (записи, созданные
+    до появления этих колонок); при --repair пересчитываются.
+
+Пользователи проверяются параллельно, файловые операции ограничиваются по
+частоте, чтобы задачу можно было запускать на работающем сервере.
+
+Запуск вручную:
+python -m backend.maintenance [--repair] [--user-id ID]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.database import get_db_connection, list_user_ids
+from backend.storage import (
+    get_user_notes_dir, update_note_metadata, read_note_file, TEMP_SUFFIX,
+    get_user_attachments_dir, collect_attachment_garbage,
+    get_user_blobs_dir, acquire_blob, collect_blob_garbage
+)
+from backend.thumbnails import THUMBNAIL_SUFFIX
+from backend.write_buffer import read_note_content
+
+logger = logging.getLogger(__name__)
+
+# Период фоновой проверки в секундах (0 - фоновая проверка выключена)
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "0"))
+# Исправлять найденные проблемы, а не только сообщать о них
+MAINTENANCE_REPAIR = os.environ.get("MAINTENANCE_REPAIR", "False").lower() == "true"
+# Сколько пользователей проверяется одновременно
+MAINTENANCE_WORKERS = int(os.environ.get("MAINTENANCE_WORKERS", "2"))
+# Ограничение файловых операций в секунду на всю задачу
+MAINTENANCE_IO_RATE = float(os.environ.get("MAINTENANCE_IO_RATE", "200"))
+# Файлы моложе этого (сек) не считаются сиротами: запись о них может быть еще не закоммичена,
+# а список записей читается раньше, чем обходится каталог
+ORPHAN_FILE_MIN_AGE = 60
+
+
+class IOThrottle:
+    """Ограничитель частоты операций (token bucket), общий для всех потоков проверки"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+                wait = (cost - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def check_user(user_id, repair=False, throttle=None):
+    """Проверяет данные одного пользователя и при repair=True исправляет найденное"""
+    throttle = throttle or IOThrottle(MAINTENANCE_IO_RATE)
+    report = {
+        "missing_files": [],
+        "orphan_files": [],
+        "legacy_files": 0,
+        "blob_refcount_mismatches": 0,
+        "orphan_blobs": [],
+        "dangling_tag_links": 0,
+        "unused_tags": [],
+        "orphan_messages": 0,
+        "orphan_journal": 0,
+        "orphan_attachments": 0,
+        "orphan_revisions": 0,
+        "orphan_attachment_files": [],
+        "stale_metadata": [],
+    }
+
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT file_id FROM note_journal")
+        journaled = {row[0] for row in cursor.fetchall()}
+
+        # Записи без файлов
+        cursor.execute("SELECT id, path FROM files")
+        rows = cursor.fetchall()
+        referenced = set()
+        for note_id, path in rows:
+            referenced.add(os.path.abspath(path))
+            throttle.acquire()
+            if not os.path.exists(path) and note_id not in journaled:
+                report["missing_files"].append(note_id)
+
+        # Файлы без записей
+        notes_dir = get_user_notes_dir(user_id)
+        min_mtime = time.time() - ORPHAN_FILE_MIN_AGE
+        throttle.acquire()
+        for entry in os.scandir(notes_dir):
+            if not entry.is_file() or not entry.name.endswith(".md") or entry.name.endswith(TEMP_SUFFIX):
+                continue
+            if os.path.abspath(entry.path) not in referenced and entry.stat().st_mtime < min_mtime:
+                report["orphan_files"].append(entry.name)
+
+        cursor.execute("SELECT COUNT(*) FROM files WHERE blob_hash IS NULL")
+        report["legacy_files"] = cursor.fetchone()[0]
+
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM note_blobs
+                 WHERE refcount != (SELECT COUNT(*) FROM files WHERE files.blob_hash = note_blobs.hash))
+              + (SELECT COUNT(DISTINCT blob_hash) FROM files
+                 WHERE blob_hash IS NOT NULL AND blob_hash NOT IN (SELECT hash FROM note_blobs))
+        """)
+        report["blob_refcount_mismatches"] = cursor.fetchone()[0]
+
+        cursor.execute("SELECT hash FROM note_blobs")
+        known_blobs = {row[0] for row in cursor.fetchall()}
+        throttle.acquire()
+        for directory, _, filenames in os.walk(get_user_blobs_dir(user_id)):
+            for filename in filenames:
+                if filename.startswith(".") or not filename.endswith(".md"):
+                    continue
+                path = os.path.join(directory, filename)
+                if filename[:-len(".md")] not in known_blobs and os.path.getmtime(path) < min_mtime:
+                    report["orphan_blobs"].append(path)
+
+        cursor.execute("""
+            SELECT COUNT(*) FROM file_tags
+            WHERE file_id NOT IN (SELECT id FROM files)
+               OR tag_id NOT IN (SELECT id FROM unique_tags)
+        """)
+        report["dangling_tag_links"] = cursor.fetchone()[0]
+
+        cursor.execute("""
+            SELECT tag FROM unique_tags
+            WHERE id NOT IN (
+                SELECT tag_id FROM file_tags WHERE file_id IN (SELECT id FROM files)
+            )
+        """)
+        report["unused_tags"] = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute("SELECT COUNT(*) FROM folder_messages WHERE folder_id NOT IN (SELECT id FROM folders)")
+        report["orphan_messages"] = cursor.fetchone()[0]
+
+        cursor.execute("SELECT COUNT(*) FROM note_journal WHERE file_id NOT IN (SELECT id FROM files)")
+        report["orphan_journal"] = cursor.fetchone()[0]
+
+        cursor.execute("SELECT COUNT(*) FROM attachments WHERE file_id NOT IN (SELECT id FROM files)")
+        report["orphan_attachments"] = cursor.fetchone()[0]
+
+        cursor.execute("SELECT COUNT(DISTINCT file_id) FROM note_revisions WHERE file_id NOT IN (SELECT id FROM files)")
+        report["orphan_revisions"] = cursor.fetchone()[0]
+
+        # Содержимое вложений без записей (записи вложений удаленных заметок тоже не в счет)
+        cursor.execute("""
+            SELECT DISTINCT content_hash FROM attachments WHERE file_id IN (SELECT id FROM files)
+        """)
+        live_hashes = {row[0] for row in cursor.fetchall()}
+        throttle.acquire()
+        for directory, _, filenames in os.walk(get_user_attachments_dir(user_id)):
+            for filename in filenames:
+                if filename.startswith(".") or filename.endswith(THUMBNAIL_SUFFIX):
+                    continue
+                path = os.path.join(directory, filename)
+                if filename not in live_hashes and os.path.getmtime(path) < min_mtime:
+                    report["orphan_attachment_files"].append(path)
+
+        cursor.execute("SELECT id FROM files WHERE content_hash IS NULL OR size_bytes IS NULL OR preview IS NULL")
+        report["stale_metadata"] = [row[0] for row in cursor.fetchall()]
+
+        if repair:
+            migrated_paths = _repair_user(cursor, user_id, report, throttle)
+            conn.commit()
+            _remove_orphan_blobs(conn, report["orphan_blobs"], throttle)
+            collect_blob_garbage(conn, user_id)
+            # Ссылки перепроверяются под блокировкой записи: вложение могли загрузить после проверки
+            for path in report["orphan_attachment_files"]:
+                throttle.acquire()
+                collect_attachment_garbage(conn, user_id, [os.path.basename(path)])
+    finally:
+        conn.close()
+
+    if repair:
+        # Файлы удаляем после коммита: ссылки на них в БД уже проверены
+        for path in migrated_paths:
+            throttle.acquire()
+            if os.path.exists(path):
+                os.remove(path)
+        for filename in report["orphan_files"]:
+            throttle.acquire()
+            path = os.path.join(get_user_notes_dir(user_id), filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    return report
+
+
+def _repair_user(cursor, user_id, report, throttle):
+    """Исправления в БД (одной транзакцией под блокировкой записи); возвращает старые
+    файлы <id>.md, которые нужно удалить после коммита"""
+    cursor.execute("BEGIN IMMEDIATE")
+    # Восстанавливаем отсутствующие файлы пустыми, как раньше делал get_note. Список
+    # собран без блокировки: за это время заметку могли переключить на новый файл
+    # (запись журнала, восстановление ревизии), поэтому каждую проверяем заново
+    for note_id in report["missing_files"]:
+        throttle.acquire()
+        cursor.execute("""
+            SELECT path FROM files
+            WHERE id = ? AND id NOT IN (SELECT file_id FROM note_journal)
+        """, (note_id,))
+        row = cursor.fetchone()
+        if not row or os.path.exists(row[0]):
+            continue
+        blob_hash, path = acquire_blob(cursor, user_id, "")
+        cursor.execute("UPDATE files SET path = ?, blob_hash = ? WHERE id = ?", (path, blob_hash, note_id))
+        update_note_metadata(cursor, note_id, "")
+
+    # Переносим содержимое из старых файлов <id>.md в файлы по хешу
+    migrated_paths = []
+    cursor.execute("SELECT id, path FROM files WHERE blob_hash IS NULL")
+    for note_id, path in cursor.fetchall():
+        throttle.acquire()
+        content = read_note_file(path)
+        if content is None:
+            continue
+        blob_hash, blob_path = acquire_blob(cursor, user_id, content)
+        cursor.execute("UPDATE files SET path = ?, blob_hash = ? WHERE id = ?", (blob_path, blob_hash, note_id))
+        migrated_paths.append(path)
+
+    # Счетчики ссылок пересчитываем по files (под блокировкой записи транзакции ремонта)
+    cursor.execute("""
+        INSERT INTO note_blobs (hash, refcount, size_bytes)
+        SELECT blob_hash, 0, MAX(COALESCE(size_bytes, 0)) FROM files
+        WHERE blob_hash IS NOT NULL AND blob_hash NOT IN (SELECT hash FROM note_blobs)
+        GROUP BY blob_hash
+    """)
+    cursor.execute("""
+        UPDATE note_blobs SET refcount = (SELECT COUNT(*) FROM files WHERE files.blob_hash = note_blobs.hash)
+    """)
+
+    # Пересчитываем метаданные по актуальному содержимому, не меняя updated_at
+    for note_id in report["stale_metadata"]:
+        throttle.acquire()
+        cursor.execute("SELECT path, updated_at FROM files WHERE id = ?", (note_id,))
+        path, updated_at = cursor.fetchone()
+        content = read_note_content(cursor, note_id, path)
+        if content is not None:
+            update_note_metadata(cursor, note_id, content, updated_at)
+
+    cursor.execute("""
+        DELETE FROM file_tags
+        WHERE file_id NOT IN (SELECT id FROM files)
+           OR tag_id NOT IN (SELECT id FROM unique_tags)
+    """)
+    cursor.execute("DELETE FROM unique_tags WHERE id NOT IN (SELECT tag_id FROM file_tags)")
+    cursor.execute("DELETE FROM folder_messages WHERE folder_id NOT IN (SELECT id FROM folders)")
+    cursor.execute("DELETE FROM note_journal WHERE file_id NOT IN (SELECT id FROM files)")
+    cursor.execute("DELETE FROM attachments WHERE file_id NOT IN (SELECT id FROM files)")
+    cursor.execute("DELETE FROM note_revisions WHERE file_id NOT IN (SELECT id FROM files)")
+    return migrated_paths
+
+
+def _remove_orphan_blobs(conn, paths, throttle):
+    """Удаляет файлы содержимого без строк note_blobs под блокировкой записи (как collect_blob_garbage)"""
+    if not paths:
+        return
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        for path in paths:
+            throttle.acquire()
+            content_hash = os.path.basename(path)[:-len(".md")]
+            cursor.execute("SELECT 1 FROM note_blobs WHERE hash = ?", (content_hash,))
+            if not cursor.fetchone() and os.path.exists(path):
+                os.remove(path)
+    finally:
+        conn.rollback()
+
+
+def run_maintenance(repair=False, user_ids=None, workers=MAINTENANCE_WORKERS, io_rate=MAINTENANCE_IO_RATE):
+    """Проверяет всех (или указанных) пользователей параллельно; возвращает отчеты по пользователям"""
+    user_ids = list(user_ids) if user_ids is not None else list_user_ids()
+    throttle = IOThrottle(io_rate)
+    reports = {}
+
+    def _check(user_id):
+        try:
+            return check_user(user_id, repair=repair, throttle=throttle)
+        except Exception as e:
+            logger.error(f"Maintenance failed for user {user_id}: {e}")
+            return {"error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="maintenance") as pool:
+        for user_id, report in zip(user_ids, pool.map(_check, user_ids)):
+            reports[user_id] = report
+    return reports
+
+
+def _has_problems(report):
+    return any(report.get(key) for key in (
+        "error", "missing_files", "orphan_files", "legacy_files", "blob_refcount_mismatches",
+        "orphan_blobs", "dangling_tag_links", "unused_tags", "orphan_messages", "orphan_journal",
+        "orphan_attachments", "orphan_revisions", "orphan_attachment_files", "stale_metadata"
+    ))
+
+
+class MaintenanceJob:
+    """Фоновая периодическая проверка"""
+
+    def __init__(self, interval=MAINTENANCE_INTERVAL, repair=MAINTENANCE_REPAIR):
+        self.interval = interval
+        self.repair = repair
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            reports = run_maintenance(repair=self.repair)
+            for user_id, report in reports.items():
+                if _has_problems(report):
+                    logger.warning(f"Maintenance report for user {user_id}: {report}")
+
+    def start(self):
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+maintenance_job = MaintenanceJob()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check note files against the database')
+    parser.add_argument('--repair', action='store_true', help='Fix problems instead of only reporting them')
+    parser.add_argument('--user-id', help='Check only this Telegram user ID')
+    parser.add_argument('--workers', type=int, default=MAINTENANCE_WORKERS, help='Users checked in parallel')
+    parser.add_argument('--io-rate', type=float, default=MAINTENANCE_IO_RATE, help='File operations per second (0 - unlimited)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = run_maintenance(
+        repair=args.repair,
+        user_ids=[args.user_id] if args.user_id else None,
+        workers=args.workers,
+        io_rate=args.io_rate,
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
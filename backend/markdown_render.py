@@ -0,0 +1,216 @@
+"""Серверный рендеринг markdown заметок в безопасный HTML с кэшем.
+
+HTML зависит только от содержимого, поэтому кэш общий для всех
+пользователей и адресуется хешем содержимого (files.content_hash) и версией
+рендерера. Два уровня: ограниченный по объему LRU в памяти процесса и
+каталог на диске (DATA_DIR/cache/html), который переживает перезапуск и
+подрезается по давности использования. Повторное открытие неизмененной
+заметки не читает ни файл заметки, ни рендерер.
+
+Зависимости markdown и bleach необязательные: без них RENDERING_AVAILABLE
+равен False, а клиент продолжает рендерить сам.
+"""
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+from xml.etree import ElementTree
+
+try:
+    import markdown
+    from markdown.extensions import Extension
+    from markdown.inlinepatterns import InlineProcessor
+    from markdown.treeprocessors import Treeprocessor
+except ImportError:  # pragma: no cover - необязательная зависимость
+    markdown = None
+
+try:
+    import bleach
+except ImportError:  # pragma: no cover - необязательная зависимость
+    bleach = None
+
+logger = logging.getLogger(__name__)
+
+RENDERING_AVAILABLE = markdown is not None and bleach is not None
+
+# Меняется при изменении правил рендеринга или очистки, чтобы старый кэш не использовался
+RENDER_VERSION = "1"
+
+# Объем кэша HTML в памяти и на диске (байты)
+HTML_CACHE_MEMORY_BYTES = int(os.environ.get("HTML_CACHE_MEMORY_BYTES", str(16 * 1024 * 1024)))
+HTML_CACHE_DISK_BYTES = int(os.environ.get("HTML_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+# Теги #tag, как в MarkdownPreview.js
+TAG_PATTERN = r"(?<![\w&#])#([a-zA-Zа-яА-ЯёЁ0-9]\w*(?:[-_][a-zA-Zа-яА-ЯёЁ0-9]\w*)*)"
+
+ALLOWED_TAGS = [
+    "a", "abbr", "b", "blockquote", "br", "code", "del", "div", "em", "h1", "h2", "h3",
+    "h4", "h5", "h6", "hr", "i", "img", "li", "ol", "p", "pre", "span", "strong",
+    "table", "tbody", "td", "th", "thead", "tr", "ul",
+]
+ALLOWED_ATTRIBUTES = {
+    "a": ["href", "title", "target", "rel"],
+    "img": ["src", "alt", "title"],
+    "code": ["class"],
+    "span": ["class"],
+    "th": ["align"],
+    "td": ["align"],
+}
+ALLOWED_PROTOCOLS = ["http", "https", "mailto"]
+
+
+if markdown is not None:
+    class _TagInlineProcessor(InlineProcessor):
+        def handleMatch(self, m, data):
+            element = ElementTree.Element("span")
+            element.set("class", "tag")
+            element.text = m.group(0)
+            return element, m.start(0), m.end(0)
+
+    class _ExternalLinksTreeprocessor(Treeprocessor):
+        def run(self, root):
+            for link in root.iter("a"):
+                link.set("target", "_blank")
+                link.set("rel", "noopener noreferrer")
+
+    class NotesExtension(Extension):
+        """Особенности клиентского рендерера: #теги и ссылки в новой вкладке"""
+
+        def extendMarkdown(self, md):
+            md.inlinePatterns.register(_TagInlineProcessor(TAG_PATTERN, md), "note_tag", 65)
+            md.treeprocessors.register(_ExternalLinksTreeprocessor(md), "external_links", 5)
+
+
+def render_markdown(content: str) -> str:
+    """Рендерит markdown в очищенный HTML (экземпляр Markdown не потокобезопасен, создаем на вызов)"""
+    html = markdown.markdown(
+        content,
+        extensions=["fenced_code", "tables", "nl2br", "sane_lists", NotesExtension()],
+    )
+    return bleach.clean(
+        html,
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRIBUTES,
+        protocols=ALLOWED_PROTOCOLS,
+        strip=True,
+    )
+
+
+class HtmlCache:
+    """Двухуровневый кэш HTML: LRU в памяти и каталог на диске"""
+
+    def __init__(self, directory, max_memory_bytes=HTML_CACHE_MEMORY_BYTES, max_disk_bytes=HTML_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # считается при первом обращении
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.html")
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            html = self._memory.get(key)
+            if html is not None:
+                self._memory.move_to_end(key)
+                return html
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                html = f.read()
+            # Время изменения служит меткой использования при подрезке диска
+            os.utime(path)
+        except OSError:
+            return None
+        self._remember(key, html)
+        return html
+
+    def put(self, key, html):
+        self._remember(key, html)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Атомарная запись без fsync: потеря кэша при сбое безопасна
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(html)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write HTML cache entry {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(html.encode("utf-8"))
+        self._prune_disk()
+
+    def _remember(self, key, html):
+        size = len(html.encode("utf-8"))
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous.encode("utf-8"))
+            self._memory[key] = html
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted.encode("utf-8"))
+
+    def _scan_disk(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _prune_disk(self):
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            # Удаляем давно не использованные записи, пока не освободим десятую часть лимита
+            entries = sorted(self._scan_disk())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_disk_bytes * 9 // 10
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._disk_bytes = total
+
+
+html_cache = HtmlCache(os.path.join(os.environ.get("DATA_DIR", "data"), "cache", "html"))
+
+
+def cache_key(content_hash):
+    return f"{content_hash}-v{RENDER_VERSION}"
+
+
+def get_rendered_html(content_hash, load_content):
+    """HTML заметки по хешу содержимого; load_content() вызывается только при промахе кэша"""
+    key = cache_key(content_hash)
+    html = html_cache.get(key)
+    if html is None:
+        html = render_markdown(load_content())
+        html_cache.put(key, html)
+    return html
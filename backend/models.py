@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, root_validator
+from typing import List, Literal, Optional
 from datetime import datetime
 import uuid
 
@@ -16,6 +16,25 @@ class Note(BaseModel):
     tags: List[Tag] = []
     date_added: Optional[str] = Field(default_factory=lambda: datetime.now().isoformat())
 
+class ContentDelta(BaseModel):
+    op: str  # "append" или "replace"
+    text: str = ""
+    start: Optional[int] = None  # для "replace": диапазон [start, end) в символах
+    end: Optional[int] = None
+
+class NotePatch(BaseModel):
+    name: Optional[str] = None
+    content: Optional[str] = None
+    delta: Optional[ContentDelta] = None
+    folder_id: Optional[str] = None
+    parent_id: Optional[str] = None
+    tags: Optional[List[Tag]] = None
+
+class NoteDuplicate(BaseModel):
+    name: Optional[str] = None
+    folder_id: Optional[str] = None
+    parent_id: Optional[str] = None
+
 class Folder(BaseModel):
     id: Optional[str] = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -23,6 +42,15 @@ class Folder(BaseModel):
     color: Optional[str] = None
     position: int = 0
 
+class FolderMove(BaseModel):
+    parent_id: Optional[str] = None  # если не передан, папка остается у прежнего родителя
+    after_id: Optional[str] = None   # соседняя папка, после которой встать
+    before_id: Optional[str] = None  # соседняя папка, перед которой встать
+
+class FolderMessage(BaseModel):
+    content: str
+    author: Optional[str] = None  # по умолчанию - имя текущего пользователя
+
 class GraphNode(BaseModel):
     id: str
     name: str
@@ -38,4 +66,35 @@ class GraphEdge(BaseModel):
 
 class GraphData(BaseModel):
     nodes: List[GraphNode]
-    edges: List[GraphEdge]
\ No newline at end of file
+    edges: List[GraphEdge]
+class BatchOperation(BaseModel):
+    op: Literal["create", "update", "move", "tag", "untag", "delete"]
+    id: Optional[str] = None
+    ids: List[str] = []  # для move/tag/untag/delete можно передать сразу несколько заметок
+    name: Optional[str] = None
+    content: Optional[str] = None
+    folder_id: Optional[str] = None
+    parent_id: Optional[str] = None
+    tags: Optional[List[Tag]] = None
+
+    @root_validator(pre=True)
+    def check_required_fields(cls, values):
+        """Обязательные поля операции проверяются до транзакции: неверный запрос - 422, а не ошибка БД"""
+        op = values.get("op")
+        if op == "create" and not values.get("name"):
+            raise ValueError("name is required")
+        if op == "update":
+            if not values.get("id"):
+                raise ValueError("id is required")
+            if "name" in values and not values["name"]:
+                raise ValueError("name cannot be empty")
+        if op in ("move", "tag", "untag", "delete") and not (values.get("id") or values.get("ids")):
+            raise ValueError("no note ids given")
+        if op == "move" and "folder_id" not in values and "parent_id" not in values:
+            raise ValueError("folder_id or parent_id is required")
+        if op in ("tag", "untag") and not values.get("tags"):
+            raise ValueError("tags are required")
+        return values
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
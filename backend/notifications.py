@@ -0,0 +1,286 @@
+"""Исходящие сообщения Telegram: общий клиент бота и очередь отправки.
+
+Раньше на каждое уведомление создавался новый telegram.Bot (новый
+HTTP-клиент и соединение), а сообщение отправлялось прямо в обработчике
+запроса. Теперь в процессе один клиент (get_bot) с пулом соединений, а
+уведомления ставятся в очередь (outbox.notify) и отправляются фоновой
+задачей с учетом ограничений Telegram:
+
+- в один чат - не чаще одного сообщения в OUTBOX_CHAT_INTERVAL секунд;
+- всего - не больше OUTBOX_GLOBAL_RATE сообщений в секунду.
+
+Уведомления, накопившиеся для чата за OUTBOX_COALESCE_DELAY секунд (или
+пока чат ждет своей очереди), объединяются в одно сообщение: вместо
+двенадцати "Заметка обновлена" - "Обновлено заметок: 12". При ответе
+429 (RetryAfter) чат ждет указанное Telegram время, уведомления остаются
+в очереди.
+
+TELEGRAM_API_URL позволяет направить запросы на локальный сервер,
+имитирующий Bot API (например, для тестов).
+"""
+import asyncio
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from telegram import Bot
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# Размер пула HTTP-соединений общего клиента
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "8"))
+# Минимальный интервал между сообщениями в один чат (секунды)
+OUTBOX_CHAT_INTERVAL = float(os.environ.get("OUTBOX_CHAT_INTERVAL", "1.0"))
+# Сообщений в секунду для всех чатов вместе
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "30"))
+# Сколько ждать продолжения серии уведомлений перед отправкой (секунды)
+OUTBOX_COALESCE_DELAY = float(os.environ.get("OUTBOX_COALESCE_DELAY", "1.0"))
+# Попыток отправки при сетевых ошибках
+OUTBOX_MAX_ATTEMPTS = 3
+
+MAX_MESSAGE_LENGTH = 4096
+
+# Тексты для нескольких однотипных уведомлений
+SUMMARY_TEMPLATES = {
+    "note_created": "✅ Создано заметок: {count}",
+    "note_updated": "✅ Обновлено заметок: {count}",
+    "note_deleted": "🗑️ Удалено заметок: {count}",
+    "note_captured": "📥 Сохранено во \"Входящие\" заметок: {count}",
+}
+# Сколько названий перечислять в объединенном сообщении
+SUMMARY_NAMES = 3
+
+_bot = None
+_request = None
+_bot_lock = threading.Lock()
+
+
+def get_bot(token=None) -> Bot:
+    """Общий для процесса клиент Bot API"""
+    global _bot, _request
+    with _bot_lock:
+        if _bot is None:
+            token = token or os.environ.get("TELEGRAM_BOT_TOKEN")
+            if not token:
+                raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
+            _request = HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+            _bot = Bot(token=token, base_url=TELEGRAM_API_URL, request=_request)
+        return _bot
+
+
+async def ensure_bot() -> Bot:
+    """Общий клиент, готовый к запросам (после Application.shutdown соединения открываются заново)"""
+    bot = get_bot()
+    await _request.initialize()
+    return bot
+
+
+async def close_bot():
+    global _bot, _request
+    if _request is not None:
+        await _request.shutdown()
+    _bot = _request = None
+
+
+@dataclass
+class Notification:
+    kind: str
+    text: str
+    name: Optional[str] = None
+
+
+@dataclass
+class _ChatState:
+    items: List[Notification] = field(default_factory=list)
+    first_at: float = 0.0
+    next_allowed: float = 0.0
+    in_flight: bool = False
+
+
+def compose_message(items):
+    """Текст одного сообщения из накопленных уведомлений чата"""
+    groups = {}
+    for item in items:
+        groups.setdefault(item.kind, []).append(item)
+    lines = []
+    for kind, group in groups.items():
+        if len(group) == 1 or kind not in SUMMARY_TEMPLATES:
+            # Без шаблона сводки - тексты по одному на строку, без повторов
+            lines.extend(dict.fromkeys(item.text for item in group))
+            continue
+        line = SUMMARY_TEMPLATES[kind].format(count=len(group))
+        names = [item.name for item in group if item.name]
+        if names:
+            shown = ", ".join(f"'{name}'" for name in names[:SUMMARY_NAMES])
+            rest = len(names) - SUMMARY_NAMES
+            line += f" ({shown}" + (f" и еще {rest})" if rest > 0 else ")")
+        lines.append(line)
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+    return text
+
+
+class TelegramOutbox:
+    """Очередь исходящих уведомлений; работает в цикле событий, где вызван первый notify()"""
+
+    def __init__(self, chat_interval=OUTBOX_CHAT_INTERVAL, global_rate=OUTBOX_GLOBAL_RATE,
+                 coalesce_delay=OUTBOX_COALESCE_DELAY, concurrency=TELEGRAM_POOL_SIZE):
+        self.chat_interval = chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.coalesce_delay = coalesce_delay
+        self.concurrency = concurrency
+        self._chats = {}
+        self._loop = None
+        self._worker = None
+        self._wakeup = None
+        self._slots = None
+        self._tasks = set()
+        self._next_global = 0.0
+        self._draining = False
+
+    def notify(self, chat_id, kind, text, name=None):
+        """Ставит уведомление в очередь; можно вызывать из любого потока после старта"""
+        notification = Notification(kind, text, name)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and running is self._loop:
+            self._enqueue(chat_id, notification)
+        elif running is not None and self._loop is None:
+            self.start()
+            self._enqueue(chat_id, notification)
+        elif self._loop is not None:
+            self._loop.call_soon_threadsafe(self._enqueue, chat_id, notification)
+        else:
+            raise RuntimeError("Outbox is not started")
+
+    def _enqueue(self, chat_id, notification):
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+        if not state.items:
+            state.first_at = self._loop.time()
+        state.items.append(notification)
+        self._wakeup.set()
+
+    def pending_count(self):
+        return sum(len(state.items) for state in self._chats.values())
+
+    def start(self):
+        """Запускает отправку в текущем цикле событий"""
+        if self._worker is not None and not self._worker.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._draining = False
+        self._worker = self._loop.create_task(self._run())
+
+    async def stop(self, timeout=5.0):
+        """Отправляет накопленное (не дольше timeout секунд) и останавливает очередь"""
+        if self._worker is None:
+            return
+        self._draining = True
+        self._wakeup.set()
+        deadline = self._loop.time() + timeout
+        while (self.pending_count() or self._tasks) and self._loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        self._worker.cancel()
+        for task in list(self._tasks) + [self._worker]:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self.pending_count():
+            logger.warning(f"Outbox stopped with {self.pending_count()} undelivered notification(s)")
+        self._worker = None
+        self._loop = None
+
+    def _next_ready(self, now):
+        """Чат, которому пора отправлять, или (None, сколько ждать)"""
+        ready, ready_due, wait = None, None, None
+        for chat_id, state in list(self._chats.items()):
+            if state.in_flight:
+                continue
+            if not state.items:
+                if state.next_allowed <= now:
+                    del self._chats[chat_id]
+                continue
+            coalesce = 0.0 if self._draining else self.coalesce_delay
+            due = max(state.first_at + coalesce, state.next_allowed)
+            if due <= now:
+                if ready_due is None or due < ready_due:
+                    ready, ready_due = chat_id, due
+            elif wait is None or due - now < wait:
+                wait = due - now
+        return ready, wait
+
+    async def _run(self):
+        while True:
+            chat_id, wait = self._next_ready(self._loop.time())
+            if chat_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            # Общий лимит: сообщения уходят не чаще global_interval
+            delay = self._next_global - self._loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_global = max(self._loop.time(), self._next_global) + self.global_interval
+
+            state = self._chats[chat_id]
+            # Пока ждали, в чат могли добавиться уведомления - они уйдут в том же сообщении
+            items, state.items = state.items, []
+            state.in_flight = True
+            task = self._loop.create_task(self._deliver(chat_id, state, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, chat_id, state, items):
+        try:
+            text = compose_message(items)
+            for attempt in range(1, OUTBOX_MAX_ATTEMPTS + 1):
+                try:
+                    bot = await ensure_bot()
+                    await bot.send_message(chat_id=chat_id, text=text)
+                    state.next_allowed = self._loop.time() + self.chat_interval
+                    return
+                except RetryAfter as e:
+                    # Telegram просит подождать: уведомления возвращаются в начало очереди чата
+                    logger.warning(f"Telegram flood limit for chat {chat_id}, retry in {e.retry_after}s")
+                    if not state.items:
+                        state.first_at = self._loop.time()
+                    state.items = items + state.items
+                    state.next_allowed = self._loop.time() + e.retry_after
+                    return
+                except (Forbidden, BadRequest) as e:
+                    # Пользователь заблокировал бота или чат недоступен: повтор не поможет
+                    logger.warning(f"Dropping notification for chat {chat_id}: {e}")
+                    return
+                except NetworkError as e:
+                    if attempt == OUTBOX_MAX_ATTEMPTS:
+                        logger.error(f"Failed to send notification to chat {chat_id}: {e}")
+                        return
+                    await asyncio.sleep(attempt)
+        except Exception as e:
+            logger.error(f"Failed to send notification to chat {chat_id}: {e}")
+        finally:
+            state.in_flight = False
+            self._slots.release()
+            self._wakeup.set()
+
+
+# Общая очередь процесса
+outbox = TelegramOutbox()
@@ -0,0 +1,85 @@
+"""Дробные строковые ключи порядка (в духе LexoRank) для сортировки папок.
+
+Ключ - строка из цифр base62, сравниваемая побайтно (как BINARY-сравнение
+в SQLite). Между любыми двумя ключами всегда можно вставить третий, поэтому
+перестановка элемента меняет ровно одну строку. Ключи не заканчиваются на
+наименьшую цифру "0", чтобы перед любым ключом оставалось место.
+"""
+import math
+from typing import List, Optional
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = len(DIGITS)
+
+# Длина ключа, после которой стоит перенумеровать соседей
+MAX_KEY_LENGTH = 16
+
+
+def _midpoint(a: str, b: Optional[str]) -> str:
+    """Ключ строго между a и b (b=None - без верхней границы)"""
+    if b is not None:
+        # Общий префикс (a дополняется нулями) переносим в результат как есть
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else BASE
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    # Соседние цифры: берем цифру a и ищем середину в следующем разряде
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def key_between(a: Optional[str], b: Optional[str]) -> str:
+    """Ключ между a и b; None означает начало или конец списка"""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"Order key {a!r} must be less than {b!r}")
+    if a is not None and b is None:
+        return key_after(a)
+    return _midpoint(a or "", b)
+
+
+def key_after(a: Optional[str]) -> str:
+    """Ключ в конце списка: по возможности увеличивает последний разряд, не удлиняя ключ"""
+    if not a:
+        return _midpoint("", None)
+    stripped = a.rstrip(DIGITS[-1])
+    if not stripped:
+        return _midpoint(a, None)
+    return stripped[:-1] + DIGITS[DIGITS.index(stripped[-1]) + 1]
+
+
+def evenly_spaced_keys(count: int) -> List[str]:
+    """Равномерно распределенные короткие ключи для перенумерации count элементов"""
+    if count <= 0:
+        return []
+    length = max(1, math.ceil(math.log(count + 1, BASE)) + 1)
+    space = BASE ** length
+    keys = []
+    for i in range(1, count + 1):
+        value = i * space // (count + 1)
+        digits = []
+        for _ in range(length):
+            value, digit = divmod(value, BASE)
+            digits.append(DIGITS[digit])
+        keys.append(''.join(reversed(digits)).rstrip(DIGITS[0]))
+    return keys
+
+
+def rebalance_folder_keys(cursor, parent_id):
+    """Перенумеровывает ключи всех дочерних папок parent_id, сохраняя порядок; возвращает их id"""
+    cursor.execute(
+        "SELECT id FROM folders WHERE parent_id IS ? ORDER BY order_key, id",
+        (parent_id,)
+    )
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.executemany(
+        "UPDATE folders SET order_key = ? WHERE id = ?",
+        list(zip(evenly_spaced_keys(len(ids)), ids))
+    )
+    return ids
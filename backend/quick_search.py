@@ -0,0 +1,195 @@
+"""Быстрый поиск заметок для бота: inline-режим, /notes и "найти ...".
+
+Telegram ждет ответ на inline-запрос недолго, поэтому поиск не читает
+файлы содержимого: он идет по денормализованным полям files (название,
+превью, теги) в БД пользователя. На запрос отводится
+QUICK_SEARCH_BUDGET секунд; запрос к SQLite, не уложившийся в бюджет,
+прерывается (Connection.interrupt), и ответ собирается из того, что уже
+есть в кэше.
+
+Кэш последних заметок (HOT_CACHE_SIZE на пользователя) держится в памяти:
+пустой запрос и /notes отвечаются из него без обращения к БД, а если у
+пользователя заметок не больше размера кэша, то и поиск. Запись кэша
+действительна, пока не изменилась версия данных пользователя
+(backend.events.user_events) и не истек HOT_CACHE_TTL - версия не видна
+процессу, который не получает события изменений.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+from backend.database import get_db_connection, user_db_exists
+from backend.events import user_events
+
+logger = logging.getLogger(__name__)
+
+# Бюджет времени на один поиск (секунды)
+QUICK_SEARCH_BUDGET = float(os.environ.get("QUICK_SEARCH_BUDGET", "0.4"))
+# Сколько последних заметок пользователя держать в кэше и для скольких пользователей
+HOT_CACHE_SIZE = int(os.environ.get("HOT_CACHE_SIZE", "200"))
+HOT_CACHE_USERS = int(os.environ.get("HOT_CACHE_USERS", "256"))
+HOT_CACHE_TTL = float(os.environ.get("HOT_CACHE_TTL", "30"))
+# Длина фрагмента текста вокруг совпадения
+SNIPPET_LENGTH = 100
+
+_NOTE_COLUMNS = """
+    files.id, files.name, files.preview, files.updated_at,
+    (SELECT group_concat(unique_tags.tag, ' ')
+     FROM file_tags JOIN unique_tags ON file_tags.tag_id = unique_tags.id
+     WHERE file_tags.file_id = files.id)
+"""
+
+
+def _note_dict(row):
+    return {"id": row[0], "name": row[1], "preview": row[2] or "", "updated_at": row[3], "tags": row[4] or ""}
+
+
+def _contains(text, query):
+    """Поиск подстроки без учета регистра (LIKE в SQLite не понимает кириллицу)"""
+    return text is not None and query in text.casefold()
+
+
+def _matches(note, query):
+    return _contains(note["name"], query) or _contains(note["preview"], query) or _contains(note["tags"], query)
+
+
+def make_snippet(note, query=None, length=SNIPPET_LENGTH):
+    """Фрагмент превью вокруг первого совпадения (или начало превью)"""
+    text = note["preview"]
+    if not text:
+        return ""
+    start = text.casefold().find(query) if query else -1
+    if start <= 0 or len(text) <= length:
+        return text[:length] + ("…" if len(text) > length else "")
+    start = max(start - length // 3, 0)
+    snippet = text[start:start + length]
+    return ("…" if start else "") + snippet + ("…" if start + length < len(text) else "")
+
+
+class HotNotesCache:
+    """LRU-кэш последних заметок по пользователям"""
+
+    def __init__(self, size=HOT_CACHE_SIZE, max_users=HOT_CACHE_USERS, ttl=HOT_CACHE_TTL):
+        self.size = size
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """(заметки, полный ли список) или None, если записи нет или она устарела"""
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            version, loaded_at, notes, complete = entry
+            if version != user_events.data_version(user_id) or time.monotonic() - loaded_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return notes, complete
+
+    def load(self, user_id):
+        """Читает последние заметки пользователя из БД и кладет их в кэш"""
+        user_id = str(user_id)
+        # Версию берем до чтения: изменение во время чтения сделает запись устаревшей
+        version = user_events.data_version(user_id)
+        notes = []
+        if user_db_exists(user_id):
+            conn = get_db_connection(user_id)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"SELECT {_NOTE_COLUMNS} FROM files ORDER BY files.updated_at DESC LIMIT ?",
+                    (self.size + 1,)
+                )
+                notes = [_note_dict(row) for row in cursor.fetchall()]
+            finally:
+                conn.close()
+        complete = len(notes) <= self.size
+        notes = notes[:self.size]
+        with self._lock:
+            self._entries[user_id] = (version, time.monotonic(), notes, complete)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return notes, complete
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+
+
+hot_notes = HotNotesCache()
+
+
+def _search_db(user_id, query, limit, exclude, budget):
+    """Совпадения по всем заметкам пользователя; прерывается по истечении budget секунд"""
+    conn = get_db_connection(user_id)
+    timer = threading.Timer(budget, conn.interrupt)
+    try:
+        conn.create_function("contains_ci", 2, _contains, deterministic=True)
+        cursor = conn.cursor()
+        timer.start()
+        cursor.execute(f"""
+            SELECT {_NOTE_COLUMNS} FROM files
+            WHERE contains_ci(files.name, ?) OR contains_ci(files.preview, ?)
+               OR files.id IN (
+                   SELECT file_tags.file_id FROM file_tags
+                   JOIN unique_tags ON file_tags.tag_id = unique_tags.id
+                   WHERE contains_ci(unique_tags.tag, ?)
+               )
+            ORDER BY contains_ci(files.name, ?) DESC, files.updated_at DESC
+            LIMIT ?
+        """, (query, query, query, query, limit + len(exclude)))
+        return [note for note in map(_note_dict, cursor.fetchall()) if note["id"] not in exclude]
+    finally:
+        timer.cancel()
+        conn.close()
+
+
+async def recent_notes(user_id, limit=20):
+    """Последние измененные заметки пользователя (из кэша, если он актуален)"""
+    cached = hot_notes.get(user_id)
+    if cached is None:
+        cached = await run_in_threadpool(hot_notes.load, user_id)
+    notes, _ = cached
+    return [dict(note, snippet=make_snippet(note)) for note in notes[:limit]]
+
+
+async def find_notes(user_id, query, limit=20, budget=QUICK_SEARCH_BUDGET):
+    """Заметки, у которых запрос есть в названии, превью или тегах; сначала совпадения по названию.
+
+    Укладывается в budget: если поиск по БД не успел, возвращается то,
+    что нашлось в кэше последних заметок.
+    """
+    query = query.strip().lstrip("#").casefold()
+    if not query:
+        return await recent_notes(user_id, limit)
+
+    started = time.monotonic()
+    cached = hot_notes.get(user_id)
+    if cached is None:
+        cached = await run_in_threadpool(hot_notes.load, user_id)
+    notes, complete = cached
+    found = [note for note in notes if _matches(note, query)]
+    found.sort(key=lambda note: not _contains(note["name"], query))
+
+    remaining = budget - (time.monotonic() - started)
+    if not complete and len(found) < limit and remaining > 0:
+        try:
+            found += await asyncio.wait_for(
+                run_in_threadpool(_search_db, str(user_id), query, limit - len(found),
+                                  {note["id"] for note in found}, remaining),
+                timeout=remaining + 0.05
+            )
+        except Exception as e:
+            # sqlite3.OperationalError("interrupted") или таймаут: отвечаем тем, что есть
+            logger.info(f"Quick search for user {user_id} cut short: {e}")
+    return [dict(note, snippet=make_snippet(note, query)) for note in found[:limit]]
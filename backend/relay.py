@@ -0,0 +1,166 @@
+"""Передача событий между процессами сервера через общую БД SQLite.
+
+Хаб событий (backend.events) живет в памяти процесса, а при нескольких
+процессах клиент может быть подписан в одном, а изменение сделано в
+другом. Когда включен EVENT_RELAY, публикация - это вставка строки в
+relay_events (отдельный файл events.db), а каждый процесс читает новые
+строки фоновым потоком и раздает их своим подписчикам. Свои события поток
+читает сразу после вставки, чужие - не позже чем через RELAY_POLL_INTERVAL.
+
+Все процессы получают события в одном порядке - по id строки, поэтому id
+служит общим номером события (Last-Event-ID), а таблица - буфером для
+досылки после переподключения. Строки старше RELAY_RETENTION удаляются.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+RELAY_DB_PATH = os.path.join(os.environ.get("DATA_DIR", "data"), "events.db")
+# Как часто проверять события других процессов (секунды)
+RELAY_POLL_INTERVAL = float(os.environ.get("RELAY_POLL_INTERVAL", "0.1"))
+# Сколько секунд события хранятся для досылки
+RELAY_RETENTION = float(os.environ.get("RELAY_RETENTION", "600"))
+# Сколько событий читается за один проход
+RELAY_BATCH_SIZE = 500
+
+
+def _encode_channel(channel):
+    return json.dumps(list(channel), ensure_ascii=False)
+
+
+def _decode_channel(value):
+    return tuple(json.loads(value))
+
+
+class EventRelay:
+    def __init__(self, path=RELAY_DB_PATH, poll_interval=RELAY_POLL_INTERVAL, retention=RELAY_RETENTION):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.epoch = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._last_id = 0
+        self._last_prune = 0.0
+
+    def open(self):
+        """Открывает БД событий; новые события читаются начиная с текущего конца таблицы"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # События не переживают перезапуск всех процессов, fsync на каждую вставку не нужен
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS relay_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_relay_events_channel ON relay_events (channel, id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS relay_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Эпоха общая для всех процессов: меняется, только если файл событий создан заново
+        conn.execute("INSERT OR IGNORE INTO relay_meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+        self.epoch = conn.execute("SELECT value FROM relay_meta WHERE key = 'epoch'").fetchone()[0]
+        self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM relay_events").fetchone()[0]
+        self._conn = conn
+
+    def append(self, channel, event):
+        """Публикует событие для всех процессов; возвращает его номер. Можно вызывать из любого потока"""
+        payload = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO relay_events (channel, payload, created_at) VALUES (?, ?, ?)",
+                (_encode_channel(channel), payload, time.time())
+            )
+            number = cursor.lastrowid
+        # Свое событие раздаем сразу, не дожидаясь интервала опроса
+        self._wakeup.set()
+        return number
+
+    def since(self, channel, after):
+        """События канала с номером больше after или None, если часть из них уже удалена"""
+        with self._lock:
+            pruned = self._conn.execute("SELECT value FROM relay_meta WHERE key = 'pruned_through'").fetchone()
+            last = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM relay_events").fetchone()[0]
+            if after > max(last, int(pruned[0]) if pruned else 0) or (pruned and after < int(pruned[0])):
+                return None
+            rows = self._conn.execute(
+                "SELECT id, payload FROM relay_events WHERE channel = ? AND id > ? ORDER BY id",
+                (_encode_channel(channel), after)
+            ).fetchall()
+        return [(number, json.loads(payload)) for number, payload in rows]
+
+    def _read_new(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, channel, payload FROM relay_events WHERE id > ? ORDER BY id LIMIT ?",
+                (self._last_id, RELAY_BATCH_SIZE)
+            ).fetchall()
+        if rows:
+            self._last_id = rows[-1][0]
+        return rows
+
+    def _prune(self):
+        """Удаляет устаревшие события; номер последнего удаленного запоминается для since()"""
+        self._last_prune = time.monotonic()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT MAX(id) FROM relay_events WHERE created_at < ?", (time.time() - self.retention,)
+                ).fetchone()
+                if row[0] is not None:
+                    self._conn.execute("DELETE FROM relay_events WHERE id <= ?", (row[0],))
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO relay_meta (key, value) VALUES ('pruned_through', ?)", (str(row[0]),)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _run(self, deliver):
+        while not self._stopping:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                rows = self._read_new()
+                while rows:
+                    for number, channel, payload in rows:
+                        deliver(_decode_channel(channel), number, json.loads(payload))
+                    rows = self._read_new() if len(rows) == RELAY_BATCH_SIZE else None
+                if time.monotonic() - self._last_prune >= max(self.retention / 10, 1):
+                    self._prune()
+            except Exception as e:
+                logger.error(f"Event relay poll failed: {e}")
+
+    def start(self, deliver):
+        """Запускает поток, вызывающий deliver(channel, number, event) для каждого нового события"""
+        if self._conn is None:
+            self.open()
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, args=(deliver,), name="event-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,106 @@
+"""История версий заметок в виде сжатых построчных дельт.
+
+Каждая ревизия хранится в note_revisions пользовательской БД либо как
+снимок (полный текст, zlib), либо как дельта к предыдущей ревизии:
+список операций [i1, i2] ("взять строки i1..i2 прежней версии") и строк
+вставленного текста, сериализованный в JSON и сжатый zlib. Размер дельты
+пропорционален изменению, а не размеру заметки. Снимок пишется каждые
+REVISION_SNAPSHOT_INTERVAL ревизий (или когда дельта не меньше снимка),
+поэтому восстановление любой версии применяет ограниченное число дельт.
+
+Ревизии записываются, когда содержимое попадает в файл (создание заметки
+и сброс журнала отложенной записи), поэтому серия быстрых автосохранений
+дает одну ревизию.
+"""
+import json
+import os
+import zlib
+from datetime import datetime
+from difflib import SequenceMatcher
+
+from backend.storage import content_hash_of
+
+# Раз в сколько ревизий записывается полный снимок
+REVISION_SNAPSHOT_INTERVAL = int(os.environ.get("REVISION_SNAPSHOT_INTERVAL", "20"))
+
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+
+def make_delta(old, new):
+    """Сжатая построчная дельта, превращающая old в new"""
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode("utf-8"))
+
+
+def apply_delta(old, data):
+    a = old.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(zlib.decompress(data)):
+        parts.append("".join(a[op[0]:op[1]]) if isinstance(op, list) else op)
+    return "".join(parts)
+
+
+def get_revision_content(cursor, note_id, rev):
+    """Текст ревизии: ближайший снимок не позже rev и дельты после него; None, если ревизии нет"""
+    cursor.execute("""
+        SELECT rev FROM note_revisions
+        WHERE file_id = ? AND rev <= ? AND kind = ?
+        ORDER BY rev DESC LIMIT 1
+    """, (note_id, rev, SNAPSHOT))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute("""
+        SELECT rev, kind, data FROM note_revisions
+        WHERE file_id = ? AND rev BETWEEN ? AND ?
+        ORDER BY rev
+    """, (note_id, row[0], rev))
+    content = None
+    last_rev = None
+    for last_rev, kind, data in cursor.fetchall():
+        content = zlib.decompress(data).decode("utf-8") if kind == SNAPSHOT else apply_delta(content, data)
+    return content if last_rev == rev else None
+
+
+def record_revision(cursor, note_id, content, content_hash=None):
+    """Записывает новую ревизию (в транзакции вызывающего кода); возвращает ее номер или None без изменений"""
+    content_hash = content_hash or content_hash_of(content)
+    cursor.execute("""
+        SELECT rev, content_hash FROM note_revisions
+        WHERE file_id = ? ORDER BY rev DESC LIMIT 1
+    """, (note_id,))
+    last = cursor.fetchone()
+    if last and last[1] == content_hash:
+        return None
+
+    rev = last[0] + 1 if last else 1
+    kind, data = SNAPSHOT, zlib.compress(content.encode("utf-8"))
+    if last:
+        cursor.execute("""
+            SELECT MAX(rev) FROM note_revisions WHERE file_id = ? AND kind = ?
+        """, (note_id, SNAPSHOT))
+        last_snapshot = cursor.fetchone()[0] or 0
+        previous = get_revision_content(cursor, note_id, last[0])
+        if previous is not None and rev - last_snapshot < REVISION_SNAPSHOT_INTERVAL:
+            delta = make_delta(previous, content)
+            if len(delta) < len(data):
+                kind, data = DELTA, delta
+
+    cursor.execute("""
+        INSERT INTO note_revisions (file_id, rev, kind, data, content_hash, size_bytes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (note_id, rev, kind, data, content_hash, len(content.encode("utf-8")), datetime.now().isoformat()))
+    return rev
+
+
+def drop_revisions(cursor, note_ids):
+    """Удаляет историю удаляемых заметок"""
+    cursor.executemany("DELETE FROM note_revisions WHERE file_id = ?", [(i,) for i in note_ids])
@@ -0,0 +1,341 @@
+from fastapi import APIRouter, HTTPException, Depends, Request
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Optional
+from urllib.parse import quote
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from multipart.multipart import MultipartParser, parse_options_header
+
+from backend.database import get_db_connection
+from backend.auth import get_current_user, get_user_id
+from backend.storage import (
+    get_attachment_path, get_user_attachments_dir, open_temp_file, finish_temp_file, install_temp_file,
+    collect_attachment_garbage
+)
+from backend.streaming import file_response
+from backend.thumbnails import schedule_thumbnail, thumbnail_path
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/notes", tags=["attachments"])
+
+# Максимальный размер одного вложения
+ATTACHMENT_MAX_BYTES = int(os.environ.get("ATTACHMENT_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Содержимое адресуется хешем и не меняется, поэтому браузер может кэшировать его навсегда
+IMMUTABLE_CACHE = "private, max-age=31536000, immutable"
+
+# Тип содержимого задает клиент при загрузке, поэтому открываются в браузере
+# (inline) только типы, которые не исполняют скриптов; HTML, SVG и все
+# остальное отдается на скачивание
+INLINE_CONTENT_TYPES = {
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif", "image/bmp",
+    "application/pdf",
+}
+
+
+class _UploadSink:
+    """Принимает тело запроса кусками: пишет во временный файл и сразу считает sha256"""
+
+    def __init__(self, temp_file, max_bytes):
+        self.file = temp_file
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._buffered = []
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Attachment is too large")
+        self.digest.update(data)
+        self._buffered.append(data)
+
+    async def drain(self):
+        """Запись файла выполняется в пуле потоков, чтобы не блокировать цикл событий"""
+        if self._buffered:
+            data, self._buffered = b"".join(self._buffered), []
+            await run_in_threadpool(self.file.write, data)
+
+
+class _MultipartFile:
+    """Потоковый разбор multipart/form-data: сохраняется первая часть с именем файла"""
+
+    def __init__(self, boundary, sink):
+        self.sink = sink
+        self.filename = None
+        self.content_type = None
+        self._in_file = False
+        self._done = False
+        self._header_name = b""
+        self._header_value = b""
+        self._headers = {}
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if not self._done and b"filename" in options:
+            self._in_file = True
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self.content_type = self._headers.get(b"content-type", b"").decode("latin-1") or None
+
+    def _on_part_data(self, data, start, end):
+        if self._in_file:
+            self.sink.feed(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._done = True
+
+
+def _attachment_dict(row):
+    return {
+        "id": row[0],
+        "note_id": row[1],
+        "name": row[2],
+        "content_type": row[3],
+        "size_bytes": row[4],
+        "content_hash": row[5],
+        "created_at": row[6]
+    }
+
+
+ATTACHMENT_COLUMNS = "id, file_id, name, content_type, size_bytes, content_hash, created_at"
+
+
+def _insert_attachment(user_id, attachment, temp_path, blob_path):
+    """Вставляет запись вложения и при необходимости кладет содержимое на место.
+
+    Проверка наличия содержимого и вставка - под одной блокировкой записи:
+    удаление последней ссылки на тот же хеш (collect_attachment_garbage)
+    убирает файл под той же блокировкой, поэтому запись без файла не появится.
+    """
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(f"INSERT INTO attachments ({ATTACHMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", attachment)
+        if not os.path.exists(blob_path):
+            install_temp_file(temp_path, blob_path)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+@router.post("/{note_id}/attachments")
+async def upload_attachment(
+    note_id: str,
+    request: Request,
+    filename: Optional[str] = None,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Загрузка вложения.
+
+    Принимает multipart/form-data (первая часть с файлом) или тело запроса
+    как есть (имя - в параметре filename). Тело пишется на диск кусками по
+    мере получения, без буферизации целиком; одинаковые файлы хранятся один раз.
+    """
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("SELECT 1 FROM files WHERE id = ?", (note_id,))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
+    finally:
+        conn.close()
+
+    media_type, options = parse_options_header(request.headers.get("content-type", ""))
+    staging_path = os.path.join(get_user_attachments_dir(user_id), "upload")
+    temp_path, temp_file = open_temp_file(staging_path)
+    sink = _UploadSink(temp_file, ATTACHMENT_MAX_BYTES)
+
+    try:
+        if media_type == b"multipart/form-data":
+            if b"boundary" not in options:
+                raise HTTPException(status_code=400, detail="Missing multipart boundary")
+            form = _MultipartFile(options[b"boundary"], sink)
+            async for chunk in request.stream():
+                form.parser.write(chunk)
+                await sink.drain()
+            form.parser.finalize()
+            if form.filename is None:
+                raise HTTPException(status_code=400, detail="No file in upload")
+            name, content_type = form.filename, form.content_type
+        else:
+            async for chunk in request.stream():
+                sink.feed(chunk)
+                await sink.drain()
+            name = filename or request.headers.get("x-filename") or "attachment"
+            content_type = media_type.decode("latin-1") or None
+        await sink.drain()
+
+        content_hash = sink.digest.hexdigest()
+        blob_path = get_attachment_path(user_id, content_hash)
+        await run_in_threadpool(finish_temp_file, temp_file)
+
+        attachment = (
+            str(uuid.uuid4()), note_id, os.path.basename(name), content_type,
+            sink.size, content_hash, datetime.now().isoformat()
+        )
+        try:
+            await run_in_threadpool(_insert_attachment, user_id, attachment, temp_path, blob_path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        temp_file.close()
+        # Если такое содержимое уже было, временный файл не нужен: второй раз не храним
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # Миниатюра создается в пуле процессов, ответ ее не ждет
+    schedule_thumbnail(blob_path, content_type)
+
+    return _attachment_dict(attachment)
+
+
+@router.get("/{note_id}/attachments")
+async def list_attachments(note_id: str, current_user: Dict = Depends(get_current_user)):
+    """Вложения заметки в порядке загрузки"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(
+            f"SELECT {ATTACHMENT_COLUMNS} FROM attachments WHERE file_id = ? ORDER BY created_at, id",
+            (note_id,)
+        )
+        return [_attachment_dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def _get_attachment(user_id, note_id, attachment_id):
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {ATTACHMENT_COLUMNS} FROM attachments WHERE id = ? AND file_id = ?",
+            (attachment_id, note_id)
+        )
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return _attachment_dict(row)
+
+
+@router.get("/{note_id}/attachments/{attachment_id}")
+async def get_attachment(
+    note_id: str,
+    attachment_id: str,
+    request: Request,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Содержимое вложения (поддерживает Range, кэшируется навсегда)"""
+    user_id = get_user_id(current_user)
+    attachment = _get_attachment(user_id, note_id, attachment_id)
+    content_type = (attachment["content_type"] or "").split(";")[0].strip().lower()
+    disposition = "inline" if content_type in INLINE_CONTENT_TYPES else "attachment"
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE,
+        "Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(attachment['name'])}",
+        # Браузер не должен угадывать тип по содержимому (например, HTML в "картинке")
+        "X-Content-Type-Options": "nosniff"
+    }
+    try:
+        return file_response(
+            request, get_attachment_path(user_id, attachment["content_hash"]),
+            attachment["content_type"] or "application/octet-stream",
+            etag=attachment["content_hash"], headers=headers
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Attachment file not found")
+
+
+@router.get("/{note_id}/attachments/{attachment_id}/thumbnail")
+async def get_attachment_thumbnail(
+    note_id: str,
+    attachment_id: str,
+    request: Request,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Миниатюра изображения; 404, пока она не готова (или если это не изображение)"""
+    user_id = get_user_id(current_user)
+    attachment = _get_attachment(user_id, note_id, attachment_id)
+    path = thumbnail_path(get_attachment_path(user_id, attachment["content_hash"]))
+    try:
+        return file_response(
+            request, path, "image/jpeg",
+            etag=f"{attachment['content_hash']}-thumb", headers={"Cache-Control": IMMUTABLE_CACHE}
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+
+
+@router.delete("/{note_id}/attachments/{attachment_id}")
+async def delete_attachment(
+    note_id: str,
+    attachment_id: str,
+    current_user: Dict = Depends(get_current_user)
+):
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(
+            "SELECT content_hash FROM attachments WHERE id = ? AND file_id = ?",
+            (attachment_id, note_id)
+        )
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+
+        cursor.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+        conn.commit()
+
+        # Содержимое удаляем после коммита и только если на него больше никто не ссылается
+        collect_attachment_garbage(conn, user_id, [row[0]])
+        return {"status": "deleted"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
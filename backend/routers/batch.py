@@ -0,0 +1,213 @@
+from fastapi import APIRouter, HTTPException, Depends
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List
+import uuid
+from datetime import datetime
+
+from backend.models import BatchOperation, BatchRequest
+from backend.database import get_db_connection
+from backend.auth import get_current_user, get_user_id
+from backend.write_buffer import write_buffer, journal_content, read_note_content, drop_journal
+from backend.revisions import record_revision, drop_revisions
+from backend.events import publish_note_changes, publish_notes_deleted, publish_folder_changes
+from backend.storage import (
+    remove_note_file, update_note_metadata, acquire_blob, write_blobs, release_blob, collect_blob_garbage,
+    drop_note_attachments, collect_attachment_garbage,
+    ensure_tags, find_tag_ids, link_tags, unlink_tags
+)
+
+router = APIRouter(prefix="/api/batch", tags=["batch"])
+
+# Ограничение на количество параметров в одном IN (...) для SQLite
+SQL_IN_CHUNK = 500
+
+
+def _target_ids(op: BatchOperation) -> List[str]:
+    """Список заметок, к которым применяется операция"""
+    ids = list(op.ids)
+    if op.id and op.id not in ids:
+        ids.insert(0, op.id)
+    return ids
+
+
+def _existing_ids(cursor, ids: List[str]) -> set:
+    """Возвращает подмножество ids, для которых есть записи в files"""
+    found = set()
+    for start in range(0, len(ids), SQL_IN_CHUNK):
+        chunk = ids[start:start + SQL_IN_CHUNK]
+        placeholders = ','.join(['?'] * len(chunk))
+        cursor.execute(f"SELECT id FROM files WHERE id IN ({placeholders})", chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+
+def _note_folders(cursor, ids: List[str]) -> set:
+    """Папки, в которых сейчас лежат заметки ids"""
+    found = set()
+    for start in range(0, len(ids), SQL_IN_CHUNK):
+        chunk = ids[start:start + SQL_IN_CHUNK]
+        placeholders = ','.join(['?'] * len(chunk))
+        cursor.execute(f"SELECT DISTINCT folder_id FROM files WHERE id IN ({placeholders})", chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+
+def _require_notes(cursor, index: int, ids: List[str]):
+    existing = _existing_ids(cursor, ids)
+    missing = [note_id for note_id in ids if note_id not in existing]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Operation {index}: notes not found: {', '.join(missing[:10])}"
+        )
+
+
+@router.post("")
+async def apply_batch(batch: BatchRequest, current_user: Dict = Depends(get_current_user)):
+    """Применяет набор операций над заметками в одной транзакции"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+
+    removed_paths = []   # старые файлы <id>.md удаляемых заметок (удаляются после коммита)
+    released_blobs = False
+    removed_attachments = []  # хеши содержимого вложений удаленных заметок
+    removed_ids = []
+    touched_folders = set()  # папки, чей note_count мог поменяться (публикуются после коммита)
+    staged = {}          # версии из журнала, которые после коммита ставятся в буфер
+    results = []
+
+    try:
+        # Содержимое новых заметок пишется заранее, одной группой fsync и вне цикла событий;
+        # acquire_blob внутри транзакции только добавит ссылки
+        await run_in_threadpool(
+            write_blobs, user_id, [op.content or "" for op in batch.operations if op.op == "create"]
+        )
+        for index, op in enumerate(batch.operations):
+            # Форма операций (op, обязательные поля) уже проверена моделью BatchOperation
+            if op.op == "create":
+                note_id = op.id or str(uuid.uuid4())
+                blob_hash, path = acquire_blob(cursor, user_id, op.content or "")
+                cursor.execute("""
+                    INSERT INTO files (id, name, path, blob_hash, date_added, folder_id, parent_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (note_id, op.name, path, blob_hash, datetime.now().isoformat(), op.folder_id, op.parent_id))
+                update_note_metadata(cursor, note_id, op.content or "")
+                record_revision(cursor, note_id, op.content or "", blob_hash)
+                if op.tags:
+                    link_tags(cursor, [note_id], ensure_tags(cursor, op.tags))
+                touched_folders.add(op.folder_id)
+                results.append({"op": op.op, "id": note_id})
+
+            elif op.op == "update":
+                cursor.execute("SELECT path, folder_id FROM files WHERE id = ?", (op.id,))
+                row = cursor.fetchone()
+                if not row:
+                    raise HTTPException(status_code=404, detail=f"Operation {index}: note {op.id} not found")
+                if "folder_id" in op.__fields_set__ and op.folder_id != row[1]:
+                    touched_folders.update((row[1], op.folder_id))
+
+                # Обновляем только переданные поля
+                fields = [f for f in ("name", "folder_id", "parent_id") if f in op.__fields_set__]
+                if fields:
+                    assignments = ', '.join(f"{f} = ?" for f in fields)
+                    cursor.execute(f"UPDATE files SET {assignments} WHERE id = ?",
+                                   [getattr(op, f) for f in fields] + [op.id])
+
+                # Новую версию пишем в журнал, только если содержимое действительно изменилось.
+                # Файлы внутри транзакции не трогаем: версия уходит в буфер записи после коммита,
+                # и откат пачки не оставит на диске содержимое, которого нет в БД
+                content_changed = False
+                if op.content is not None and read_note_content(cursor, op.id, row[0]) != op.content:
+                    journal_content(cursor, op.id, op.content)
+                    update_note_metadata(cursor, op.id, op.content)
+                    staged[op.id] = op.content
+                    content_changed = True
+
+                if op.tags is not None:
+                    cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (op.id,))
+                    link_tags(cursor, [op.id], ensure_tags(cursor, op.tags))
+                results.append({"op": op.op, "id": op.id, "content_changed": content_changed})
+
+            elif op.op == "move":
+                ids = _target_ids(op)
+                _require_notes(cursor, index, ids)
+                fields = [f for f in ("folder_id", "parent_id") if f in op.__fields_set__]
+                if "folder_id" in fields:
+                    touched_folders.update(_note_folders(cursor, ids))
+                    touched_folders.add(op.folder_id)
+                assignments = ', '.join(f"{f} = ?" for f in fields)
+                values = [getattr(op, f) for f in fields]
+                cursor.executemany(f"UPDATE files SET {assignments} WHERE id = ?",
+                                   [values + [note_id] for note_id in ids])
+                results.append({"op": op.op, "ids": ids})
+
+            elif op.op in ("tag", "untag"):
+                ids = _target_ids(op)
+                _require_notes(cursor, index, ids)
+                if op.op == "tag":
+                    link_tags(cursor, ids, ensure_tags(cursor, op.tags))
+                else:
+                    unlink_tags(cursor, ids, find_tag_ids(cursor, [tag.name for tag in op.tags]))
+                results.append({"op": op.op, "ids": ids})
+
+            elif op.op == "delete":
+                ids = _target_ids(op)
+                _require_notes(cursor, index, ids)
+                for start in range(0, len(ids), SQL_IN_CHUNK):
+                    chunk = ids[start:start + SQL_IN_CHUNK]
+                    placeholders = ','.join(['?'] * len(chunk))
+                    cursor.execute(f"SELECT path, blob_hash, folder_id FROM files WHERE id IN ({placeholders})", chunk)
+                    for path, blob_hash, folder_id in cursor.fetchall():
+                        touched_folders.add(folder_id)
+                        if blob_hash:
+                            release_blob(cursor, blob_hash)
+                            released_blobs = True
+                        else:
+                            removed_paths.append(path)
+                cursor.executemany("DELETE FROM file_tags WHERE file_id = ?", [(i,) for i in ids])
+                drop_journal(cursor, ids)
+                drop_revisions(cursor, ids)
+                removed_attachments.extend(drop_note_attachments(cursor, user_id, ids))
+                removed_ids.extend(ids)
+                cursor.executemany("DELETE FROM files WHERE id = ?", [(i,) for i in ids])
+                results.append({"op": op.op, "ids": ids})
+
+        conn.commit()
+
+        changed_ids = []
+        for result in results:
+            if result["op"] != "delete":
+                changed_ids.extend(result.get("ids") or [result["id"]])
+        removed = set(removed_ids)
+        publish_note_changes(user_id, cursor, dict.fromkeys(i for i in changed_ids if i not in removed))
+        publish_folder_changes(user_id, cursor, touched_folders)
+    except Exception as e:
+        # Файлы содержимого созданных заметок могут быть общими с другими заметками,
+        # поэтому их не трогаем: без ссылок их уберет backend.maintenance
+        conn.rollback()
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+    for note_id, content in staged.items():
+        if note_id not in removed_ids:
+            write_buffer.stage(user_id, note_id, content)
+    write_buffer.discard(user_id, removed_ids)
+
+    # Файлы удаленных заметок убираем только после успешного коммита
+    for path in removed_paths:
+        remove_note_file(path)
+    if released_blobs or removed_attachments:
+        conn = get_db_connection(user_id)
+        try:
+            if released_blobs:
+                collect_blob_garbage(conn, user_id)
+            collect_attachment_garbage(conn, user_id, removed_attachments)
+        finally:
+            conn.close()
+    publish_notes_deleted(user_id, removed_ids)
+
+    return {"status": "ok", "count": len(results), "results": results}
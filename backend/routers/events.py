@@ -0,0 +1,62 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+from typing import Dict, Optional
+
+from backend.auth import get_current_user, get_user_id
+from backend.events import event_hub, user_events, format_sse, SSE_HEADERS, SSE_PING
+
+router = APIRouter(prefix="/api/events", tags=["events"])
+
+
+def _event_number(event_id):
+    return int(event_id.partition(":")[2])
+
+
+async def _stream_changes(subscription, backlog, resync):
+    try:
+        yield "retry: 1000\n\n"
+        if resync:
+            # Пропущенные события не восстановить: клиент перечитывает дерево целиком
+            yield format_sse({"type": "resync"}, "resync")
+        last_number = 0
+        for event_id, event in backlog:
+            last_number = _event_number(event_id)
+            yield format_sse(event, event["type"], event_id)
+        async for item in subscription.events():
+            if item is None:
+                yield SSE_PING
+                continue
+            event_id, event = item
+            # Событие могло уже уйти в составе досылки
+            if _event_number(event_id) <= last_number:
+                continue
+            yield format_sse(event, event["type"], event_id)
+    finally:
+        subscription.close()
+
+
+@router.get("")
+async def stream_events(
+    request: Request,
+    last_event_id: Optional[str] = None,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Изменения заметок и папок пользователя в реальном времени (text/event-stream).
+
+    События: note.changed (строки дерева заметок), note.deleted (id),
+    folder.changed (строки дерева папок), folder.deleted (id и родитель, к
+    которому перешло содержимое) и resync - когда нужно перечитать дерево.
+    """
+    user_id = get_user_id(current_user)
+    resume_from = request.headers.get("last-event-id") or last_event_id
+
+    # Подписываемся до чтения буфера, чтобы не потерять события между ними
+    subscription = event_hub.subscribe(user_events.channel(user_id))
+    backlog = user_events.since(user_id, resume_from) if resume_from else []
+    resync = backlog is None
+
+    return StreamingResponse(
+        _stream_changes(subscription, backlog or [], resync),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
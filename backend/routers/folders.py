@@ -1,35 +1,74 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
 from typing import List, Optional
 import uuid
 
-from backend.models import Folder
+from backend.models import Folder, FolderMove
 from backend.database import get_db_connection
 from backend.auth import get_current_user, get_user_id
+from backend.folder_tree import (
+    insert_folder_closure, move_folder_closure, remove_folder_closure, is_descendant
+)
+from backend.ordering import key_between, rebalance_folder_keys, MAX_KEY_LENGTH
+from backend.events import publish_folder_changes, publish_folder_deleted
+from backend.singleflight import coalesced_json
 
 router = APIRouter(prefix="/api/folders", tags=["folders"])
 
+def _folder_dict(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "parent_id": row[2],
+        "color": row[3],
+        "position": row[4],
+        "order_key": row[5]
+    }
+
+def _sibling_key(cursor, parent_id, exclude_id=None):
+    """Ключ последней папки у родителя (поиск по индексу, без MAX по всем строкам)"""
+    cursor.execute("""
+        SELECT order_key FROM folders
+        WHERE parent_id IS ? AND order_key IS NOT NULL AND id IS NOT ?
+        ORDER BY order_key DESC
+        LIMIT 1
+    """, (parent_id, exclude_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _rebalance_in_background(user_id, parent_id):
+    """Перенумеровывает ключи соседей, когда они стали слишком длинными"""
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    try:
+        folder_ids = rebalance_folder_keys(cursor, parent_id)
+        conn.commit()
+        # Без события клиенты сохранят старые ключи и посчитают следующий перенос от них
+        publish_folder_changes(user_id, cursor, folder_ids)
+    finally:
+        conn.close()
+
+def _schedule_rebalance(background_tasks, user_id, parent_id, key):
+    if len(key) > MAX_KEY_LENGTH:
+        background_tasks.add_task(_rebalance_in_background, user_id, parent_id)
+
 @router.get("")
 async def get_folders(current_user: dict = Depends(get_current_user)):
     user_id = get_user_id(current_user)
+    # Одинаковые одновременные запросы ждут одно чтение
+    return await coalesced_json(user_id, "folders", (), _load_folders, user_id)
+
+def _load_folders(user_id):
     conn = get_db_connection(user_id)  # Используем пользовательскую БД
     cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT id, name, parent_id, color, position
+        SELECT id, name, parent_id, color, position, order_key, child_count, note_count
         FROM folders
-        ORDER BY position
+        ORDER BY order_key, id
     """)
     
-    folders = [
-        {
-            "id": row[0],
-            "name": row[1],
-            "parent_id": row[2],
-            "color": row[3],
-            "position": row[4]
-        }
-        for row in cursor.fetchall()
-    ]
+    # Счетчики нужны проводнику, чтобы показать стрелку раскрытия, не загружая уровень
+    folders = [dict(_folder_dict(row), child_count=row[6], note_count=row[7]) for row in cursor.fetchall()]
     
     conn.close()
     
@@ -42,7 +81,7 @@ async def get_folder(folder_id: str, current_user: dict = Depends(get_current_us
     cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT id, name, parent_id, color, position
+        SELECT id, name, parent_id, color, position, order_key
         FROM folders
         WHERE id = ?
     """, (folder_id,))
@@ -53,20 +92,67 @@ async def get_folder(folder_id: str, current_user: dict = Depends(get_current_us
         conn.close()
         raise HTTPException(status_code=404, detail="Folder not found")
     
-    folder = {
-        "id": row[0],
-        "name": row[1],
-        "parent_id": row[2],
-        "color": row[3],
-        "position": row[4]
-    }
+    folder = _folder_dict(row)
     
     conn.close()
     
     return folder
 
+@router.get("/{folder_id}/subtree")
+async def get_folder_subtree(folder_id: str, current_user: dict = Depends(get_current_user)):
+    """Папка и все вложенные папки с глубиной относительно нее"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT folders.id, folders.name, folders.parent_id, folders.color, folders.position,
+                   folders.order_key, folder_closure.depth
+            FROM folder_closure
+            JOIN folders ON folders.id = folder_closure.descendant
+            WHERE folder_closure.ancestor = ?
+            ORDER BY folder_closure.depth, folders.order_key
+        """, (folder_id,))
+        
+        rows = cursor.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        
+        return [dict(_folder_dict(row), depth=row[6]) for row in rows]
+    finally:
+        conn.close()
+
+@router.get("/{folder_id}/breadcrumbs")
+async def get_folder_breadcrumbs(folder_id: str, current_user: dict = Depends(get_current_user)):
+    """Путь от корня до папки (включая ее саму)"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT folders.id, folders.name, folders.color, folder_closure.depth
+            FROM folder_closure
+            JOIN folders ON folders.id = folder_closure.ancestor
+            WHERE folder_closure.descendant = ?
+            ORDER BY folder_closure.depth DESC
+        """, (folder_id,))
+        
+        rows = cursor.fetchall()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        
+        return [{"id": row[0], "name": row[1], "color": row[2]} for row in rows]
+    finally:
+        conn.close()
+
 @router.post("")
-async def create_folder(folder: Folder, current_user: dict = Depends(get_current_user)):
+async def create_folder(
+    folder: Folder,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user)
+):
     user_id = get_user_id(current_user)
     conn = get_db_connection(user_id)  # Используем пользовательскую БД
     cursor = conn.cursor()
@@ -76,26 +162,31 @@ async def create_folder(folder: Folder, current_user: dict = Depends(get_current
         if not folder.id:
             folder.id = str(uuid.uuid4())
         
-        # Получаем максимальную позицию для нового элемента
-        cursor.execute("""
-            SELECT COALESCE(MAX(position), -1) + 1
-            FROM folders
-            WHERE (parent_id IS ? OR (parent_id IS NULL AND ? IS NULL))
-        """, (folder.parent_id, folder.parent_id))
+        if folder.parent_id is not None:
+            cursor.execute("SELECT 1 FROM folders WHERE id = ?", (folder.parent_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=400, detail="Parent folder not found")
         
-        next_position = cursor.fetchone()[0]
-        folder.position = next_position
+        # Новая папка встает в конец списка соседей
+        order_key = key_between(_sibling_key(cursor, folder.parent_id), None)
         
         # Создаем папку
         cursor.execute("""
-            INSERT INTO folders (id, name, parent_id, color, position)
-            VALUES (?, ?, ?, ?, ?)
-        """, (folder.id, folder.name, folder.parent_id, folder.color, folder.position))
+            INSERT INTO folders (id, name, parent_id, color, position, order_key)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (folder.id, folder.name, folder.parent_id, folder.color, folder.position, order_key))
+        insert_folder_closure(cursor, folder.id, folder.parent_id)
         
         conn.commit()
+        _schedule_rebalance(background_tasks, user_id, folder.parent_id, order_key)
+        # У родителя поменялся child_count
+        publish_folder_changes(user_id, cursor, [folder.id, folder.parent_id])
         
-        return {"id": folder.id, "status": "created"}
+        return {"id": folder.id, "status": "created", "order_key": order_key}
     
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -110,13 +201,21 @@ async def update_folder(folder_id: str, folder: Folder, current_user: dict = Dep
     
     try:
         # Проверяем существование папки
-        cursor.execute("SELECT id FROM folders WHERE id = ?", (folder_id,))
+        cursor.execute("SELECT parent_id FROM folders WHERE id = ?", (folder_id,))
         result = cursor.fetchone()
         
         if not result:
-            conn.close()
             raise HTTPException(status_code=404, detail="Folder not found")
         
+        parent_changed = result[0] != folder.parent_id
+        if parent_changed and folder.parent_id is not None:
+            cursor.execute("SELECT 1 FROM folders WHERE id = ?", (folder.parent_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=400, detail="Parent folder not found")
+            # Нельзя переместить папку в саму себя или в свою подпапку
+            if is_descendant(cursor, folder_id, folder.parent_id):
+                raise HTTPException(status_code=400, detail="Cannot move a folder into its own subtree")
+        
         # Обновляем папку
         cursor.execute("""
             UPDATE folders
@@ -124,10 +223,114 @@ async def update_folder(folder_id: str, folder: Folder, current_user: dict = Dep
             WHERE id = ?
         """, (folder.name, folder.parent_id, folder.color, folder.position, folder_id))
         
+        if parent_changed:
+            move_folder_closure(cursor, folder_id, folder.parent_id)
+            # У нового родителя папка встает в конец списка
+            cursor.execute("UPDATE folders SET order_key = ? WHERE id = ?",
+                           (key_between(_sibling_key(cursor, folder.parent_id), None), folder_id))
+        
         conn.commit()
+        # При смене родителя child_count меняется у старого и нового
+        publish_folder_changes(user_id, cursor,
+                               [folder_id, result[0], folder.parent_id] if parent_changed else [folder_id])
         
         return {"id": folder_id, "status": "updated"}
     
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@router.post("/{folder_id}/move")
+async def move_folder(
+    folder_id: str,
+    move: FolderMove,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user)
+):
+    """Перемещает папку между соседями (и при необходимости к другому родителю), меняя одну строку"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT parent_id FROM folders WHERE id = ?", (folder_id,))
+        result = cursor.fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Folder not found")
+        
+        parent_id = move.parent_id if "parent_id" in move.__fields_set__ else result[0]
+        parent_changed = parent_id != result[0]
+        if parent_changed and parent_id is not None:
+            cursor.execute("SELECT 1 FROM folders WHERE id = ?", (parent_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=400, detail="Parent folder not found")
+            if is_descendant(cursor, folder_id, parent_id):
+                raise HTTPException(status_code=400, detail="Cannot move a folder into its own subtree")
+        
+        def sibling_key(sibling_id):
+            if sibling_id is None:
+                return None
+            if sibling_id == folder_id:
+                raise HTTPException(status_code=400, detail="A folder cannot be its own neighbour")
+            cursor.execute("SELECT parent_id, order_key FROM folders WHERE id = ?", (sibling_id,))
+            row = cursor.fetchone()
+            if not row or row[0] != parent_id:
+                raise HTTPException(status_code=400, detail=f"Folder {sibling_id} is not a sibling")
+            return row[1]
+        
+        def neighbour_key(key, after):
+            # Ближайший сосед по индексу (parent_id, order_key), не считая перемещаемую папку
+            cursor.execute(f"""
+                SELECT order_key FROM folders
+                WHERE parent_id IS ? AND id != ? AND order_key {'>' if after else '<'} ?
+                ORDER BY order_key {'ASC' if after else 'DESC'}
+                LIMIT 1
+            """, (parent_id, folder_id, key))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        
+        def bounds():
+            lower = sibling_key(move.after_id)
+            upper = sibling_key(move.before_id)
+            if move.after_id is not None and move.before_id is None:
+                upper = neighbour_key(lower, after=True)
+            elif move.before_id is not None and move.after_id is None:
+                lower = neighbour_key(upper, after=False)
+            elif move.after_id is None and move.before_id is None:
+                # Без соседей - в конец списка
+                lower = _sibling_key(cursor, parent_id, exclude_id=folder_id)
+            return lower, upper
+        
+        rebalanced = []
+        try:
+            order_key = key_between(*bounds())
+        except ValueError:
+            # Совпадающие ключи (например, после одновременных вставок) - перенумеровываем соседей
+            rebalanced = rebalance_folder_keys(cursor, parent_id)
+            order_key = key_between(*bounds())
+        
+        cursor.execute("UPDATE folders SET parent_id = ?, order_key = ? WHERE id = ?",
+                       (parent_id, order_key, folder_id))
+        if parent_changed:
+            move_folder_closure(cursor, folder_id, parent_id)
+        
+        conn.commit()
+        _schedule_rebalance(background_tasks, user_id, parent_id, order_key)
+        changed = [folder_id] + rebalanced
+        if parent_changed:
+            changed += [result[0], parent_id]
+        publish_folder_changes(user_id, cursor, changed)
+        
+        return {"id": folder_id, "status": "moved", "parent_id": parent_id, "order_key": order_key}
+    
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -146,17 +349,19 @@ async def delete_folder(folder_id: str, current_user: dict = Depends(get_current
         result = cursor.fetchone()
         
         if not result:
-            conn.close()
             raise HTTPException(status_code=404, detail="Folder not found")
         
         parent_id = result[0]
         
-        # Перемещаем дочерние папки к родителю удаляемой папки
-        cursor.execute("""
-            UPDATE folders
-            SET parent_id = ?
-            WHERE parent_id = ?
-        """, (parent_id, folder_id))
+        # Перемещаем дочерние папки к родителю удаляемой папки. Старые ключи могут совпасть
+        # с ключами новых соседей, поэтому папки встают в конец списка в прежнем порядке
+        cursor.execute("SELECT id FROM folders WHERE parent_id = ? ORDER BY order_key, id", (folder_id,))
+        moved_ids = [row[0] for row in cursor.fetchall()]
+        order_key = _sibling_key(cursor, parent_id, exclude_id=folder_id)
+        for child_id in moved_ids:
+            order_key = key_between(order_key, None)
+            cursor.execute("UPDATE folders SET parent_id = ?, order_key = ? WHERE id = ?",
+                           (parent_id, order_key, child_id))
         
         # Перемещаем файлы к родителю удаляемой папки
         cursor.execute("""
@@ -165,13 +370,21 @@ async def delete_folder(folder_id: str, current_user: dict = Depends(get_current
             WHERE folder_id = ?
         """, (parent_id, folder_id))
         
-        # Удаляем папку
+        # Удаляем сообщения папки и саму папку
+        cursor.execute("DELETE FROM folder_messages WHERE folder_id = ?", (folder_id,))
         cursor.execute("DELETE FROM folders WHERE id = ?", (folder_id,))
+        remove_folder_closure(cursor, folder_id)
         
         conn.commit()
+        # Клиенты сами переносят содержимое папки к ее родителю
+        publish_folder_deleted(user_id, folder_id, parent_id)
+        # Счетчики родителя пересчитаны триггерами, у перенесенных папок новые ключи
+        publish_folder_changes(user_id, cursor, [parent_id] + moved_ids)
         
         return {"status": "deleted"}
     
+    except HTTPException:
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
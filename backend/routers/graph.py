@@ -4,6 +4,7 @@ from typing import List, Optional
 from backend.models import GraphData
 from backend.database import get_db_connection
 from backend.auth import get_current_user, get_user_id
+from backend.singleflight import coalesced_json
 
 router = APIRouter(prefix="/api/graph", tags=["graph"])
 
@@ -14,6 +15,10 @@ async def get_graph(
     current_user: dict = Depends(get_current_user)
 ):
     user_id = get_user_id(current_user)
+    # Одинаковые одновременные запросы ждут одно построение графа
+    return await coalesced_json(user_id, "graph", (folder_id, tag), _build_graph, user_id, folder_id, tag)
+
+def _build_graph(user_id, folder_id, tag):
     conn = get_db_connection(user_id)  # Используем пользовательскую БД
     cursor = conn.cursor()
     
@@ -27,20 +32,13 @@ async def get_graph(
         params = []
         
         if folder_id:
-            # Получаем все подпапки выбранной папки
-            folder_ids = [folder_id]
-            queue = [folder_id]
-            
-            while queue:
-                current_id = queue.pop(0)
-                cursor.execute("SELECT id FROM folders WHERE parent_id = ?", (current_id,))
-                children = [row[0] for row in cursor.fetchall()]
-                folder_ids.extend(children)
-                queue.extend(children)
-            
-            placeholders = ','.join(['?'] * len(folder_ids))
-            files_query += f" WHERE files.folder_id IN ({placeholders})"
-            params.extend(folder_ids)
+            # Заметки выбранной папки и всех ее подпапок (по таблице замыкания)
+            files_query += """
+                WHERE files.folder_id IN (
+                    SELECT descendant FROM folder_closure WHERE ancestor = ?
+                )
+            """
+            params.append(folder_id)
             
         elif tag:
             files_query = """
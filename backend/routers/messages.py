@@ -0,0 +1,225 @@
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Optional
+from datetime import datetime
+import base64
+import json
+import logging
+
+from backend.models import FolderMessage
+from backend.database import get_db_connection
+from backend.auth import get_current_user, get_user_id
+from backend.events import event_hub, format_sse, SSE_HEADERS, SSE_PING
+
+router = APIRouter(prefix="/api/folders", tags=["messages"])
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Сколько пропущенных сообщений читается из БД за раз при переподключении к потоку
+STREAM_BACKLOG_LIMIT = 500
+
+MESSAGE_COLUMNS = "id, folder_id, content, created_at, author"
+
+
+def _message_dict(row):
+    return {
+        "id": row[0],
+        "folder_id": row[1],
+        "content": row[2],
+        "created_at": row[3],
+        "author": row[4]
+    }
+
+
+def _encode_cursor(message):
+    raw = json.dumps([message["created_at"], message["id"]]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def _decode_cursor(cursor_value):
+    try:
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(cursor_value.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(created_at, str) or not isinstance(message_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, message_id
+
+
+def _messages_channel(user_id, folder_id):
+    return ("folder_messages", str(user_id), folder_id)
+
+
+def _require_folder(cursor, folder_id):
+    cursor.execute("SELECT 1 FROM folders WHERE id = ?", (folder_id,))
+    if not cursor.fetchone():
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+
+@router.post("/{folder_id}/messages")
+async def post_message(
+    folder_id: str,
+    message: FolderMessage,
+    current_user: Dict = Depends(get_current_user)
+):
+    if not message.content.strip():
+        raise HTTPException(status_code=400, detail="Message content cannot be empty")
+
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    cursor = conn.cursor()
+
+    try:
+        _require_folder(cursor, folder_id)
+        author = message.author or current_user.get("username") or current_user.get("first_name")
+        created_at = datetime.now().isoformat()
+        cursor.execute(
+            "INSERT INTO folder_messages (folder_id, content, created_at, author) VALUES (?, ?, ?, ?)",
+            (folder_id, message.content, created_at, author)
+        )
+        conn.commit()
+        result = _message_dict((cursor.lastrowid, folder_id, message.content, created_at, author))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+    # Открытые потоки этой папки получают сообщение сразу; сообщение уже сохранено,
+    # поэтому ошибка публикации (например, занятая БД событий) только логируется
+    try:
+        event_hub.publish(_messages_channel(user_id, folder_id), result)
+    except Exception as e:
+        logger.warning(f"Failed to publish message for user {user_id}: {e}")
+    return result
+
+
+@router.get("/{folder_id}/messages")
+async def get_messages(
+    folder_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Dict = Depends(get_current_user)
+):
+    """Сообщения папки от новых к старым; next_cursor продолжает ленту в прошлое.
+
+    Страница читается по индексу (folder_id, created_at, id), поэтому ее
+    стоимость не зависит от длины истории.
+    """
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    db_cursor = conn.cursor()
+
+    try:
+        _require_folder(db_cursor, folder_id)
+        if cursor is None:
+            db_cursor.execute(f"""
+                SELECT {MESSAGE_COLUMNS} FROM folder_messages
+                WHERE folder_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (folder_id, limit + 1))
+        else:
+            created_at, message_id = _decode_cursor(cursor)
+            db_cursor.execute(f"""
+                SELECT {MESSAGE_COLUMNS} FROM folder_messages
+                WHERE folder_id = ? AND (created_at < ? OR (created_at = ? AND id < ?))
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (folder_id, created_at, created_at, message_id, limit + 1))
+        messages = [_message_dict(row) for row in db_cursor.fetchall()]
+
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = _encode_cursor(messages[-1])
+
+        return {"folder_id": folder_id, "messages": messages, "next_cursor": next_cursor}
+    finally:
+        conn.close()
+
+
+def _messages_after(user_id, folder_id, key):
+    """Сообщения новее key = (created_at, id) в хронологическом порядке"""
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT {MESSAGE_COLUMNS} FROM folder_messages
+            WHERE folder_id = ? AND (created_at > ? OR (created_at = ? AND id > ?))
+            ORDER BY created_at, id
+            LIMIT ?
+        """, (folder_id, key[0], key[0], key[1], STREAM_BACKLOG_LIMIT))
+        return [_message_dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+async def _tail_messages(subscription, user_id, folder_id, backlog, last_key):
+    try:
+        yield "retry: 1000\n\n"
+        # Пропущенное отдается страницами, пока не кончится: только после этого
+        # last_key можно сравнивать с сообщениями из хаба
+        while backlog:
+            for message in backlog:
+                last_key = (message["created_at"], message["id"])
+                yield format_sse(message, "message", _encode_cursor(message))
+            if len(backlog) < STREAM_BACKLOG_LIMIT:
+                break
+            backlog = await run_in_threadpool(_messages_after, user_id, folder_id, last_key)
+        async for message in subscription.events():
+            if message is None:
+                yield SSE_PING
+                continue
+            key = (message["created_at"], message["id"])
+            # Сообщение могло уже попасть в догоняющую выборку из БД
+            if last_key is not None and key <= last_key:
+                continue
+            last_key = key
+            yield format_sse(message, "message", _encode_cursor(message))
+    finally:
+        subscription.close()
+
+
+@router.get("/{folder_id}/messages/stream")
+async def stream_messages(
+    folder_id: str,
+    request: Request,
+    after: Optional[str] = None,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Новые сообщения папки в реальном времени (text/event-stream).
+
+    id каждого события - курсор сообщения. При переподключении с
+    Last-Event-ID (или параметром after) сначала отдаются пропущенные
+    сообщения из БД, затем поток продолжается из хаба событий без опроса БД.
+    """
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем пользовательскую БД
+    try:
+        _require_folder(conn.cursor(), folder_id)
+    finally:
+        conn.close()
+
+    resume_from = request.headers.get("last-event-id") or after
+    last_key = _decode_cursor(resume_from) if resume_from else None
+
+    # Подписываемся до чтения пропущенного, чтобы не потерять сообщения между ними
+    subscription = event_hub.subscribe(_messages_channel(user_id, folder_id))
+    try:
+        backlog = _messages_after(user_id, folder_id, last_key) if last_key else []
+    except Exception:
+        subscription.close()
+        raise
+
+    return StreamingResponse(
+        _tail_messages(subscription, user_id, folder_id, backlog, last_key),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
@@ -1,21 +1,87 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import HTMLResponse, Response
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional, Dict
-import os
 import uuid
+import json
+import hashlib
 from datetime import datetime
+import logging
 
-from backend.models import Note, Tag
+from backend.models import Note, NotePatch, NoteDuplicate, Tag
 from backend.database import get_db_connection
 from backend.auth import get_current_user, get_user_id
+from backend.storage import (
+    read_note_file, remove_note_file, apply_content_delta, update_note_metadata,
+    acquire_blob, write_blobs, share_blob, share_live_blob, release_blob, collect_blob_garbage,
+    content_hash_of, get_blob_path,
+    drop_note_attachments, collect_attachment_garbage,
+    ensure_tags, link_tags, unlink_tags, get_note_tag_ids
+)
+from backend.streaming import file_response
+from backend.fastjson import FastJSONResponse
+from backend.markdown_render import RENDERING_AVAILABLE, get_rendered_html, cache_key
+from backend.write_buffer import (
+    write_buffer, journal_content, read_note_content, drop_journal
+)
+from backend.revisions import record_revision, get_revision_content, drop_revisions
+from backend.events import publish_note_changes, publish_notes_deleted, publish_folder_changes
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/notes", tags=["notes"])
 
-# Функция для получения пути к заметкам пользователя
-def get_user_notes_dir(user_id):
-    base_notes_dir = os.path.join(os.environ.get("DATA_DIR", "data"), "notes")
-    user_notes_dir = os.path.join(base_notes_dir, str(user_id))
-    os.makedirs(user_notes_dir, exist_ok=True)
-    return user_notes_dir
+# Ограничение глубины рекурсивных запросов по иерархии заметок (защита от циклов в parent_id)
+MAX_NOTE_DEPTH = 64
+
+# Максимальный размер страницы истории ревизий
+MAX_REVISIONS_PAGE = 200
+
+def _hierarchy_rows(cursor, cte_sql, params, order_by):
+    """Легкие строки заметок (id, имя, глубина, теги) для результата рекурсивного CTE hierarchy(id, depth)"""
+    cursor.execute(f"""
+        WITH RECURSIVE {cte_sql}
+        SELECT files.id, files.name, files.folder_id, files.parent_id, hierarchy.depth,
+               (SELECT COUNT(*) FROM files AS children WHERE children.parent_id = files.id),
+               (SELECT json_group_array(unique_tags.tag)
+                FROM file_tags JOIN unique_tags ON unique_tags.id = file_tags.tag_id
+                WHERE file_tags.file_id = files.id)
+        FROM hierarchy
+        JOIN files ON files.id = hierarchy.id
+        ORDER BY {order_by}
+    """, params)
+    return [
+        {
+            "id": row[0],
+            "name": row[1],
+            "folder_id": row[2],
+            "parent_id": row[3],
+            "depth": row[4],
+            "child_count": row[5],
+            "tags": json.loads(row[6])
+        }
+        for row in cursor.fetchall()
+    ]
+
+def _attach_metadata(cursor, files, chunk=500):
+    """Добавляет к результатам поиска метаданные и превью из files (без чтения файлов)"""
+    by_id = {f["id"]: f for f in files}
+    ids = list(by_id)
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        cursor.execute(f"""
+            SELECT id, updated_at, size_bytes, word_count, preview
+            FROM files WHERE id IN ({', '.join('?' * len(part))})
+        """, part)
+        for note_id, updated_at, size_bytes, word_count, preview in cursor.fetchall():
+            by_id[note_id].update(
+                updated_at=updated_at, size_bytes=size_bytes, word_count=word_count, preview=preview
+            )
+
+def _require_note(cursor, note_id):
+    cursor.execute("SELECT 1 FROM files WHERE id = ?", (note_id,))
+    if not cursor.fetchone():
+        raise HTTPException(status_code=404, detail="Note not found")
 
 # ВАЖНО: Маршрут для поиска должен быть определен ДО маршрута для получения заметки по ID
 @router.get("/search", summary="Search notes")
@@ -158,43 +224,212 @@ async def search_notes(
 
             # 3. Поиск по содержимому
             print("Searching by content")
+            # Незаписанные в файлы версии из журнала отложенной записи
+            cursor.execute("SELECT file_id, content FROM note_journal")
+            journaled = {row[0]: row[1] for row in cursor.fetchall()}
             cursor.execute("SELECT id, name, path, date_added, folder_id FROM files")
             for row in cursor.fetchall():
                 file_id, name, path, date_added, folder_id = row
                 if file_id in processed_files:
                     continue
                 try:
-                    if os.path.exists(path):
-                        with open(path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        if query.lower() in content.lower():
-                            processed_files.add(file_id)
-                            cursor.execute("""
-                                SELECT unique_tags.tag, unique_tags.color
-                                FROM file_tags JOIN unique_tags ON file_tags.tag_id = unique_tags.id
-                                WHERE file_tags.file_id = ?
-                            """, (file_id,))
-                            tags_data = [{"name": t_name, "color": color} for t_name, color in cursor.fetchall()]
-                            files.append({
-                                "id": file_id, "name": name, "date_added": date_added, 
-                                "folder_id": folder_id, "tags": tags_data,
-                                "match": "content"   # совпадение по содержимому
-                            })
+                    content = journaled.get(file_id)
+                    if content is None:
+                        content = read_note_file(path)
+                    if content is not None and query.lower() in content.lower():
+                        processed_files.add(file_id)
+                        cursor.execute("""
+                            SELECT unique_tags.tag, unique_tags.color
+                            FROM file_tags JOIN unique_tags ON file_tags.tag_id = unique_tags.id
+                            WHERE file_tags.file_id = ?
+                        """, (file_id,))
+                        tags_data = [{"name": t_name, "color": color} for t_name, color in cursor.fetchall()]
+                        files.append({
+                            "id": file_id, "name": name, "date_added": date_added, 
+                            "folder_id": folder_id, "tags": tags_data,
+                            "match": "content"   # совпадение по содержимому
+                        })
                 except Exception as e:
                     print(f"Error reading file {path}: {str(e)}")
 
         if not query and not tag:
             return []
         
+        _attach_metadata(cursor, files)
+        
         # Перед возвратом результатов добавим лог
         print(f"Search results: {len(files)} files found")    
-        return files
+        return FastJSONResponse(files)
     except Exception as e:
         print(f"Search error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
+@router.get("/{note_id}/children")
+async def get_note_children(note_id: str, current_user: Dict = Depends(get_current_user)):
+    """Непосредственные дочерние заметки"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        _require_note(cursor, note_id)
+        return FastJSONResponse(_hierarchy_rows(
+            cursor,
+            "hierarchy(id, depth) AS (SELECT id, 1 FROM files WHERE parent_id = ?)",
+            (note_id,),
+            "files.name, files.id"
+        ))
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/descendants")
+async def get_note_descendants(
+    note_id: str,
+    depth: int = Query(MAX_NOTE_DEPTH, ge=1, le=MAX_NOTE_DEPTH),
+    current_user: Dict = Depends(get_current_user)
+):
+    """Все потомки заметки до заданной глубины (в порядке обхода в ширину)"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        _require_note(cursor, note_id)
+        return FastJSONResponse(_hierarchy_rows(
+            cursor,
+            """hierarchy(id, depth) AS (
+                SELECT id, 1 FROM files WHERE parent_id = ?
+                UNION
+                SELECT files.id, hierarchy.depth + 1
+                FROM hierarchy JOIN files ON files.parent_id = hierarchy.id
+                WHERE hierarchy.depth < ?
+            )""",
+            (note_id, depth),
+            "hierarchy.depth, files.name, files.id"
+        ))
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/ancestors")
+async def get_note_ancestors(note_id: str, current_user: Dict = Depends(get_current_user)):
+    """Цепочка родительских заметок от корня до непосредственного родителя"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        _require_note(cursor, note_id)
+        return FastJSONResponse(_hierarchy_rows(
+            cursor,
+            f"""hierarchy(id, depth) AS (
+                SELECT parent_id, 1 FROM files WHERE id = ? AND parent_id IS NOT NULL
+                UNION
+                SELECT files.parent_id, hierarchy.depth + 1
+                FROM hierarchy JOIN files ON files.id = hierarchy.id
+                WHERE files.parent_id IS NOT NULL AND hierarchy.depth < {MAX_NOTE_DEPTH}
+            )""",
+            (note_id,),
+            "hierarchy.depth DESC"
+        ))
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/raw")
+async def get_note_raw(
+    note_id: str,
+    request: Request,
+    head: Optional[int] = Query(None, ge=1, description="Отдать только первые head байт"),
+    current_user: Dict = Depends(get_current_user)
+):
+    """Содержимое заметки как есть (text/markdown) потоково, с поддержкой Range"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    query = """
+        SELECT files.path, files.content_hash, note_journal.file_id IS NOT NULL
+        FROM files LEFT JOIN note_journal ON note_journal.file_id = files.id
+        WHERE files.id = ?
+    """
+    try:
+        cursor.execute(query, (note_id,))
+        row = cursor.fetchone()
+        if row and row[2]:
+            # Последняя версия еще в журнале: сначала записываем ее в файл (путь при этом меняется)
+            await run_in_threadpool(write_buffer.flush_note, user_id, note_id)
+            cursor.execute(query, (note_id,))
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Note not found")
+    
+    path, content_hash, _ = row
+    try:
+        return file_response(
+            request, path, "text/markdown; charset=utf-8",
+            etag=content_hash, headers={"Cache-Control": "private, no-cache"}, head=head
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Note file not found")
+
+def _note_etag(content_hash):
+    # Версия рендера входит в ETag: после обновления рендерера клиенты получат новый HTML
+    return f'"{cache_key(content_hash)}"'
+
+def _render_note_html(user_id, note_id, if_none_match=None):
+    """ETag и HTML заметки; файл читается только при промахе кэша.
+
+    Если if_none_match совпадает с ETag, HTML не рендерится и возвращается None.
+    """
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT path, content_hash FROM files WHERE id = ?", (note_id,))
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        path, content_hash = row
+        
+        def load_content():
+            return read_note_content(cursor, note_id, path) or ""
+        
+        if content_hash is None:
+            # Хеш неизвестен (содержимое дописывалось без полного чтения): считаем по содержимому
+            content = load_content()
+            content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            return _note_etag(content_hash), get_rendered_html(content_hash, lambda: content)
+        # content_hash в строке обновляется вместе с журналом, поэтому ETag совпадает
+        # с еще не записанной в файл версией, и проверка обходится без чтения и рендера
+        etag = _note_etag(content_hash)
+        if if_none_match == etag:
+            return etag, None
+        return etag, get_rendered_html(content_hash, load_content)
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/html", response_class=HTMLResponse)
+async def get_note_html(note_id: str, request: Request, current_user: Dict = Depends(get_current_user)):
+    """Очищенный HTML заметки, отрендеренный на сервере и закэшированный по хешу содержимого"""
+    if not RENDERING_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Server-side markdown rendering is not available")
+    
+    user_id = get_user_id(current_user)
+    # Рендеринг длинных заметок не должен блокировать цикл событий
+    etag, html = await run_in_threadpool(
+        _render_note_html, user_id, note_id, request.headers.get("if-none-match")
+    )
+    
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if html is None:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
+
 @router.get("/{note_id}")
 async def get_note(note_id: str, current_user: Dict = Depends(get_current_user)):
     user_id = get_user_id(current_user)
@@ -202,30 +437,24 @@ async def get_note(note_id: str, current_user: Dict = Depends(get_current_user))
     cursor = conn.cursor()
     
     # Получаем информацию о заметке
-    cursor.execute("SELECT id, name, path, folder_id, date_added FROM files WHERE id = ?", (note_id,))
+    cursor.execute("""
+        SELECT id, name, path, folder_id, date_added, updated_at, size_bytes, word_count
+        FROM files WHERE id = ?
+    """, (note_id,))
     note_data = cursor.fetchone()
     
     if not note_data:
         conn.close()
         raise HTTPException(status_code=404, detail="Note not found")
     
-    note_id, name, path, folder_id, date_added = note_data
-    
-    # Получаем содержимое заметки
-    content = ""
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
-    else:
-        # Если файл не существует, создаем пустой
-        user_notes_dir = get_user_notes_dir(user_id)
-        path = os.path.join(user_notes_dir, f"{note_id}.md")
-        with open(path, 'w', encoding='utf-8') as f:
-            pass
-        
-        # Обновляем путь в базе данных
-        cursor.execute("UPDATE files SET path = ? WHERE id = ?", (path, note_id))
-        conn.commit()
+    note_id, name, path, folder_id, date_added, updated_at, size_bytes, word_count = note_data
+    
+    # Получаем содержимое заметки (последняя версия может быть еще в журнале)
+    content = read_note_content(cursor, note_id, path)
+    if content is None:
+        # Файл потерян: отдаем пустую заметку, восстановлением занимается backend.maintenance
+        logger.warning(f"Note file is missing for note {note_id} of user {user_id}")
+        content = ""
     
     # Получаем теги заметки
     cursor.execute("""
@@ -245,6 +474,9 @@ async def get_note(note_id: str, current_user: Dict = Depends(get_current_user))
         "content": content,
         "folder_id": folder_id,
         "date_added": date_added,
+        "updated_at": updated_at,
+        "size_bytes": size_bytes,
+        "word_count": word_count,
         "tags": tags
     }
 
@@ -266,49 +498,34 @@ async def create_note(
         if not note.date_added:
             note.date_added = datetime.now().isoformat()
         
-        # Создаем директорию для заметок пользователя
-        user_notes_dir = get_user_notes_dir(user_id)
-        
-        # Создаем файл заметки
-        path = os.path.join(user_notes_dir, f"{note.id}.md")
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(note.content)
+        # Содержимое хранится по хешу: такой же текст (например, из шаблона) уже может быть на диске.
+        # Файл с fsync пишется в пуле потоков: в цикле событий он остановил бы все запросы,
+        # а одновременные записи не могли бы попасть в одну группу fsync
+        await run_in_threadpool(write_blobs, user_id, [note.content])
+        blob_hash, path = acquire_blob(cursor, user_id, note.content)
         
         # Добавляем запись в базу данных
         cursor.execute("""
-            INSERT INTO files (id, name, path, date_added, folder_id, parent_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (note.id, note.name, path, note.date_added, note.folder_id, note.parent_id))
+            INSERT INTO files (id, name, path, blob_hash, date_added, folder_id, parent_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (note.id, note.name, path, blob_hash, note.date_added, note.folder_id, note.parent_id))
+        update_note_metadata(cursor, note.id, note.content, note.date_added)
+        record_revision(cursor, note.id, note.content, blob_hash)
         
         # Добавляем теги, если они указаны
         if note.tags:
-            for tag in note.tags:
-                # Проверяем, существует ли тег
-                cursor.execute("SELECT id FROM unique_tags WHERE tag = ?", (tag.name,))
-                tag_row = cursor.fetchone()
-                
-                if tag_row:
-                    tag_id = tag_row[0]
-                    # Обновляем цвет, если он задан
-                    if tag.color:
-                        cursor.execute("UPDATE unique_tags SET color = ? WHERE id = ?", 
-                                      (tag.color, tag_id))
-                else:
-                    # Создаем новый тег
-                    color = tag.color or f"#{uuid.uuid4().hex[:6]}"
-                    cursor.execute("INSERT INTO unique_tags (tag, color) VALUES (?, ?)", 
-                                  (tag.name, color))
-                    tag_id = cursor.lastrowid
-                
-                # Связываем тег с файлом
-                cursor.execute("INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)", 
-                              (note.id, tag_id))
+            link_tags(cursor, [note.id], ensure_tags(cursor, note.tags))
         
         conn.commit()
+        publish_note_changes(user_id, cursor, [note.id])
+        # note_count папки поменял триггер
+        publish_folder_changes(user_id, cursor, [note.folder_id])
         
         return {"id": note.id, "status": "created"}
     
     except Exception as e:
+        # Файл содержимого может быть общим с другими заметками, поэтому его не трогаем:
+        # без ссылок его уберет backend.maintenance
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -326,18 +543,18 @@ async def update_note(
     
     try:
         # Проверяем существование заметки
-        cursor.execute("SELECT path FROM files WHERE id = ?", (note_id,))
+        cursor.execute("SELECT path, folder_id FROM files WHERE id = ?", (note_id,))
         result = cursor.fetchone()
         
         if not result:
             conn.close()
             raise HTTPException(status_code=404, detail="Note not found")
         
-        note_path = result[0]
+        note_path, old_folder_id = result
         
-        # Обновляем содержимое заметки
-        with open(note_path, 'w', encoding='utf-8') as f:
-            f.write(note.content)
+        # Новое содержимое попадает в журнал, файл перезапишется в фоне
+        journal_content(cursor, note_id, note.content)
+        update_note_metadata(cursor, note_id, note.content)
         
         # Обновляем имя и папку, если указаны
         cursor.execute("""
@@ -352,29 +569,13 @@ async def update_note(
             cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (note_id,))
             
             # Добавляем новые теги
-            for tag in note.tags:
-                # Проверяем существование тега
-                cursor.execute("SELECT id FROM unique_tags WHERE tag = ?", (tag.name,))
-                tag_row = cursor.fetchone()
-                
-                if tag_row:
-                    tag_id = tag_row[0]
-                    # Обновляем цвет, если он задан
-                    if tag.color:
-                        cursor.execute("UPDATE unique_tags SET color = ? WHERE id = ?", 
-                                      (tag.color, tag_id))
-                else:
-                    # Создаем новый тег
-                    color = tag.color or f"#{uuid.uuid4().hex[:6]}"
-                    cursor.execute("INSERT INTO unique_tags (tag, color) VALUES (?, ?)", 
-                                  (tag.name, color))
-                    tag_id = cursor.lastrowid
-                
-                # Связываем тег с файлом
-                cursor.execute("INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)", 
-                              (note_id, tag_id))
+            link_tags(cursor, [note_id], ensure_tags(cursor, note.tags))
         
         conn.commit()
+        write_buffer.stage(user_id, note_id, note.content)
+        publish_note_changes(user_id, cursor, [note_id])
+        if note.folder_id != old_folder_id:
+            publish_folder_changes(user_id, cursor, [old_folder_id, note.folder_id])
         
         return {"id": note_id, "status": "updated"}
     
@@ -384,6 +585,273 @@ async def update_note(
     finally:
         conn.close()
 
+@router.patch("/{note_id}")
+async def patch_note(
+    note_id: str,
+    patch: NotePatch,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Частичное обновление заметки: файл трогаем только при изменении содержимого"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        if patch.content is not None and patch.delta is not None:
+            raise HTTPException(status_code=400, detail="Use either content or delta, not both")
+        if "name" in patch.__fields_set__ and not patch.name:
+            raise HTTPException(status_code=400, detail="Name cannot be empty")
+        
+        cursor.execute("SELECT path, folder_id FROM files WHERE id = ?", (note_id,))
+        result = cursor.fetchone()
+        
+        if not result:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        note_path, old_folder_id = result
+        
+        # Обновляем только переданные метаданные
+        fields = [f for f in ("name", "folder_id", "parent_id") if f in patch.__fields_set__]
+        if fields:
+            assignments = ', '.join(f"{f} = ?" for f in fields)
+            cursor.execute(f"UPDATE files SET {assignments} WHERE id = ?",
+                           [getattr(patch, f) for f in fields] + [note_id])
+        
+        # Обновляем теги по разнице множеств: пишем только добавленные и удаленные связи
+        if patch.tags is not None:
+            current_tag_ids = set(get_note_tag_ids(cursor, note_id))
+            new_tag_ids = ensure_tags(cursor, patch.tags)
+            unlink_tags(cursor, [note_id], current_tag_ids - set(new_tag_ids))
+            link_tags(cursor, [note_id], [t for t in new_tag_ids if t not in current_tag_ids])
+        
+        # Обновляем содержимое
+        content_changed = False
+        new_content = None
+        if patch.delta is not None:
+            # Файлы содержимого неизменяемы (общие для одинаковых заметок), поэтому
+            # даже дописывание в конец идет через журнал отложенной записи
+            base = read_note_content(cursor, note_id, note_path) or ""
+            try:
+                new_content = apply_content_delta(base, patch.delta)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if new_content == base:
+                new_content = None
+        elif patch.content is not None and read_note_content(cursor, note_id, note_path) != patch.content:
+            new_content = patch.content
+        
+        if new_content is not None:
+            journal_content(cursor, note_id, new_content)
+            update_note_metadata(cursor, note_id, new_content)
+            content_changed = True
+        
+        conn.commit()
+        if new_content is not None:
+            write_buffer.stage(user_id, note_id, new_content)
+        publish_note_changes(user_id, cursor, [note_id])
+        if "folder_id" in patch.__fields_set__ and patch.folder_id != old_folder_id:
+            publish_folder_changes(user_id, cursor, [old_folder_id, patch.folder_id])
+        
+        return {"id": note_id, "status": "updated", "content_changed": content_changed}
+    
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@router.post("/{note_id}/duplicate")
+async def duplicate_note(
+    note_id: str,
+    options: Optional[NoteDuplicate] = None,
+    current_user: Dict = Depends(get_current_user)
+):
+    """Копия заметки: новая запись ссылается на то же содержимое, файлы не копируются"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    options = options or NoteDuplicate()
+    
+    try:
+        cursor.execute("""
+            SELECT name, path, blob_hash, folder_id, parent_id,
+                   size_bytes, word_count, content_hash, preview
+            FROM files WHERE id = ?
+        """, (note_id,))
+        source = cursor.fetchone()
+        if not source:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        name, path, blob_hash, folder_id, parent_id, size_bytes, word_count, content_hash, preview = source
+        # Содержимое нужно для первой ревизии копии; читаем его до блокировки записи
+        content = read_note_file(path)
+        if blob_hash:
+            share_blob(cursor, blob_hash)
+        else:
+            # Старый файл <id>.md: копия сразу получает содержимое по хешу
+            content = content or ""
+            blob_hash, path = acquire_blob(cursor, user_id, content)
+        
+        new_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        new_folder_id = options.folder_id if "folder_id" in options.__fields_set__ else folder_id
+        cursor.execute("""
+            INSERT INTO files (id, name, path, blob_hash, date_added, folder_id, parent_id,
+                               size_bytes, word_count, content_hash, preview, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            new_id,
+            options.name if options.name else f"{name} (copy)",
+            path, blob_hash, now,
+            new_folder_id,
+            options.parent_id if "parent_id" in options.__fields_set__ else parent_id,
+            size_bytes, word_count, content_hash, preview, now
+        ))
+        # История копии начинается с общего содержимого; версия из журнала станет следующей ревизией
+        if content is not None:
+            record_revision(cursor, new_id, content, blob_hash)
+        cursor.execute("""
+            INSERT INTO file_tags (file_id, tag_id)
+            SELECT ?, tag_id FROM file_tags WHERE file_id = ?
+        """, (new_id, note_id))
+        
+        # Незаписанная версия исходной заметки достается и копии
+        cursor.execute("SELECT content FROM note_journal WHERE file_id = ?", (note_id,))
+        journaled = cursor.fetchone()
+        if journaled:
+            journal_content(cursor, new_id, journaled[0])
+        
+        conn.commit()
+        if journaled:
+            write_buffer.stage(user_id, new_id, journaled[0])
+        publish_note_changes(user_id, cursor, [new_id])
+        publish_folder_changes(user_id, cursor, [new_folder_id])
+        
+        return {"id": new_id, "status": "created"}
+    
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/revisions")
+async def list_note_revisions(
+    note_id: str,
+    before: Optional[int] = Query(None, ge=1, description="Номер ревизии, с которой продолжить (не включая)"),
+    limit: int = Query(50, ge=1, le=MAX_REVISIONS_PAGE),
+    current_user: Dict = Depends(get_current_user)
+):
+    """История версий заметки от новых к старым (keyset-пагинация по номеру ревизии)"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        _require_note(cursor, note_id)
+        cursor.execute("""
+            SELECT rev, created_at, size_bytes, content_hash, kind
+            FROM note_revisions
+            WHERE file_id = ? AND rev < ?
+            ORDER BY rev DESC
+            LIMIT ?
+        """, (note_id, before or 2 ** 62, limit + 1))
+        rows = cursor.fetchall()
+        
+        revisions = [{
+            "rev": row[0],
+            "created_at": row[1],
+            "size_bytes": row[2],
+            "content_hash": row[3],
+            "snapshot": row[4] == "snapshot"
+        } for row in rows[:limit]]
+        next_before = revisions[-1]["rev"] if len(rows) > limit else None
+        return {"note_id": note_id, "revisions": revisions, "next_before": next_before}
+    finally:
+        conn.close()
+
+@router.get("/{note_id}/revisions/{rev}")
+async def get_note_revision(note_id: str, rev: int, current_user: Dict = Depends(get_current_user)):
+    """Текст одной ревизии (восстанавливается из ближайшего снимка и дельт)"""
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        _require_note(cursor, note_id)
+        content = get_revision_content(cursor, note_id, rev)
+        if content is None:
+            raise HTTPException(status_code=404, detail="Revision not found")
+        return {"note_id": note_id, "rev": rev, "content": content}
+    finally:
+        conn.close()
+
+@router.post("/{note_id}/revisions/{rev}/restore")
+async def restore_note_revision(note_id: str, rev: int, current_user: Dict = Depends(get_current_user)):
+    """Возвращает заметку к ревизии; восстановление само становится новой ревизией.
+
+    Если содержимое этой версии еще лежит на диске (его использует эта или
+    другая заметка), запись просто переключается на него без записи файла.
+    Иначе версия идет через журнал, как обычное сохранение.
+    """
+    user_id = get_user_id(current_user)
+    conn = get_db_connection(user_id)  # Используем БД пользователя
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT path, blob_hash FROM files WHERE id = ?", (note_id,))
+        result = cursor.fetchone()
+        if not result:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        note_path, blob_hash = result
+        content = get_revision_content(cursor, note_id, rev)
+        if content is None:
+            raise HTTPException(status_code=404, detail="Revision not found")
+        
+        content_hash = content_hash_of(content)
+        swapped = share_live_blob(cursor, content_hash)
+        if swapped:
+            cursor.execute(
+                "UPDATE files SET path = ?, blob_hash = ? WHERE id = ?",
+                (get_blob_path(user_id, content_hash), content_hash, note_id)
+            )
+            release_blob(cursor, blob_hash)
+            # Незаписанная версия заменяется восстановленной
+            drop_journal(cursor, [note_id])
+            record_revision(cursor, note_id, content, content_hash)
+        else:
+            journal_content(cursor, note_id, content)
+        update_note_metadata(cursor, note_id, content)
+        
+        conn.commit()
+        if swapped:
+            write_buffer.discard(user_id, [note_id])
+            if blob_hash:
+                collect_blob_garbage(conn, user_id)
+            else:
+                remove_note_file(note_path)
+        else:
+            write_buffer.stage(user_id, note_id, content)
+        publish_note_changes(user_id, cursor, [note_id])
+        
+        return {"id": note_id, "status": "restored", "rev": rev}
+    
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
 @router.delete("/{note_id}")
 async def delete_note(
     note_id: str,
@@ -395,27 +863,38 @@ async def delete_note(
     
     try:
         # Проверяем существование заметки
-        cursor.execute("SELECT path FROM files WHERE id = ?", (note_id,))
+        cursor.execute("SELECT path, blob_hash, folder_id FROM files WHERE id = ?", (note_id,))
         result = cursor.fetchone()
         
         if not result:
             conn.close()
             raise HTTPException(status_code=404, detail="Note not found")
         
-        note_path = result[0]
+        note_path, blob_hash, folder_id = result
+        release_blob(cursor, blob_hash)
         
-        # Удаляем файл заметки
-        if os.path.exists(note_path):
-            os.remove(note_path)
-        
-        # Удаляем связи с тегами
+        # Удаляем связи с тегами и незаписанные версии
         cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (note_id,))
+        drop_journal(cursor, [note_id])
+        write_buffer.discard(user_id, [note_id])
+        drop_revisions(cursor, [note_id])
+        removed_attachments = drop_note_attachments(cursor, user_id, [note_id])
         
         # Удаляем запись из базы данных
         cursor.execute("DELETE FROM files WHERE id = ?", (note_id,))
         
         conn.commit()
         
+        # Файлы удаляем только после коммита, чтобы откат не оставил запись без файла
+        if blob_hash:
+            collect_blob_garbage(conn, user_id)
+        else:
+            # Старый файл <id>.md принадлежит только этой заметке
+            remove_note_file(note_path)
+        collect_attachment_garbage(conn, user_id, removed_attachments)
+        publish_notes_deleted(user_id, [note_id])
+        publish_folder_changes(user_id, cursor, [folder_id])
+        
         return {"status": "deleted"}
     
     except Exception as e:
@@ -1,57 +1,201 @@
 from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+import base64
+import json
+
 from backend.database import get_db_connection
 from backend.auth import get_current_user, get_user_id
+from backend.singleflight import coalesced_json
 
 router = APIRouter(prefix="/api/tree", tags=["tree"])
 
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+# Допустимые сортировки заметок: значение параметра sort -> колонка files (обе покрыты индексами)
+NOTE_SORTS = {"name": "name", "updated_at": "updated_at"}
+
+
+def _folder_row(row):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "parent_id": row[2],
+        "color": row[3],
+        "position": row[4],
+        "order_key": row[5],
+        "child_count": row[6],
+        "note_count": row[7]
+    }
+
+
+def _note_row(row, preview):
+    note = {
+        "id": row[0],
+        "name": row[1],
+        "folder_id": row[2],
+        "parent_id": row[3],
+        "updated_at": row[4],
+        "size_bytes": row[5],
+        "word_count": row[6]
+    }
+    if preview:
+        note["preview"] = row[7]
+    return note
+
+
+def _encode_cursor(kind, sort_key, item_id, sort_spec):
+    raw = json.dumps([kind, sort_key, item_id, sort_spec], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def _decode_cursor(cursor_value, sort_spec):
+    try:
+        kind, sort_key, item_id, cursor_sort = json.loads(base64.urlsafe_b64decode(cursor_value.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if kind not in ("folder", "note"):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort_spec:
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different sort order")
+    return kind, sort_key, item_id
+
+
 @router.get("")
-async def get_tree(current_user: dict = Depends(get_current_user)):
-    """Получение структуры файлов и папок для проводника"""
+async def get_tree(
+    parent_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    sort: str = "name",
+    order: str = "asc",
+    preview: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Получение структуры файлов и папок для проводника.
+
+    Без параметров возвращает все дерево целиком. С parent_id, cursor или
+    limit возвращает один уровень (сначала папки, затем заметки) постранично.
+    sort/order задают порядок заметок (name или updated_at), preview=true
+    добавляет к заметкам текстовое превью.
+    """
+    if sort not in NOTE_SORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort '{sort}'")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Unknown order '{order}'")
+
     user_id = get_user_id(current_user)
+    # Одинаковые одновременные запросы (например, повторное открытие приложения) ждут одно чтение
+    params = (parent_id, cursor, limit, sort, order, preview)
+    return await coalesced_json(user_id, "tree", params, _load_tree, user_id, *params)
+
+
+def _load_tree(user_id, parent_id, cursor, limit, sort, order, preview):
     conn = get_db_connection(user_id)  # Используем пользовательскую БД
-    cursor = conn.cursor()
-    
+    db_cursor = conn.cursor()
+
     try:
-        # Получаем все папки пользователя
-        cursor.execute("""
-            SELECT id, name, parent_id, color, position
-            FROM folders
-            ORDER BY position
-        """)
-        
-        folders = [
-            {
-                "id": row[0],
-                "name": row[1],
-                "parent_id": row[2],
-                "color": row[3],
-                "position": row[4]
-            }
-            for row in cursor.fetchall()
-        ]
-        
-        # Получаем все файлы пользователя
-        cursor.execute("""
-            SELECT id, name, folder_id, parent_id, path
-            FROM files
-            ORDER BY name
-        """)
-        
-        files = [
-            {
-                "id": row[0],
-                "name": row[1],
-                "folder_id": row[2],
-                "parent_id": row[3],
-                "path": row[4]
-            }
-            for row in cursor.fetchall()
-        ]
-        
-        return {"folders": folders, "files": files}
-    
+        if parent_id is None and cursor is None and limit is None:
+            return _get_full_tree(db_cursor, sort, order, preview)
+        return _get_tree_level(
+            db_cursor, parent_id or None, cursor, limit or DEFAULT_PAGE_SIZE, sort, order, preview
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+
+def _get_full_tree(cursor, sort, order, preview):
+    # Получаем все папки пользователя
+    cursor.execute("""
+        SELECT id, name, parent_id, color, position, order_key, child_count, note_count
+        FROM folders
+        ORDER BY order_key, id
+    """)
+
+    folders = [_folder_row(row) for row in cursor.fetchall()]
+
+    # Получаем все файлы пользователя
+    column = NOTE_SORTS[sort]
+    cursor.execute(f"""
+        SELECT id, name, folder_id, parent_id, updated_at, size_bytes, word_count{", preview" if preview else ""}
+        FROM files
+        ORDER BY {column} {order}, id {order}
+    """)
+
+    files = [_note_row(row, preview) for row in cursor.fetchall()]
+
+    return {"folders": folders, "files": files}
+
+
+def _get_tree_level(cursor, parent_id, cursor_value, limit, sort, order, preview):
+    """Один уровень дерева: keyset-пагинация по (order_key, id) для папок и (sort, id) для заметок"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sort_spec = f"{sort}:{order}"
+    kind, sort_key, last_id = _decode_cursor(cursor_value, sort_spec) if cursor_value else ("folder", None, None)
+
+    if parent_id is not None:
+        cursor.execute("SELECT 1 FROM folders WHERE id = ?", (parent_id,))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Folder not found")
+
+    items = []
+
+    if kind == "folder":
+        if last_id is None:
+            cursor.execute("""
+                SELECT id, name, parent_id, color, position, order_key, child_count, note_count
+                FROM folders
+                WHERE parent_id IS ?
+                ORDER BY order_key, id
+                LIMIT ?
+            """, (parent_id, limit + 1))
+        else:
+            cursor.execute("""
+                SELECT id, name, parent_id, color, position, order_key, child_count, note_count
+                FROM folders
+                WHERE parent_id IS ? AND (order_key > ? OR (order_key = ? AND id > ?))
+                ORDER BY order_key, id
+                LIMIT ?
+            """, (parent_id, sort_key, sort_key, last_id, limit + 1))
+        items.extend(dict(_folder_row(row), type="folder") for row in cursor.fetchall())
+        # Заметки начинаются с начала, когда папки закончились
+        kind, sort_key, last_id = "note", None, None
+
+    remaining = limit + 1 - len(items)
+    if remaining > 0:
+        column = NOTE_SORTS[sort]
+        columns = "id, name, folder_id, parent_id, updated_at, size_bytes, word_count, preview"
+        if last_id is None:
+            cursor.execute(f"""
+                SELECT {columns}
+                FROM files
+                WHERE folder_id IS ?
+                ORDER BY {column} {order}, id {order}
+                LIMIT ?
+            """, (parent_id, remaining))
+        else:
+            after = ">" if order == "asc" else "<"
+            cursor.execute(f"""
+                SELECT {columns}
+                FROM files
+                WHERE folder_id IS ? AND ({column} {after} ? OR ({column} = ? AND id {after} ?))
+                ORDER BY {column} {order}, id {order}
+                LIMIT ?
+            """, (parent_id, sort_key, sort_key, last_id, remaining))
+        items.extend(dict(_note_row(row, preview), type="note") for row in cursor.fetchall())
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        if last["type"] == "folder":
+            next_cursor = _encode_cursor("folder", last["order_key"], last["id"], sort_spec)
+        else:
+            next_cursor = _encode_cursor("note", last[NOTE_SORTS[sort]], last["id"], sort_spec)
+
+    return {"parent_id": parent_id, "items": items, "next_cursor": next_cursor}
@@ -0,0 +1,63 @@
+"""Объединение одинаковых одновременных запросов на чтение (single-flight).
+
+Mini App при открытии параллельно запрашивает дерево, папки и граф, а
+повторное открытие или двойное нажатие дублирует эти запросы. Одинаковые
+запросы (тот же пользователь, те же параметры и та же версия данных) ждут
+одно вычисление: первый запускает загрузку в пуле потоков, остальные
+получают тот же результат, уже сериализованный в JSON.
+
+Версия данных - номер последнего события изменений пользователя
+(backend.events.user_events): запрос, пришедший после записи, не
+присоединится к вычислению, начатому до нее. Готовые результаты не
+кэшируются - объединяются только вычисления, идущие в данный момент.
+"""
+import asyncio
+
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from backend.events import user_events
+from backend.fastjson import dumps
+
+
+class SingleFlight:
+    """Текущие вычисления по ключу; используется только из цикла событий"""
+
+    def __init__(self):
+        self._calls = {}
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Ошибку получают ожидающие; если их не осталось, не даем asyncio ругаться на нее
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(run_in_threadpool(fn, *args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # Отключившийся клиент не должен отменять вычисление для остальных
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+single_flight = SingleFlight()
+
+
+def _load_and_encode(fn, args):
+    return dumps(fn(*args))
+
+
+async def coalesced_json(user_id, name, params, fn, *args) -> Response:
+    """JSON-ответ fn(*args), общий для одинаковых одновременных запросов пользователя.
+
+    fn выполняется в пуле потоков и может бросать HTTPException.
+    """
+    key = (str(user_id), name, params, user_events.data_version(user_id))
+    body = await single_flight.do(key, _load_and_encode, fn, args)
+    return Response(content=body, media_type="application/json")
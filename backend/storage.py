@@ -0,0 +1,523 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Iterable, List
+
+from backend.models import Tag
+from backend.thumbnails import thumbnail_path
+
+logger = logging.getLogger(__name__)
+
+# Политика fsync для файлов заметок:
+#   always - fsync каждого файла и каталога сразу после записи;
+#   batch  - групповой коммит: одновременные записи ждут одного общего прохода fsync;
+#   never  - без fsync (атомарность через os.replace сохраняется, долговечность - на усмотрение ОС)
+FSYNC_POLICY = os.environ.get("NOTES_FSYNC", "batch").lower()
+# Сколько миллисекунд лидер группового коммита ждет попутные записи
+FSYNC_BATCH_WINDOW = float(os.environ.get("NOTES_FSYNC_BATCH_WINDOW_MS", "2")) / 1000.0
+
+TEMP_SUFFIX = ".tmp"
+
+# Длина текстового превью заметки в таблице files
+PREVIEW_LENGTH = 200
+
+_CODE_FENCE = re.compile(r"```.*?(```|$)", re.S)
+_MARKDOWN_LINK = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_WIKI_LINK = re.compile(r"\[\[([^\]|]*)(\|[^\]]*)?\]\]")
+_MARKDOWN_MARKUP = re.compile(r"^\s{0,3}(#{1,6}|>|[-*+]|\d+\.)\s+|[*_~`]+", re.M)
+
+
+class GroupCommit:
+    """Групповой fsync: первый ожидающий становится лидером и синхронизирует всех накопившихся"""
+
+    def __init__(self, sync_item, window=FSYNC_BATCH_WINDOW):
+        self._sync_item = sync_item
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending = []
+        self._errors = {}
+        self._batch = 0   # номер собираемой группы
+        self._done = 0    # группы с номером меньше _done уже синхронизированы
+        self._leader = False
+
+    def sync(self, *items):
+        """Синхронизирует items (вместе с попутными записями других потоков)"""
+        with self._cond:
+            self._pending.extend(items)
+            my_batch = self._batch
+            while True:
+                if self._done > my_batch:
+                    self._raise_errors(items)
+                    return
+                if not self._leader:
+                    self._leader = True
+                    break
+                self._cond.wait()
+
+        # Мы лидер: ждем попутчиков и синхронизируем всю группу
+        if self.window:
+            time.sleep(self.window)
+        with self._cond:
+            group, self._pending = self._pending, []
+            batch = self._batch
+            self._batch += 1
+
+        errors = {}
+        for pending_item in dict.fromkeys(group):
+            try:
+                self._sync_item(pending_item)
+            except OSError as e:
+                errors[pending_item] = e
+
+        with self._cond:
+            self._errors.update(errors)
+            self._done = batch + 1
+            self._leader = False
+            self._cond.notify_all()
+            self._raise_errors(items)
+
+    def _raise_errors(self, items):
+        """Поднимает первую ошибку синхронизации своих items (под self._cond)"""
+        errors = [self._errors.pop(item) for item in items if item in self._errors]
+        if errors:
+            raise errors[0]
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_file_group = GroupCommit(os.fsync)
+_dir_group = GroupCommit(_fsync_dir)
+
+
+def _sync_file(*fds):
+    if FSYNC_POLICY == "always":
+        for fd in fds:
+            os.fsync(fd)
+    elif FSYNC_POLICY == "batch":
+        _file_group.sync(*fds)
+
+
+def _sync_dir(*paths):
+    if FSYNC_POLICY == "always":
+        for path in paths:
+            _fsync_dir(path)
+    elif FSYNC_POLICY == "batch":
+        _dir_group.sync(*paths)
+
+
+def get_user_notes_dir(user_id):
+    """Возвращает директорию с файлами заметок пользователя (создает при необходимости)"""
+    base_notes_dir = os.path.join(os.environ.get("DATA_DIR", "data"), "notes")
+    user_notes_dir = os.path.join(base_notes_dir, str(user_id))
+    os.makedirs(user_notes_dir, exist_ok=True)
+    return user_notes_dir
+
+
+def write_note_file(path, content):
+    """Атомарно записывает содержимое заметки: временный файл, fsync по политике, os.replace"""
+    directory, filename = os.path.split(path)
+    temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            _sync_file(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _sync_dir(directory or ".")
+
+
+def get_user_blobs_dir(user_id):
+    """Директория содержимого заметок, адресуемого хешем"""
+    blobs_dir = os.path.join(get_user_notes_dir(user_id), "blobs")
+    os.makedirs(blobs_dir, exist_ok=True)
+    return blobs_dir
+
+
+def get_blob_path(user_id, content_hash):
+    return os.path.join(get_user_blobs_dir(user_id), content_hash[:2], f"{content_hash}.md")
+
+
+def content_hash_of(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def acquire_blob(cursor, user_id, content, content_hash=None):
+    """Увеличивает счетчик ссылок на содержимое (в транзакции вызывающего кода); возвращает (hash, path).
+
+    Файл пишется заранее, до блокировки БД, если его еще нет (обработчики
+    запросов записывают его через write_blobs в пуле потоков, и здесь он уже
+    на месте). После upsert (он берет блокировку записи) наличие файла
+    проверяется еще раз: сборщик мусора удаляет файлы только под той же
+    блокировкой.
+    """
+    content_hash = content_hash or content_hash_of(content)
+    path = get_blob_path(user_id, content_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_note_file(path, content)
+    cursor.execute("""
+        INSERT INTO note_blobs (hash, refcount, size_bytes) VALUES (?, 1, ?)
+        ON CONFLICT(hash) DO UPDATE SET refcount = note_blobs.refcount + 1
+    """, (content_hash, len(content.encode('utf-8'))))
+    if not os.path.exists(path):
+        write_note_file(path, content)
+    return content_hash, path
+
+
+def write_blobs(user_id, contents):
+    """Заранее записывает содержимое пачки заметок; возвращает хеши.
+
+    Сначала пишутся все недостающие временные файлы, затем они синхронизируются
+    одним проходом (по FSYNC_POLICY, в batch - через групповой коммит) и
+    переименовываются, а каталоги синхронизируются по разу на пачку.
+    Последующий acquire_blob найдет файлы на месте и только увеличит
+    счетчики ссылок.
+    """
+    hashes = []
+    pending = {}  # path -> (temp_path, открытый файл)
+    try:
+        for content in contents:
+            content_hash = content_hash_of(content)
+            hashes.append(content_hash)
+            path = get_blob_path(user_id, content_hash)
+            if path in pending or os.path.exists(path):
+                continue
+            directory, filename = os.path.split(path)
+            os.makedirs(directory, exist_ok=True)
+            temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+            f = open(temp_path, 'w', encoding='utf-8')
+            pending[path] = (temp_path, f)
+            f.write(content)
+            f.flush()
+        if pending:
+            _sync_file(*(f.fileno() for _, f in pending.values()))
+        directories = dict.fromkeys(os.path.dirname(path) for path in pending)
+        for path, (temp_path, f) in list(pending.items()):
+            f.close()
+            os.replace(temp_path, path)
+            del pending[path]
+    except BaseException:
+        for temp_path, f in pending.values():
+            f.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+    if directories:
+        _sync_dir(*directories)
+    return hashes
+
+
+def share_blob(cursor, content_hash):
+    """Еще одна ссылка на уже существующее содержимое (копирование заметки без записи файла)"""
+    cursor.execute("UPDATE note_blobs SET refcount = refcount + 1 WHERE hash = ?", (content_hash,))
+
+
+def share_live_blob(cursor, content_hash):
+    """Ссылка на содержимое, только если оно еще используется; False - файла может уже не быть.
+
+    Сборщик мусора удаляет лишь строки с refcount <= 0 и под блокировкой
+    записи, которую берет этот UPDATE, поэтому при успехе файл на месте.
+    """
+    cursor.execute(
+        "UPDATE note_blobs SET refcount = refcount + 1 WHERE hash = ? AND refcount > 0", (content_hash,)
+    )
+    return cursor.rowcount == 1
+
+
+def release_blob(cursor, content_hash):
+    """Уменьшает счетчик ссылок; содержимое без ссылок удалит collect_blob_garbage"""
+    if content_hash:
+        cursor.execute("UPDATE note_blobs SET refcount = refcount - 1 WHERE hash = ?", (content_hash,))
+
+
+def collect_blob_garbage(conn, user_id):
+    """Удаляет содержимое, на которое не осталось ссылок; вызывается вне транзакции.
+
+    Файлы удаляются под блокировкой записи (BEGIN IMMEDIATE), поэтому
+    параллельный acquire_blob либо увидит строку до удаления, либо после
+    удаления создаст ее и файл заново.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT hash FROM note_blobs WHERE refcount <= 0")
+        hashes = [row[0] for row in cursor.fetchall()]
+        for content_hash in hashes:
+            path = get_blob_path(user_id, content_hash)
+            if os.path.exists(path):
+                os.remove(path)
+            cursor.execute("DELETE FROM note_blobs WHERE hash = ? AND refcount <= 0", (content_hash,))
+        conn.commit()
+    except Exception as e:
+        # Не страшно: строки без ссылок остаются и будут удалены при следующей сборке
+        conn.rollback()
+        logger.warning(f"Blob garbage collection failed for user {user_id}: {e}")
+        return 0
+    return len(hashes)
+
+
+def get_user_attachments_dir(user_id):
+    """Директория вложений пользователя (создает при необходимости)"""
+    attachments_dir = os.path.join(get_user_notes_dir(user_id), "attachments")
+    os.makedirs(attachments_dir, exist_ok=True)
+    return attachments_dir
+
+
+def get_attachment_path(user_id, content_hash):
+    """Путь к содержимому вложения: вложения хранятся по хешу, одинаковые файлы - один раз"""
+    return os.path.join(get_user_attachments_dir(user_id), content_hash[:2], content_hash)
+
+
+def open_temp_file(path):
+    """Открывает временный файл рядом с path для потоковой записи; возвращает (temp_path, file)"""
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}{TEMP_SUFFIX}")
+    return temp_path, open(temp_path, 'wb')
+
+
+def finish_temp_file(f):
+    """Дописывает на диск (fsync по политике) и закрывает временный файл из open_temp_file"""
+    try:
+        f.flush()
+        _sync_file(f.fileno())
+    finally:
+        f.close()
+
+
+def install_temp_file(temp_path, path):
+    """Атомарно переименовывает законченный временный файл в path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    _sync_dir(os.path.dirname(path))
+
+
+def commit_temp_file(f, temp_path, path):
+    """Закрывает временный файл из open_temp_file и атомарно переименовывает его в path"""
+    finish_temp_file(f)
+    install_temp_file(temp_path, path)
+
+
+def remove_note_file(path):
+    """Удаляет файл заметки, если он существует"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def recover_temp_files(notes_root=None, min_age=0):
+    """Удаляет временные файлы, оставшиеся от прерванных записей.
+
+    До os.replace исходный файл не тронут, а незаписанные версии лежат
+    в журнале отложенной записи, поэтому недописанный временный файл
+    можно просто удалить. min_age (секунды) не дает удалить файлы, которые
+    прямо сейчас пишут другие работающие процессы.
+    """
+    notes_root = notes_root or os.path.join(os.environ.get("DATA_DIR", "data"), "notes")
+    removed = 0
+    if not os.path.isdir(notes_root):
+        return removed
+    for directory, _, filenames in os.walk(notes_root):
+        for filename in filenames:
+            if filename.startswith(".") and filename.endswith(TEMP_SUFFIX):
+                path = os.path.join(directory, filename)
+                try:
+                    if min_age and time.time() - os.path.getmtime(path) < min_age:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(f"Failed to remove temp file {filename}: {e}")
+    if removed:
+        logger.info(f"Removed {removed} orphaned temp note file(s)")
+    return removed
+
+
+def apply_content_delta(content, delta):
+    """Применяет ContentDelta к тексту заметки и возвращает новый текст"""
+    if delta.op == "append":
+        return content + delta.text
+    if delta.op == "replace":
+        start = 0 if delta.start is None else delta.start
+        end = len(content) if delta.end is None else delta.end
+        if not 0 <= start <= end <= len(content):
+            raise ValueError(f"Invalid replace range [{start}, {end}) for content of length {len(content)}")
+        return content[:start] + delta.text + content[end:]
+    raise ValueError(f"Unknown delta op '{delta.op}'")
+
+
+def read_note_file(path):
+    """Читает содержимое заметки; для отсутствующего файла возвращает None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def make_preview(content):
+    """Короткое превью без разметки markdown: одна строка до PREVIEW_LENGTH символов"""
+    text = _CODE_FENCE.sub(" ", content[:PREVIEW_LENGTH * 4])
+    text = _WIKI_LINK.sub(r"\1", text)
+    text = _MARKDOWN_LINK.sub(r"\1", text)
+    text = _MARKDOWN_MARKUP.sub("", text)
+    return " ".join(text.split())[:PREVIEW_LENGTH]
+
+
+def note_metadata(content):
+    """Метаданные содержимого, которые хранятся в files, чтобы списки не читали файлы"""
+    data = content.encode('utf-8')
+    return {
+        "size_bytes": len(data),
+        "word_count": len(content.split()),
+        "content_hash": hashlib.sha256(data).hexdigest(),
+        "preview": make_preview(content),
+    }
+
+
+def update_note_metadata(cursor, note_id, content, updated_at=None):
+    """Обновляет метаданные заметки после изменения содержимого (в транзакции вызывающего кода)"""
+    meta = note_metadata(content)
+    cursor.execute("""
+        UPDATE files
+        SET size_bytes = ?, word_count = ?, content_hash = ?, preview = ?, updated_at = ?
+        WHERE id = ?
+    """, (meta["size_bytes"], meta["word_count"], meta["content_hash"], meta["preview"],
+          updated_at or datetime.now().isoformat(), note_id))
+
+
+def drop_note_attachments(cursor, user_id, note_ids):
+    """Удаляет записи вложений заметок (в транзакции вызывающего кода).
+
+    Возвращает хеши их содержимого; после коммита содержимое без ссылок
+    убирает collect_attachment_garbage.
+    """
+    note_ids = list(note_ids)
+    hashes = set()
+    for start in range(0, len(note_ids), 500):
+        part = note_ids[start:start + 500]
+        placeholders = ', '.join('?' * len(part))
+        cursor.execute(f"SELECT DISTINCT content_hash FROM attachments WHERE file_id IN ({placeholders})", part)
+        hashes.update(row[0] for row in cursor.fetchall())
+        cursor.execute(f"DELETE FROM attachments WHERE file_id IN ({placeholders})", part)
+    return hashes
+
+
+def unreferenced_attachment_paths(cursor, user_id, hashes):
+    """Пути содержимого для хешей, на которые не ссылается ни одно вложение"""
+    paths = []
+    for content_hash in hashes:
+        cursor.execute("SELECT 1 FROM attachments WHERE content_hash = ? LIMIT 1", (content_hash,))
+        if not cursor.fetchone():
+            paths.append(get_attachment_path(user_id, content_hash))
+    return paths
+
+
+def remove_attachment_files(paths):
+    """Удаляет содержимое вложений вместе с миниатюрами"""
+    for path in paths:
+        for candidate in (path, thumbnail_path(path)):
+            if os.path.exists(candidate):
+                os.remove(candidate)
+
+
+def collect_attachment_garbage(conn, user_id, hashes):
+    """Удаляет содержимое вложений, на которое не осталось ссылок; вызывается вне транзакции.
+
+    Ссылки перепроверяются и файлы удаляются под блокировкой записи
+    (BEGIN IMMEDIATE). Загрузка того же файла вставляет запись и проверяет
+    наличие содержимого под той же блокировкой, поэтому она либо увидит
+    удаление и положит файл заново, либо ее запись не даст его удалить.
+    """
+    hashes = list(hashes)
+    if not hashes:
+        return 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        paths = unreferenced_attachment_paths(cursor, user_id, hashes)
+        remove_attachment_files(paths)
+        conn.commit()
+    except Exception as e:
+        # Не страшно: содержимое без ссылок уберет backend.maintenance
+        conn.rollback()
+        logger.warning(f"Attachment garbage collection failed for user {user_id}: {e}")
+        return 0
+    return len(paths)
+
+
+def ensure_tags(cursor, tags: Iterable[Tag]) -> List[int]:
+    """Возвращает id тегов, создавая недостающие и обновляя цвет у существующих"""
+    tag_ids = []
+    for tag in tags:
+        # Проверяем, существует ли тег
+        cursor.execute("SELECT id FROM unique_tags WHERE tag = ?", (tag.name,))
+        tag_row = cursor.fetchone()
+
+        if tag_row:
+            tag_id = tag_row[0]
+            # Обновляем цвет, если он задан
+            if tag.color:
+                cursor.execute("UPDATE unique_tags SET color = ? WHERE id = ?",
+                               (tag.color, tag_id))
+        else:
+            # Создаем новый тег
+            color = tag.color or f"#{uuid.uuid4().hex[:6]}"
+            cursor.execute("INSERT INTO unique_tags (tag, color) VALUES (?, ?)",
+                           (tag.name, color))
+            tag_id = cursor.lastrowid
+
+        if tag_id not in tag_ids:
+            tag_ids.append(tag_id)
+    return tag_ids
+
+
+def get_note_tag_ids(cursor, file_id) -> List[int]:
+    """Текущие id тегов заметки"""
+    cursor.execute("SELECT tag_id FROM file_tags WHERE file_id = ?", (file_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def find_tag_ids(cursor, names: Iterable[str]) -> List[int]:
+    """Возвращает id существующих тегов по именам (неизвестные имена пропускаются)"""
+    tag_ids = []
+    for name in names:
+        cursor.execute("SELECT id FROM unique_tags WHERE tag = ?", (name,))
+        tag_row = cursor.fetchone()
+        if tag_row and tag_row[0] not in tag_ids:
+            tag_ids.append(tag_row[0])
+    return tag_ids
+
+
+def link_tags(cursor, file_ids: Iterable[str], tag_ids: Iterable[int]):
+    """Связывает теги с заметками одним executemany, пропуская уже существующие связи"""
+    tag_ids = list(tag_ids)
+    cursor.executemany("""
+        INSERT INTO file_tags (file_id, tag_id)
+        SELECT ?, ?
+        WHERE NOT EXISTS (
+            SELECT 1 FROM file_tags WHERE file_id = ? AND tag_id = ?
+        )
+    """, [(file_id, tag_id, file_id, tag_id) for file_id in file_ids for tag_id in tag_ids])
+
+
+def unlink_tags(cursor, file_ids: Iterable[str], tag_ids: Iterable[int]):
+    """Удаляет связи заметок с тегами"""
+    tag_ids = list(tag_ids)
+    cursor.executemany(
+        "DELETE FROM file_tags WHERE file_id = ? AND tag_id = ?",
+        [(file_id, tag_id) for file_id in file_ids for tag_id in tag_ids]
+    )
@@ -0,0 +1,115 @@
+"""Потоковая отдача файлов с поддержкой HTTP Range.
+
+FileResponse в используемой версии Starlette не умеет Range и заново
+открывает файл по пути. Здесь файл открывается один раз, размер берется из
+того же дескриптора (атомарная замена файла во время отдачи не ломает
+Content-Length), а тело читается кусками по CHUNK_SIZE, поэтому память на
+запрос не зависит от размера файла.
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Разбирает заголовок Range; возвращает (start, end) включительно или None, если его нужно игнорировать.
+
+    Поддерживается один диапазон: "bytes=a-b", "bytes=a-" и "bytes=-n".
+    Для нескольких диапазонов отдается весь файл (это допускает RFC 9110).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(size - suffix, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            end = min(end, size - 1)
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def _iter_file(f, start, length, chunk_size):
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def file_response(
+    request: Request,
+    path: str,
+    media_type: str,
+    etag: Optional[str] = None,
+    headers: Optional[Dict[str, str]] = None,
+    head: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE
+) -> Response:
+    """Отдает файл целиком или диапазоном (из заголовка Range либо первые head байт).
+
+    FileNotFoundError пробрасывается вызывающему коду.
+    """
+    f = open(path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        response_headers = {"Accept-Ranges": "bytes"}
+        if etag:
+            response_headers["ETag"] = f'"{etag}"'
+        response_headers.update(headers or {})
+
+        if etag and request.headers.get("if-none-match") == response_headers["ETag"]:
+            f.close()
+            return Response(status_code=304, headers=response_headers)
+
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == response_headers.get("ETag")):
+            byte_range = parse_range(range_header, size)
+        elif head is not None and head < size:
+            byte_range = (0, head - 1)
+    except BaseException:
+        f.close()
+        raise
+
+    if byte_range is None:
+        response_headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            _iter_file(f, 0, size, chunk_size), media_type=media_type, headers=response_headers
+        )
+
+    start, end = byte_range
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response_headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _iter_file(f, start, end - start + 1, chunk_size),
+        status_code=206, media_type=media_type, headers=response_headers
+    )
@@ -0,0 +1,96 @@
+"""Миниатюры изображений-вложений в пуле процессов.
+
+Декодирование и масштабирование изображений нагружают CPU и держат GIL,
+поэтому выполняются в отдельных процессах и не на пути запроса: загрузка
+вложения только ставит задачу в очередь. Модуль не импортирует ничего из
+backend, но процесс пула (spawn) при старте все равно заново импортирует
+главный модуль (server.py как __mp_main__): FastAPI, бот и роутеры. Это
+стоит долей секунды на процесс и происходит один раз - процессы создаются
+при первой миниатюре и живут до остановки сервера. Поэтому в server.py при
+импорте нет побочных эффектов: БД и фоновые службы запускаются в startup.
+
+Pillow - необязательная зависимость: без нее миниатюры не создаются.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - необязательная зависимость
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAILS_AVAILABLE = Image is not None
+
+# Число процессов для миниатюр и максимальный размер стороны миниатюры
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "256"))
+
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def thumbnail_path(blob_path):
+    return blob_path + THUMBNAIL_SUFFIX
+
+
+def make_thumbnail(source, destination, size=THUMBNAIL_SIZE):
+    """Создает JPEG-миниатюру (выполняется в дочернем процессе)"""
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        directory, name = os.path.split(destination)
+        temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            image.save(temp_path, "JPEG", quality=85)
+            os.replace(temp_path, destination)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return destination
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: форк многопоточного сервера может унаследовать захваченные блокировки
+            _pool = ProcessPoolExecutor(
+                max_workers=max(THUMBNAIL_WORKERS, 1),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _log_failure(future):
+    error = future.exception()
+    if error:
+        logger.warning(f"Thumbnail generation failed: {error}")
+
+
+def schedule_thumbnail(blob_path, content_type):
+    """Ставит создание миниатюры в очередь; возвращает future или None, если миниатюра не нужна"""
+    if not THUMBNAILS_AVAILABLE or not (content_type or "").startswith("image/"):
+        return None
+    destination = thumbnail_path(blob_path)
+    if os.path.exists(destination):
+        return None
+    future = _get_pool().submit(make_thumbnail, blob_path, destination)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def shutdown_thumbnail_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
@@ -0,0 +1,289 @@
+"""Отложенная запись (write-behind) содержимого заметок.
+
+Сохранение заметки подтверждается сразу после того, как новое содержимое
+записано в таблицу note_journal пользовательской БД (SQLite в режиме WAL,
+коммит durable). Сам файл содержимого записывается позже: когда заметку
+перестали редактировать дольше debounce-интервала, когда запись висит в
+буфере дольше max_delay, или когда в буфере накопилось слишком много данных.
+Чтение идет через read_note_content(), которая сначала смотрит в журнал,
+поэтому клиент всегда видит последнюю версию. После падения процесса
+незаписанные версии остаются в журнале и сбрасываются в файлы при старте
+(recover()). Файлы содержимого адресуются хешем и не перезаписываются
+(см. storage.acquire_blob), запись каждого файла атомарна.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from backend.database import get_db_connection, list_user_ids
+from backend.storage import (
+    read_note_file, remove_note_file, recover_temp_files,
+    content_hash_of, acquire_blob, write_blobs, release_blob, collect_blob_garbage
+)
+from backend.revisions import record_revision
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд заметка должна "отлежаться" без изменений перед записью в файл
+FLUSH_DEBOUNCE = float(os.environ.get("NOTES_FLUSH_DEBOUNCE", "2.0"))
+# Максимальная задержка записи при непрерывном редактировании
+FLUSH_MAX_DELAY = float(os.environ.get("NOTES_FLUSH_MAX_DELAY", "30.0"))
+# Объем буфера, при превышении которого запись начинается немедленно
+BUFFER_MAX_BYTES = int(os.environ.get("NOTES_BUFFER_MAX_BYTES", str(8 * 1024 * 1024)))
+
+
+def journal_content(cursor, note_id, content):
+    """Записывает новую версию содержимого в журнал (в транзакции вызывающего кода)"""
+    cursor.execute("""
+        INSERT INTO note_journal (file_id, content, seq, updated_at)
+        VALUES (?, ?, 1, ?)
+        ON CONFLICT(file_id) DO UPDATE SET
+            content = excluded.content,
+            seq = note_journal.seq + 1,
+            updated_at = excluded.updated_at
+    """, (note_id, content, datetime.now().isoformat()))
+
+
+def get_journaled_content(cursor, note_id):
+    """Содержимое заметки из журнала или None, если незаписанной версии нет"""
+    cursor.execute("SELECT content FROM note_journal WHERE file_id = ?", (note_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def read_note_content(cursor, note_id, path):
+    """Актуальное содержимое заметки: версия из журнала, иначе файл"""
+    content = get_journaled_content(cursor, note_id)
+    if content is not None:
+        return content
+    content = read_note_file(path)
+    if content is None:
+        # Между чтением path и файла заметку могли сбросить из журнала в новый файл
+        # содержимого, а прежний - удалить как не используемый: читаем еще раз
+        cursor.execute("SELECT path FROM files WHERE id = ?", (note_id,))
+        row = cursor.fetchone()
+        if row and row[0] != path:
+            return read_note_content(cursor, note_id, row[0])
+    return content
+
+
+def drop_journal(cursor, note_ids):
+    """Удаляет незаписанные версии (например, при удалении заметок)"""
+    cursor.executemany("DELETE FROM note_journal WHERE file_id = ?", [(i,) for i in note_ids])
+
+
+class WriteBehindBuffer:
+    """Буфер последних версий заметок с фоновым сбросом в файлы"""
+
+    def __init__(self, debounce=FLUSH_DEBOUNCE, max_delay=FLUSH_MAX_DELAY, max_bytes=BUFFER_MAX_BYTES):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        # (user_id, note_id) -> {"content", "size", "first", "last"}
+        self._pending = {}
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def stage(self, user_id, note_id, content):
+        """Ставит уже записанную в журнал версию в очередь на запись в файл.
+
+        Вызывается после коммита транзакции, в которой был journal_content().
+        """
+        now = time.monotonic()
+        size = len(content.encode('utf-8'))
+        with self._lock:
+            entry = self._pending.get((user_id, note_id))
+            if entry:
+                self._pending_bytes -= entry["size"]
+                entry.update(content=content, size=size, last=now)
+            else:
+                self._pending[(user_id, note_id)] = {
+                    "content": content, "size": size, "first": now, "last": now
+                }
+            self._pending_bytes += size
+            under_pressure = self._pending_bytes > self.max_bytes
+        if under_pressure:
+            self._wakeup.set()
+
+    def discard(self, user_id, note_ids):
+        """Убирает из очереди удаленные заметки"""
+        with self._lock:
+            for note_id in note_ids:
+                entry = self._pending.pop((user_id, note_id), None)
+                if entry:
+                    self._pending_bytes -= entry["size"]
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _due_keys(self, force=False):
+        """Выбирает заметки, которые пора записать"""
+        now = time.monotonic()
+        with self._lock:
+            if force:
+                return list(self._pending)
+            due = [
+                key for key, entry in self._pending.items()
+                if now - entry["last"] >= self.debounce or now - entry["first"] >= self.max_delay
+            ]
+            if self._pending_bytes > self.max_bytes:
+                # Под давлением сбрасываем самые старые записи, пока не уложимся в лимит
+                excess = self._pending_bytes - self.max_bytes
+                for key, entry in sorted(self._pending.items(), key=lambda item: item[1]["first"]):
+                    if excess <= 0:
+                        break
+                    if key not in due:
+                        due.append(key)
+                    excess -= entry["size"]
+            return due
+
+    def flush(self, force=False):
+        """Записывает в файлы все заметки, которым пора; возвращает число записанных"""
+        keys = self._due_keys(force)
+        by_user = {}
+        for user_id, note_id in keys:
+            by_user.setdefault(user_id, []).append(note_id)
+
+        flushed = 0
+        for user_id, note_ids in by_user.items():
+            self.discard(user_id, note_ids)
+            try:
+                flushed += flush_user_journal(user_id, note_ids)
+            except Exception as e:
+                logger.error(f"Write-behind flush failed for user {user_id}: {e}")
+        return flushed
+
+    def flush_note(self, user_id, note_id):
+        """Немедленно записывает одну заметку (например, перед отдачей файла напрямую)"""
+        self.discard(user_id, [note_id])
+        return flush_user_journal(user_id, [note_id])
+
+    def _run(self):
+        interval = max(min(self.debounce, 1.0), 0.05)
+        while not self._stopping:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        """Запускает фоновый поток сброса"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="notes-write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и записывает все, что осталось в буфере"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush(force=True)
+
+
+def flush_user_journal(user_id, note_ids=None):
+    """Переносит версии из журнала пользователя в файлы содержимого.
+
+    Новая версия записывается как файл по хешу (если такого содержимого еще
+    нет), запись files переключается на него, а ссылка на прежний файл
+    освобождается; версия записывается в историю ревизий. Строка журнала
+    удаляется, только если за время записи в нее не попала более новая
+    версия (проверка по seq).
+    """
+    conn = get_db_connection(user_id)
+    cursor = conn.cursor()
+    flushed = 0
+    released = False
+    try:
+        if note_ids is None:
+            cursor.execute("SELECT file_id FROM note_journal")
+            note_ids = [row[0] for row in cursor.fetchall()]
+
+        for note_id in note_ids:
+            # Файл содержимого пишется (с fsync) до блокировки записи БД: иначе
+            # запросы к БД пользователя ждали бы диск
+            cursor.execute("""
+                SELECT note_journal.content, files.path FROM note_journal
+                LEFT JOIN files ON files.id = note_journal.file_id
+                WHERE note_journal.file_id = ?
+            """, (note_id,))
+            row = cursor.fetchone()
+            if not row:
+                continue
+            if row[1]:
+                write_blobs(user_id, [row[0]])
+
+            # Чтение и перенос - одна транзакция записи: ту же заметку может
+            # одновременно сбрасывать другой поток или процесс. Если версия
+            # за это время сменилась, acquire_blob допишет ее файл сам
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT note_journal.content, note_journal.seq, files.path, files.blob_hash
+                FROM note_journal
+                LEFT JOIN files ON files.id = note_journal.file_id
+                WHERE note_journal.file_id = ?
+            """, (note_id,))
+            row = cursor.fetchone()
+            if not row:
+                conn.rollback()
+                continue
+            content, seq, path, blob_hash = row
+            legacy_path = None
+            if path:
+                new_hash = content_hash_of(content)
+                if new_hash != blob_hash:
+                    new_hash, new_path = acquire_blob(cursor, user_id, content, new_hash)
+                    cursor.execute(
+                        "UPDATE files SET path = ?, blob_hash = ? WHERE id = ?", (new_path, new_hash, note_id)
+                    )
+                    if blob_hash:
+                        release_blob(cursor, blob_hash)
+                        released = True
+                    else:
+                        # Старый файл <id>.md заменяется содержимым по хешу
+                        legacy_path = path
+                # Каждая записанная в файл версия становится ревизией истории
+                record_revision(cursor, note_id, content, new_hash)
+                flushed += 1
+            cursor.execute("DELETE FROM note_journal WHERE file_id = ? AND seq = ?", (note_id, seq))
+            conn.commit()
+            if legacy_path:
+                remove_note_file(legacy_path)
+
+        if released:
+            collect_blob_garbage(conn, user_id)
+    finally:
+        conn.close()
+    return flushed
+
+
+def recover(temp_min_age=0):
+    """Сбрасывает в файлы версии, оставшиеся в журналах после прошлого запуска.
+
+    Безопасно и при работающих других процессах: строка журнала удаляется,
+    только если не изменилась (seq), а временные файлы моложе temp_min_age
+    секунд не трогаются.
+    """
+    # Сначала убираем недописанные временные файлы прерванных атомарных записей
+    recover_temp_files(min_age=temp_min_age)
+    recovered = 0
+    for user_id in list_user_ids():
+        try:
+            recovered += flush_user_journal(user_id)
+        except Exception as e:
+            logger.error(f"Journal recovery failed for user {user_id}: {e}")
+    if recovered:
+        logger.info(f"Recovered {recovered} note(s) from write-behind journal")
+    return recovered
+
+
+# Общий буфер процесса
+write_buffer = WriteBehindBuffer()
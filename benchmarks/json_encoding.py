@@ -0,0 +1,94 @@
+"""Микробенчмарк сериализации больших ответов: дерево и граф на 10k заметок.
+
+Сравнивает путь FastAPI по умолчанию (jsonable_encoder + json.dumps в
+JSONResponse) с backend.fastjson (orjson без предварительного обхода, и
+его запасной вариант на стандартном json).
+
+Запуск из корня репозитория:
+python -m benchmarks.json_encoding [--rows 10000] [--repeat 20]
+"""
+import argparse
+import json
+import random
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from backend import fastjson
+
+
+def make_tree(rows):
+    """Ответ /api/tree в том же виде, что строит _get_full_tree"""
+    folder_ids = [str(uuid.uuid4()) for _ in range(max(rows // 20, 1))]
+    folders = [{
+        "id": folder_id,
+        "name": f"Папка {i}",
+        "parent_id": random.choice(folder_ids[:i]) if i else None,
+        "color": "#1E90FF",
+        "position": i,
+        "order_key": f"{i:010d}",
+        "child_count": random.randint(0, 5),
+        "note_count": random.randint(0, 50),
+    } for i, folder_id in enumerate(folder_ids)]
+    start = datetime(2024, 1, 1)
+    files = [{
+        "id": str(uuid.uuid4()),
+        "name": f"Заметка номер {i}",
+        "folder_id": random.choice(folder_ids),
+        "parent_id": None,
+        "updated_at": (start + timedelta(minutes=i)).isoformat(),
+        "size_bytes": random.randint(10, 50000),
+        "word_count": random.randint(1, 5000),
+    } for i in range(rows)]
+    return {"folders": folders, "files": files}
+
+
+def make_graph(rows):
+    """Ответ /api/graph: узлы и ребра (по родителям и тегам)"""
+    ids = [str(uuid.uuid4()) for _ in range(rows)]
+    nodes = [{"id": note_id, "name": f"Заметка {i}", "color": "#1E90FF", "folder_id": None}
+             for i, note_id in enumerate(ids)]
+    edges = [{"source": ids[i], "target": ids[i + 1], "relation": "tag", "tag": f"tag{i % 50}", "color": "#888888"}
+             for i in range(rows - 1)]
+    return {"nodes": nodes, "edges": edges}
+
+
+def fastapi_default(payload):
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def stdlib_json(payload):
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def bench(name, payload, repeat):
+    encoders = [("fastapi default", fastapi_default), ("stdlib json", stdlib_json)]
+    if fastjson.ORJSON_AVAILABLE:
+        encoders.append(("fastjson (orjson)", fastjson.dumps))
+    assert all(json.loads(encode(payload)) == payload for _, encode in encoders)
+
+    size = len(fastjson.dumps(payload))
+    print(f"{name}: {size / 1024:.0f} KiB")
+    baseline = None
+    for label, encode in encoders:
+        best = min(timeit.repeat(lambda: encode(payload), number=1, repeat=repeat)) * 1000
+        baseline = baseline or best
+        print(f"  {label:<20} {best:8.2f} ms  x{baseline / best:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON encoding benchmark")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    bench(f"tree ({args.rows} notes)", make_tree(args.rows), args.repeat)
+    bench(f"graph ({args.rows} nodes)", make_graph(args.rows), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
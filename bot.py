@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import APIRouter, FastAPI, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import json
@@ -6,19 +6,30 @@ import hashlib
 import hmac
 import time
 import urllib.parse
+import html
 from typing import Optional, Dict, Any, List
 import logging
 from pydantic import BaseModel
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo,
+    InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    InlineQueryHandler,
     filters,
     ContextTypes,
     CallbackQueryHandler
 )
 
+from backend.auth import DEV_USER
+from backend.notifications import get_bot, close_bot, outbox
+from backend.quick_search import recent_notes, find_notes
+from backend.inbox import inbox_writer, INBOX_FOLDER_NAME
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -34,9 +45,32 @@ if not TELEGRAM_BOT_TOKEN:
 # URL вашего приложения, развернутого на хостинге
 WEBAPP_URL = os.environ.get("WEBAPP_URL", "https://example.com/app")
 
+# Получение обновлений: "polling" или "webhook" (см. telegram_webhook)
+BOT_UPDATE_MODE = os.environ.get("BOT_UPDATE_MODE", "polling").lower()
+# Публичный адрес сервера для вебхука (по умолчанию - origin WEBAPP_URL)
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+# Секрет вебхука; по умолчанию выводится из токена, чтобы у всех процессов был один и тот же
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET") or (
+    hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()[:32] if TELEGRAM_BOT_TOKEN else ""
+)
+# Сколько обновлений обрабатывается одновременно и сколько может ждать в очереди
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "8"))
+BOT_MAX_PENDING_UPDATES = int(os.environ.get("BOT_MAX_PENDING_UPDATES", "256"))
+
 # Режим разработки (можно переключать в зависимости от среды)
 DEV_MODE = os.environ.get("DEV_MODE", "False").lower() == "true"
 
+# Сколько заметок показывать в /notes и поиске и сколько результатов в inline-режиме
+NOTES_LIST_LIMIT = 10
+INLINE_RESULTS_LIMIT = 20
+# Сколько секунд Telegram может кэшировать ответ на inline-запрос
+INLINE_CACHE_TIME = 5
+
+# Сохранять обычные и пересланные сообщения заметками во "Входящие" (backend/inbox.py)
+BOT_QUICK_CAPTURE = os.environ.get("BOT_QUICK_CAPTURE", "False").lower() == "true"
+# Длина названия заметки из первой строки сообщения
+CAPTURE_NAME_LENGTH = 60
+
 # Инициализация FastAPI
 app = FastAPI(title="Notes Manager Bot API")
 
@@ -49,6 +83,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def stop_outbox():
+    """Отправляет накопленные уведомления и закрывает соединения с Telegram"""
+    await outbox.stop()
+    await close_bot()
+
 # Модели данных
 class WebAppData(BaseModel):
     user_id: int
@@ -158,6 +198,20 @@ def register_user_if_needed(user_data: Dict):
         logger.error(f"Ошибка регистрации пользователя: {str(e)}")
         return False
 
+def notes_user_id(user) -> str:
+    """ID пользовательской БД для пользователя Telegram (в режиме разработки - общий, как в API)"""
+    return DEV_USER["id"] if DEV_MODE else str(user.id)
+
+def format_notes_list(notes) -> str:
+    """Список заметок для сообщения (HTML): название и фрагмент текста"""
+    lines = []
+    for note in notes:
+        line = f"🔹 <b>{html.escape(note['name'] or 'Без названия')}</b>"
+        if note["snippet"]:
+            line += f"\n{html.escape(note['snippet'])}"
+        lines.append(line)
+    return "\n\n".join(lines)
+
 def extract_user_from_init_data(init_data: str) -> Optional[Dict]:
     """Извлекает данные пользователя из initData Telegram"""
     try:
@@ -230,16 +284,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/help - Показать эту справку\n"
         "/notes - Показать список последних заметок\n"
         "/new - Создать новую заметку\n\n"
-        "Или нажмите на кнопку ниже, чтобы открыть приложение:",
+        + (f"Текст и пересланные сообщения сохраняются в папку \"{INBOX_FOLDER_NAME}\".\n\n" if BOT_QUICK_CAPTURE else "")
+        + "Или нажмите на кнопку ниже, чтобы открыть приложение:",
         reply_markup=reply_markup
     )
 
 async def notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает список последних заметок пользователя."""
-    user_id = update.effective_user.id
+    user_id = notes_user_id(update.effective_user)
     
-    # Заглушка для демонстрации, в реальном приложении здесь будет запрос к базе данных
-    # для получения фактических данных о заметках пользователя
     keyboard = [
         [InlineKeyboardButton(
             "📝 Просмотреть все заметки", 
@@ -248,11 +301,14 @@ async def notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
-        "Ваши последние заметки:\n\n"
-        "🔹 Для доступа к полному списку заметок используйте кнопку ниже:",
-        reply_markup=reply_markup
-    )
+    # Последние заметки берутся из кэша (backend/quick_search.py), без чтения файлов
+    notes = await recent_notes(user_id, limit=NOTES_LIST_LIMIT)
+    if notes:
+        text = "Ваши последние заметки:\n\n" + format_notes_list(notes)
+    else:
+        text = "У вас пока нет заметок.\n\n🔹 Создайте первую в приложении:"
+    
+    await update.message.reply_html(text, reply_markup=reply_markup)
 
 async def new_note_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда для создания новой заметки."""
@@ -269,13 +325,55 @@ async def new_note_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         reply_markup=reply_markup
     )
 
+def forward_origin(message) -> Optional[str]:
+    """Откуда переслано сообщение (None, если оно не пересланное)"""
+    if message.forward_from_chat:
+        chat = message.forward_from_chat
+        origin = chat.title or (f"@{chat.username}" if chat.username else "канал")
+        if chat.username and message.forward_from_message_id:
+            origin += f" (https://t.me/{chat.username}/{message.forward_from_message_id})"
+        return origin
+    if message.forward_from:
+        return message.forward_from.full_name
+    if message.forward_sender_name:
+        return message.forward_sender_name
+    return None
+
+def capture_note(message):
+    """Название и содержимое заметки из сообщения"""
+    text = message.text or message.caption or ""
+    first_line = next((line.strip() for line in text.splitlines() if line.strip()), "")
+    name = first_line[:CAPTURE_NAME_LENGTH] + ("…" if len(first_line) > CAPTURE_NAME_LENGTH else "")
+    origin = forward_origin(message)
+    if origin:
+        text += f"\n\n— переслано от {origin}"
+    return name or "Без названия", text
+
+async def capture_message(update: Update) -> None:
+    """Ставит сообщение в очередь на сохранение во "Входящие".
+
+    Ответ отправляется через очередь уведомлений после записи, поэтому
+    серия пересланных сообщений получает одно сводное подтверждение.
+    """
+    message = update.message
+    name, content = capture_note(message)
+    chat_id = message.chat_id
+    
+    def on_saved(note_id):
+        outbox.notify(chat_id, "note_captured", f"📥 Заметка '{name}' сохранена во \"{INBOX_FOLDER_NAME}\"", name)
+    
+    inbox_writer.capture(notes_user_id(update.effective_user), name, content, on_saved)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик обычных текстовых сообщений."""
-    if update.message.text:
+    """Обработчик обычных текстовых и пересланных сообщений."""
+    text = update.message.text or update.message.caption
+    if text:
         # Проверяем, может быть это команда поиска по заметкам
-        if update.message.text.startswith("найти ") or update.message.text.startswith("поиск "):
-            query = update.message.text.split(" ", 1)[1]
+        if update.message.text and not update.message.forward_date and (text.startswith("найти ") or text.startswith("поиск ")):
+            query = text.split(" ", 1)[1]
             await search_notes(update, query)
+        elif BOT_QUICK_CAPTURE:
+            await capture_message(update)
         else:
             await help_command(update, context)
 
@@ -284,16 +382,45 @@ async def search_notes(update: Update, query: str) -> None:
     keyboard = [
         [InlineKeyboardButton(
             "📝 Открыть результаты поиска", 
-            web_app=WebAppInfo(url=f"{WEBAPP_URL}?search={query}")
+            web_app=WebAppInfo(url=f"{WEBAPP_URL}?search={urllib.parse.quote(query)}")
         )]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
-        f"Для просмотра результатов поиска по запросу \"{query}\"\n"
-        f"нажмите на кнопку ниже:",
-        reply_markup=reply_markup
-    )
+    notes = await find_notes(notes_user_id(update.effective_user), query, limit=NOTES_LIST_LIMIT)
+    if notes:
+        text = f"Найдено по запросу \"{html.escape(query)}\":\n\n" + format_notes_list(notes)
+    else:
+        text = f"По запросу \"{html.escape(query)}\" ничего не найдено."
+    
+    await update.message.reply_html(text, reply_markup=reply_markup)
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Inline-режим (@бот запрос): последние или найденные заметки с фрагментами текста."""
+    inline_query = update.inline_query
+    try:
+        notes = await find_notes(notes_user_id(inline_query.from_user), inline_query.query, limit=INLINE_RESULTS_LIMIT)
+    except Exception as e:
+        logger.error(f"Inline search failed: {e}")
+        notes = []
+    
+    results = [
+        InlineQueryResultArticle(
+            id=note["id"],
+            title=note["name"] or "Без названия",
+            description=note["snippet"] or None,
+            input_message_content=InputTextMessageContent(
+                format_notes_list([note]),
+                parse_mode=ParseMode.HTML
+            ),
+            # Кнопки WebApp в inline-сообщениях недоступны, поэтому ссылка
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                "📝 Открыть заметку", url=f"{WEBAPP_URL}?note={note['id']}"
+            )]])
+        )
+        for note in notes
+    ]
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик данных, отправленных из веб-приложения."""
@@ -375,39 +502,25 @@ async def receive_webapp_data(data: WebAppData):
             logger.info(f"[DEV] Получены данные от веб-приложения: {data}")
             return {"success": True, "message": "Данные получены (режим разработки)", "data": None}
         
-        # Отправляем сообщение пользователю через бота
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        # Сообщение отправит общая очередь (backend/notifications.py) с учетом
+        # лимитов Telegram; серия одинаковых уведомлений придет одним сообщением
+        note_name = data.data.get("note_name", "")
         
         if action == "note_created":
             # Обработка создания заметки
-            note_name = data.data.get("note_name", "")
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"✅ Заметка '{note_name}' успешно создана!"
-            )
+            outbox.notify(user_id, action, f"✅ Заметка '{note_name}' успешно создана!", note_name)
         
         elif action == "note_updated":
             # Обработка обновления заметки
-            note_name = data.data.get("note_name", "")
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"✅ Заметка '{note_name}' успешно обновлена!"
-            )
+            outbox.notify(user_id, action, f"✅ Заметка '{note_name}' успешно обновлена!", note_name)
         
         elif action == "note_deleted":
             # Обработка удаления заметки
-            note_name = data.data.get("note_name", "")
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"🗑️ Заметка '{note_name}' удалена!"
-            )
+            outbox.notify(user_id, action, f"🗑️ Заметка '{note_name}' удалена!", note_name)
         
         else:
             # Общее сообщение для неизвестных действий
-            await bot.send_message(
-                chat_id=user_id,
-                text="✅ Операция выполнена успешно!"
-            )
+            outbox.notify(user_id, action, "✅ Операция выполнена успешно!")
         
         return {"success": True, "message": "Данные успешно обработаны", "data": None}
     
@@ -415,25 +528,37 @@ async def receive_webapp_data(data: WebAppData):
         logger.error(f"Error processing webapp data: {e}")
         return {"success": False, "message": f"Ошибка: {str(e)}", "data": None}
 
+def build_application(updater=True):
+    """Создает Application с обработчиками команд на общем клиенте процесса."""
+    # Бот использует общий клиент процесса (тот же пул соединений, что и уведомления)
+    builder = Application.builder().bot(get_bot(TELEGRAM_BOT_TOKEN))
+    if not updater:
+        # Обновления приходят в update_queue из вебхука, обработчики выполняются
+        # параллельно, но не больше BOT_CONCURRENT_UPDATES одновременно
+        builder = builder.updater(None).concurrent_updates(BOT_CONCURRENT_UPDATES)
+    application = builder.build()
+    
+    # Регистрация обработчиков
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("notes", notes_command))
+    application.add_handler(CommandHandler("new", new_note_command))
+    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
+    application.add_handler(MessageHandler((filters.TEXT | filters.CAPTION) & ~filters.COMMAND, handle_message))
+    # Inline-режим нужно включить у @BotFather (/setinline)
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    return application
+
 async def run_bot():
-    """Запускает Telegram бота."""
+    """Запускает Telegram бота в режиме polling."""
     if not TELEGRAM_BOT_TOKEN:
         logger.warning("TELEGRAM_BOT_TOKEN не установлен. Бот не будет запущен.")
         return None
         
     try:
-        # Используем токен из переменных окружения
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        application = build_application()
         
-        # Регистрация обработчиков
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("notes", notes_command))
-        application.add_handler(CommandHandler("new", new_note_command))
-        application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        
-        # Запуск бота в режиме polling - ИЗМЕНЕНО!
+        # Запуск бота в режиме polling (start_polling сам снимает вебхук, если он был)
         await application.initialize()
         await application.start()
         await application.updater.start_polling()
@@ -444,7 +569,133 @@ async def run_bot():
         logger.error(f"Error starting bot: {e}")
         return None
 
+async def stop_bot(application):
+    """Останавливает опрос (если он есть) и закрывает соединения бота."""
+    try:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+    except Exception as e:
+        logger.error(f"Error stopping bot: {e}")
+
+# Режим вебхука: Telegram присылает обновления на /api/telegram/webhook/<секрет>
+# основного приложения, и их обрабатывает любой процесс API
+webhook_router = APIRouter(prefix="/api/telegram", tags=["telegram"])
+webhook_application = None
+
+def webhook_url():
+    """Публичный адрес вебхука (TELEGRAM_WEBHOOK_URL или origin WEBAPP_URL)"""
+    base = TELEGRAM_WEBHOOK_URL
+    if not base:
+        parsed = urllib.parse.urlsplit(WEBAPP_URL)
+        base = f"{parsed.scheme}://{parsed.netloc}"
+    return f"{base.rstrip('/')}/api/telegram/webhook/{TELEGRAM_WEBHOOK_SECRET}"
+
+async def start_webhook():
+    """Запускает обработку обновлений из вебхука в этом процессе."""
+    global webhook_application
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN не установлен. Вебхук не будет принимать обновления.")
+        return None
+    try:
+        application = build_application(updater=False)
+        await application.initialize()
+        await application.start()
+        webhook_application = application
+        return application
+    except Exception as e:
+        logger.error(f"Error starting webhook bot: {e}")
+        return None
+
+async def stop_webhook():
+    global webhook_application
+    if webhook_application:
+        application, webhook_application = webhook_application, None
+        await stop_bot(application)
+
+async def register_webhook():
+    """Сообщает Telegram адрес вебхука (достаточно одного процесса)."""
+    try:
+        await get_bot(TELEGRAM_BOT_TOKEN).set_webhook(
+            url=webhook_url(),
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            max_connections=BOT_CONCURRENT_UPDATES,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info("Telegram webhook registered")
+        return True
+    except Exception as e:
+        logger.error(f"Error registering webhook: {e}")
+        return False
+
+@webhook_router.post("/webhook/{secret}")
+async def telegram_webhook(secret: str, request: Request):
+    """Принимает обновление от Telegram и ставит его в очередь Application."""
+    # Секрет проверяется и в пути, и в заголовке, который Telegram добавляет по secret_token
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if (
+        webhook_application is None
+        or not hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET)
+        or not hmac.compare_digest(header, TELEGRAM_WEBHOOK_SECRET)
+    ):
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    # Обработчики не успевают: Telegram повторит доставку позже
+    if webhook_application.update_queue.qsize() >= BOT_MAX_PENDING_UPDATES:
+        raise HTTPException(status_code=503, detail="Too many pending updates")
+    
+    try:
+        update = Update.de_json(await request.json(), webhook_application.bot)
+    except Exception as e:
+        logger.error(f"Invalid webhook update: {e}")
+        raise HTTPException(status_code=400, detail="Invalid update")
+    
+    # Отвечаем сразу: обработчик выполнится в Application этого процесса
+    await webhook_application.update_queue.put(update)
+    return {"ok": True}
+
+async def run_standalone_bot():
+    """Запускает бота отдельным процессом (BOT_MODE=standalone) до сигнала остановки."""
+    import asyncio
+    import signal
+    from backend.cluster import LeaderLock, LEADER_RETRY_INTERVAL, EVENT_RELAY
+    from backend.events import attach_relay, detach_relay
+    from backend.relay import EventRelay
+
+    if BOT_UPDATE_MODE == "webhook":
+        # Обновления из вебхука принимают процессы API (server.py), отдельный процесс не нужен
+        logger.error("BOT_UPDATE_MODE=webhook обслуживается процессами API, запустите server.py")
+        return
+
+    # Опрашивать Telegram может только один процесс
+    lock = LeaderLock("bot")
+    while not lock.try_acquire():
+        logger.info("Бот уже запущен другим процессом, ожидание...")
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+    # Версии данных для кэша заметок (backend/quick_search.py) приходят из процессов API
+    if EVENT_RELAY:
+        attach_relay(EventRelay())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        application = await run_bot()
+        if application:
+            await stop.wait()
+            # Сначала дописываем "Входящие": подтверждения уходят через очередь уведомлений
+            await inbox_writer.stop()
+            await outbox.stop()
+            await stop_bot(application)
+    finally:
+        detach_relay()
+        await close_bot()
+        lock.release()
+
 # Если файл запущен напрямую
 if __name__ == "__main__":
     import asyncio
-    asyncio.run(run_bot())
\ No newline at end of file
+    asyncio.run(run_standalone_bot())
\ No newline at end of file
@@ -0,0 +1,52 @@
+// Создает .br и .gz версии файлов сборки рядом с оригиналами.
+// Сервер (backend/compression.py) отдает их вместо оригинала, если браузер
+// принимает сжатие, поэтому сжимать статику на каждый запрос не нужно.
+// Запускается автоматически после `npm run build` (postbuild).
+const fs = require('fs');
+const path = require('path');
+const zlib = require('zlib');
+
+const BUILD_DIR = path.resolve(__dirname, '..', 'build');
+const EXTENSIONS = new Set(['.js', '.css', '.html', '.svg', '.json', '.txt', '.map', '.ico']);
+// Маленькие файлы почти не сжимаются
+const MIN_SIZE = 1024;
+
+const walk = (dir) => fs.readdirSync(dir, { withFileTypes: true }).flatMap(entry => {
+  const fullPath = path.join(dir, entry.name);
+  return entry.isDirectory() ? walk(fullPath) : [fullPath];
+});
+
+const compressors = {
+  '.br': data => zlib.brotliCompressSync(data, {
+    params: {
+      [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+      [zlib.constants.BROTLI_PARAM_SIZE_HINT]: data.length,
+    },
+  }),
+  '.gz': data => zlib.gzipSync(data, { level: zlib.constants.Z_BEST_COMPRESSION }),
+};
+
+if (!fs.existsSync(BUILD_DIR)) {
+  console.error(`Build directory not found: ${BUILD_DIR}`);
+  process.exit(1);
+}
+
+let original = 0;
+let compressed = 0;
+for (const file of walk(BUILD_DIR)) {
+  if (!EXTENSIONS.has(path.extname(file))) continue;
+  const data = fs.readFileSync(file);
+  if (data.length < MIN_SIZE) continue;
+  for (const [suffix, compress] of Object.entries(compressors)) {
+    const output = compress(data);
+    // Версия, которая не меньше оригинала, только мешала бы
+    if (output.length >= data.length) continue;
+    fs.writeFileSync(file + suffix, output);
+    if (suffix === '.br') {
+      original += data.length;
+      compressed += output.length;
+    }
+  }
+}
+
+console.log(`Precompressed build: ${original} -> ${compressed} bytes (brotli)`);
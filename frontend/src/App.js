@@ -1,14 +1,15 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Box, CircularProgress, CssBaseline, Button } from '@mui/material';
 import { ThemeProvider, createTheme } from '@mui/material/styles';
 import { 
-  fetchTreeData, fetchGraphData, createFolderInParent, updateFolder, 
-  deleteFolder, deleteNote, fetchNote, updateNote, moveFolder 
+  fetchFolders, fetchTreeLevelAll, fetchGraphData, createFolderInParent, updateFolder, 
+  deleteFolder, deleteNote, patchNote, moveFolder 
 } from './services/api';
 import { 
   initTelegramApp, getThemeParams, isRunningInTelegram, 
   getUserId, showNotification, hideMainButton 
 } from './services/telegramService';
+import { applyChangeEvent, mergeTreeLevel, subscribeChanges } from './services/changeEvents';
 import NotesExplorer from './components/NotesExplorer';
 import NoteEditor from './components/NoteEditor';
 import GraphView from './components/GraphView';
@@ -64,6 +65,26 @@ function App() {
   const [folderToEdit, setFolderToEdit] = useState(null);
   const [telegramTheme, setTelegramTheme] = useState(null);
   const [inTelegram, setInTelegram] = useState(false);
+  // Растет при изменениях с сервера, чтобы граф перезагрузился (с задержкой, пачкой)
+  const [graphVersion, setGraphVersion] = useState(0);
+  // Пока поток изменений подключен, дерево обновляется событиями, а не перезапросом
+  const liveUpdates = useRef(false);
+  // Уровни дерева, содержимое которых загружено (null - корень); остальные грузятся при раскрытии папки
+  const loadedLevels = useRef(new Set([null]));
+  
+  // Все папки (для стрелок раскрытия и диалогов выбора папки) и заметки загруженных уровней
+  const loadTree = () => Promise.all([
+    fetchFolders(),
+    ...Array.from(loadedLevels.current, parentId => fetchTreeLevelAll(parentId).catch(error => {
+      // Папку могли удалить: ее уровень больше не перечитываем
+      console.error("Error fetching folder contents:", error);
+      loadedLevels.current.delete(parentId);
+      return { folders: [], files: [] };
+    }))
+  ]).then(([folders, ...levels]) => ({
+    folders,
+    files: levels.flatMap(level => level.files)
+  }));
   
   // Инициализация Telegram WebApp и загрузка данных
   useEffect(() => {
@@ -80,8 +101,8 @@ function App() {
       hideMainButton();
     }
     
-    // Загружаем данные дерева
-    fetchTreeData()
+    // Загружаем папки и корневой уровень дерева
+    loadTree()
       .then(data => {
         setTreeData(data);
         setLoading(false);
@@ -95,6 +116,41 @@ function App() {
       });
   }, []);
   
+  // Подписка на изменения заметок и папок (в том числе из других сессий)
+  useEffect(() => {
+    let graphTimer = null;
+    const reloadTree = () => {
+      loadTree()
+        .then(data => setTreeData(data))
+        .catch(error => console.error("Error fetching tree data:", error));
+    };
+    const scheduleGraphRefresh = () => {
+      clearTimeout(graphTimer);
+      graphTimer = setTimeout(() => setGraphVersion(version => version + 1), 500);
+    };
+    
+    const unsubscribe = subscribeChanges(
+      event => {
+        setTreeData(current => applyChangeEvent(current, event) || current);
+        scheduleGraphRefresh();
+      },
+      () => {
+        reloadTree();
+        scheduleGraphRefresh();
+      },
+      {
+        onOpen: () => { liveUpdates.current = true; },
+        onClose: () => { liveUpdates.current = false; }
+      }
+    );
+    
+    return () => {
+      clearTimeout(graphTimer);
+      liveUpdates.current = false;
+      unsubscribe();
+    };
+  }, []);
+  
   // Загрузка данных графа при изменении активной папки
   useEffect(() => {
     if (loading) return;
@@ -107,7 +163,7 @@ function App() {
           showNotification("Ошибка загрузки графа");
         }
       });
-  }, [activeFolder, loading, inTelegram]);
+  }, [activeFolder, loading, inTelegram, graphVersion]);
   
   // Создаем тему на основе параметров Telegram или используем стандартную
   const theme = React.useMemo(() => {
@@ -147,6 +203,18 @@ function App() {
     setActiveTab('editor');
   };
   
+  // Содержимое папки загружается при первом раскрытии
+  const handleExpandFolder = (folderId) => {
+    if (loadedLevels.current.has(folderId)) return;
+    loadedLevels.current.add(folderId);
+    fetchTreeLevelAll(folderId)
+      .then(level => setTreeData(current => mergeTreeLevel(current, folderId, level)))
+      .catch(error => {
+        loadedLevels.current.delete(folderId);
+        console.error("Error fetching folder contents:", error);
+      });
+  };
+  
   // Обработчик выбора папки
   const handleFolderSelect = (folderId) => {
     setActiveFolder(folderId);
@@ -258,15 +326,9 @@ function App() {
   // Обработчик перемещения заметки в другую папку
   const handleMoveNote = async (noteId, targetFolderId) => {
     try {
-      // Сначала получаем текущие данные заметки
-      const noteData = await fetchNote(noteId);
-      
-      // Обновляем folder_id
+      // Меняем только folder_id, содержимое заметки не передаем
       // targetFolderId может быть null для корневого каталога
-      noteData.folder_id = targetFolderId;
-      
-      // Отправляем обновленные данные на сервер
-      await updateNote(noteId, noteData);
+      await patchNote(noteId, { folder_id: targetFolderId });
       
       // Обновляем UI
       handleUpdateData();
@@ -306,8 +368,11 @@ function App() {
 
   // Обработчик обновления дерева и графа
   const handleUpdateData = () => {
+    // Изменение придет событием из потока, перезапрашивать дерево и граф не нужно
+    if (liveUpdates.current) return;
+    
     // Загружаем обновленные данные
-    fetchTreeData()
+    loadTree()
       .then(data => setTreeData(data))
       .catch(error => console.error("Error fetching tree data:", error));
       
@@ -347,6 +412,7 @@ function App() {
               activeNote={activeNote}
               onSelectNote={handleNoteSelect}
               onSelectFolder={handleFolderSelect}
+              onExpandFolder={handleExpandFolder}
               onCreateNote={handleCreateNote}
               onCreateFolder={handleCreateFolder}
               showFolderDialog={showFolderDialog}
@@ -2,6 +2,7 @@ import { useState, useEffect } from 'react';
 import { marked } from 'marked';
 import { Box } from '@mui/material';
 import katex from 'katex';
+import { fetchNoteHtml } from '../services/api';
 import 'katex/dist/katex.min.css';
 
 // Configure marked
@@ -49,7 +50,11 @@ renderer.code = (code, language) => {
   return `<pre><code class="language-${language}">${code}</code></pre>`;
 };
 
-function MarkdownPreview({ content }) {
+// Длинные сохраненные заметки без формул рендерим на сервере (там HTML кэшируется)
+const SERVER_RENDER_MIN_LENGTH = 20000;
+const hasLatex = (text) => /\$\$|\\\(/.test(text);
+
+function MarkdownPreview({ content, noteId }) {
   const [html, setHtml] = useState('');
   
   // Process content to handle LaTeX inline formulas
@@ -93,19 +98,40 @@ function MarkdownPreview({ content }) {
   };
   
   useEffect(() => {
-    try {
-      // Pre-process content for LaTeX
-      const processedContent = processContent(content || '');
-      
-      // Parse markdown with our custom renderer
-      const parsedHtml = marked(processedContent, { renderer });
-      
-      setHtml(parsedHtml);
-    } catch (error) {
-      console.error('Error rendering markdown:', error);
-      setHtml(`<p>Error rendering content: ${error.message}</p>`);
+    const renderLocally = () => {
+      try {
+        // Pre-process content for LaTeX
+        const processedContent = processContent(content || '');
+        
+        // Parse markdown with our custom renderer
+        const parsedHtml = marked(processedContent, { renderer });
+        
+        setHtml(parsedHtml);
+      } catch (error) {
+        console.error('Error rendering markdown:', error);
+        setHtml(`<p>Error rendering content: ${error.message}</p>`);
+      }
+    };
+    
+    const text = content || '';
+    if (!noteId || text.length < SERVER_RENDER_MIN_LENGTH || hasLatex(text)) {
+      renderLocally();
+      return undefined;
     }
-  }, [content]);
+    
+    let cancelled = false;
+    fetchNoteHtml(noteId)
+      .then(serverHtml => {
+        if (!cancelled) setHtml(serverHtml);
+      })
+      .catch(() => {
+        // Сервер не умеет рендерить или недоступен - рендерим на клиенте
+        if (!cancelled) renderLocally();
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [content, noteId]);
   
   return (
     <Box
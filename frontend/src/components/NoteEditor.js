@@ -325,7 +325,10 @@ function NoteEditor({ noteId, folderId, onSave, onDelete, treeData, inTelegram,
       
       <Box sx={{ flex: 1, overflow: 'hidden' }}>
         {isPreviewMode ? (
-          <MarkdownPreview content={note.content} />
+          <MarkdownPreview
+            content={note.content}
+            noteId={isModified ? null : note.id}
+          />
         ) : (
           <Editor
             height="100%"
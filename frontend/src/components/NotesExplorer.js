@@ -28,6 +28,7 @@ function NotesExplorer({
   activeNote, 
   onSelectNote, 
   onSelectFolder, 
+  onExpandFolder,
   onCreateNote, 
   onCreateFolder,
   showFolderDialog = false,
@@ -67,6 +68,9 @@ function NotesExplorer({
   const [selectedTargetFolder, setSelectedTargetFolder] = useState(null);
 
   const toggleExpand = (folderId) => {
+    if (!expanded[folderId] && onExpandFolder) {
+      onExpandFolder(folderId);
+    }
     setExpanded(prev => ({
       ...prev,
       [folderId]: !prev[folderId]
@@ -529,7 +533,7 @@ function NotesExplorer({
   const renderFolderTree = (folders, parentId = null, level = 0) => {
     const folderNodes = folders
       .filter(folder => folder.parent_id === parentId)
-      .sort((a, b) => a.position - b.position)
+      .sort((a, b) => ((a.order_key || '') < (b.order_key || '') ? -1 : (a.order_key || '') > (b.order_key || '') ? 1 : 0))
       .map(folder => {
         const folderId = folder.id;
         const isExpanded = expanded[folderId];
@@ -552,7 +556,7 @@ function NotesExplorer({
                   )}
                 </ListItemIcon>
                 <ListItemText primary={folder.name} />
-                {(hasSubfolders || folderFiles.length > 0) && (
+                {(hasSubfolders || folderFiles.length > 0 || folder.note_count > 0) && (
                   isExpanded ? <ExpandLessIcon /> : <ExpandMoreIcon />
                 )}
               </ListItemButton>
@@ -1,5 +1,6 @@
 import axios from 'axios';
 import { getInitData } from './telegramService';
+import { openEventStream } from './eventStream';
 
 // Создаем экземпляр axios с базовым URL
 const api = axios.create({
@@ -62,6 +63,26 @@ export const fetchNote = async (noteId) => {
   }
 };
 
+// HTML, отрендеренный на сервере (503, если рендеринг на сервере недоступен)
+export const fetchNoteHtml = async (noteId) => {
+  const response = await api.get(`/notes/${noteId}/html`, { responseType: 'text' });
+  return response.data;
+};
+
+// Сырое содержимое заметки; headBytes - только начало файла для быстрой первой отрисовки
+export const fetchNoteRaw = async (noteId, headBytes = null) => {
+  const response = await api.get(`/notes/${noteId}/raw`, {
+    params: headBytes ? { head: headBytes } : {},
+    responseType: 'text'
+  });
+  const contentRange = response.headers['content-range'];
+  return {
+    content: response.data,
+    partial: response.status === 206,
+    totalSize: contentRange ? Number(contentRange.split('/')[1]) : response.data.length
+  };
+};
+
 export const createNote = async (note) => {
   try {
     const response = await api.post('/notes', note);
@@ -80,6 +101,123 @@ export const updateNote = async (noteId, note) => {
   }
 };
 
+// Частичное обновление заметки: только переданные поля, content или delta
+export const patchNote = async (noteId, changes) => {
+  try {
+    const response = await api.patch(`/notes/${noteId}`, changes);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchNoteChildren = async (noteId) => {
+  try {
+    const response = await api.get(`/notes/${noteId}/children`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchNoteDescendants = async (noteId, depth) => {
+  try {
+    const response = await api.get(`/notes/${noteId}/descendants`, {
+      params: depth ? { depth } : {}
+    });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchNoteAncestors = async (noteId) => {
+  try {
+    const response = await api.get(`/notes/${noteId}/ancestors`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchAttachments = async (noteId) => {
+  try {
+    const response = await api.get(`/notes/${noteId}/attachments`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const uploadAttachment = async (noteId, file, onProgress) => {
+  try {
+    const formData = new FormData();
+    formData.append('file', file, file.name);
+    const response = await api.post(`/notes/${noteId}/attachments`, formData, {
+      onUploadProgress: onProgress
+    });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchAttachmentBlob = async (noteId, attachmentId, thumbnail = false) => {
+  const suffix = thumbnail ? '/thumbnail' : '';
+  const response = await api.get(`/notes/${noteId}/attachments/${attachmentId}${suffix}`, {
+    responseType: 'blob'
+  });
+  return response.data;
+};
+
+export const deleteAttachment = async (noteId, attachmentId) => {
+  try {
+    const response = await api.delete(`/notes/${noteId}/attachments/${attachmentId}`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const duplicateNote = async (noteId, options = {}) => {
+  try {
+    const response = await api.post(`/notes/${noteId}/duplicate`, options);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+// История версий заметки: страница от новых к старым, next_before - продолжение
+export const fetchNoteRevisions = async (noteId, before = null, limit = 50) => {
+  try {
+    const params = { limit };
+    if (before) params.before = before;
+    const response = await api.get(`/notes/${noteId}/revisions`, { params });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const fetchNoteRevision = async (noteId, rev) => {
+  try {
+    const response = await api.get(`/notes/${noteId}/revisions/${rev}`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+export const restoreNoteRevision = async (noteId, rev) => {
+  try {
+    const response = await api.post(`/notes/${noteId}/revisions/${rev}/restore`);
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
 export const deleteNote = async (noteId) => {
   try {
     const response = await api.delete(`/notes/${noteId}`);
@@ -117,6 +255,16 @@ export const searchNotes = async (query) => {
   }
 };
 
+// Пакетное применение операций над заметками (create/update/move/tag/untag/delete)
+export const applyBatch = async (operations) => {
+  try {
+    const response = await api.post('/batch', { operations });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
 // Folders API
 export const fetchFolders = async () => {
   try {
@@ -171,22 +319,60 @@ export const deleteFolder = async (folderId) => {
 // Перемещение папки
 export const moveFolder = async (folderId, targetFolderId) => {
   try {
-    // Сначала получим данные папки
-    const response = await api.get(`/folders/${folderId}`);
-    const folderData = response.data;
-    
-    // Обновляем parent_id 
     // Важно: targetFolderId может быть null (корневой каталог)
-    folderData.parent_id = targetFolderId;
-    
-    // Отправляем обновленные данные на сервер
-    const updateResponse = await api.put(`/folders/${folderId}`, folderData);
-    return updateResponse.data;
+    const response = await api.post(`/folders/${folderId}/move`, { parent_id: targetFolderId });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+// Изменение порядка папки среди соседей: встать после afterId и/или перед beforeId
+export const reorderFolder = async (folderId, { afterId = null, beforeId = null } = {}) => {
+  try {
+    const response = await api.post(`/folders/${folderId}/move`, {
+      after_id: afterId,
+      before_id: beforeId
+    });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+// Folder messages API
+export const fetchFolderMessages = async (folderId, cursor = null, limit = 50) => {
+  try {
+    const params = { limit };
+    if (cursor) params.cursor = cursor;
+    const response = await api.get(`/folders/${folderId}/messages`, { params });
+    return response.data;
   } catch (error) {
     return handleError(error);
   }
 };
 
+export const postFolderMessage = async (folderId, content, author = null) => {
+  try {
+    const response = await api.post(`/folders/${folderId}/messages`, { content, author });
+    return response.data;
+  } catch (error) {
+    return handleError(error);
+  }
+};
+
+// Новые сообщения папки в реальном времени; after - id последнего полученного
+// события потока, чтобы сервер дослал пропущенное. Возвращает функцию отписки.
+export const subscribeFolderMessages = (folderId, onMessage, after = null) => {
+  return openEventStream(
+    `/folders/${folderId}/messages/stream`,
+    (type, message) => {
+      if (type === 'message') onMessage(message);
+    },
+    { lastEventId: after }
+  );
+};
+
 // Graph API
 export const fetchGraphData = async (folderId = null, tag = null) => {
   try {
@@ -209,11 +395,31 @@ export const fetchGraphData = async (folderId = null, tag = null) => {
 };
 
 // Tree API
-export const fetchTreeData = async () => {
+// Один уровень дерева с постраничной загрузкой (parentId = null - корень)
+export const fetchTreeLevel = async (parentId = null, cursor = null, limit = 200) => {
   try {
-    const response = await api.get('/tree');
+    const params = { parent_id: parentId || '', limit };
+    if (cursor) {
+      params.cursor = cursor;
+    }
+    const response = await api.get('/tree', { params });
     return response.data;
   } catch (error) {
     return handleError(error);
   }
-};
\ No newline at end of file
+};
+
+// Весь уровень: страницы запрашиваются, пока сервер возвращает next_cursor
+export const fetchTreeLevelAll = async (parentId = null) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const page = await fetchTreeLevel(parentId, cursor);
+    items.push(...page.items);
+    cursor = page.next_cursor;
+  } while (cursor);
+  return {
+    folders: items.filter(item => item.type === 'folder'),
+    files: items.filter(item => item.type === 'note')
+  };
+};
@@ -0,0 +1,69 @@
+import { openEventStream } from './eventStream';
+
+// Заменяет или добавляет элементы по id, сохраняя порядок существующих
+const upsertById = (items, changed) => {
+  const byId = new Map(changed.map(item => [item.id, item]));
+  const result = items.map(item => {
+    if (!byId.has(item.id)) return item;
+    const updated = { ...item, ...byId.get(item.id) };
+    byId.delete(item.id);
+    return updated;
+  });
+  return result.concat(Array.from(byId.values()));
+};
+
+/**
+ * Подставляет загруженный уровень дерева (fetchTreeLevelAll) в данные { folders, files }:
+ * заметки папки parentId заменяются целиком, папки обновляются по id.
+ */
+export const mergeTreeLevel = (treeData, parentId, level) => ({
+  folders: upsertById(treeData.folders, level.folders),
+  files: treeData.files
+    .filter(file => (file.folder_id || null) !== parentId)
+    .concat(level.files)
+});
+
+/**
+ * Применяет событие изменения к данным дерева { folders, files }.
+ * Возвращает новые данные или null, если дерево нужно перечитать целиком.
+ */
+export const applyChangeEvent = (treeData, event) => {
+  switch (event.type) {
+    case 'note.changed':
+      return { ...treeData, files: upsertById(treeData.files, event.notes) };
+    case 'note.deleted': {
+      const removed = new Set(event.ids);
+      return { ...treeData, files: treeData.files.filter(file => !removed.has(file.id)) };
+    }
+    case 'folder.changed':
+      return { ...treeData, folders: upsertById(treeData.folders, event.folders) };
+    case 'folder.deleted':
+      // Сервер переносит подпапки и заметки удаленной папки к ее родителю
+      return {
+        folders: treeData.folders
+          .filter(folder => folder.id !== event.id)
+          .map(folder => (folder.parent_id === event.id ? { ...folder, parent_id: event.parent_id } : folder)),
+        files: treeData.files.map(file => (
+          file.folder_id === event.id ? { ...file, folder_id: event.parent_id } : file
+        ))
+      };
+    default:
+      return null;
+  }
+};
+
+/**
+ * Подписка на изменения заметок и папок пользователя (/api/events).
+ * onEvent получает событие, onResync вызывается, когда пропущенные события
+ * не восстановить и данные нужно перечитать (например, после перезапуска
+ * сервера). onOpen и onClose сообщают о подключении и обрыве потока.
+ * Возвращает функцию отписки.
+ */
+export const subscribeChanges = (onEvent, onResync, { onOpen = null, onClose = null } = {}) => openEventStream(
+  '/events',
+  (type, event) => {
+    if (type === 'resync') onResync();
+    else onEvent(event);
+  },
+  { onOpen, onClose }
+);
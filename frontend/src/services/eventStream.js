@@ -0,0 +1,95 @@
+import { getInitData } from './telegramService';
+
+// Задержка переподключения по умолчанию (сервер может прислать свою в поле retry)
+const DEFAULT_RETRY_MS = 1000;
+const MAX_RETRY_MS = 30000;
+
+// Разбирает один блок SSE (строки до пустой строки)
+const parseBlock = (block) => {
+  const event = { id: null, type: 'message', data: [], retry: null };
+  for (const line of block.split('\n')) {
+    if (!line || line.startsWith(':')) continue;
+    const colon = line.indexOf(':');
+    const field = colon === -1 ? line : line.slice(0, colon);
+    let value = colon === -1 ? '' : line.slice(colon + 1);
+    if (value.startsWith(' ')) value = value.slice(1);
+    if (field === 'id') event.id = value;
+    else if (field === 'event') event.type = value;
+    else if (field === 'data') event.data.push(value);
+    else if (field === 'retry' && /^\d+$/.test(value)) event.retry = Number(value);
+  }
+  return event;
+};
+
+/**
+ * Подписка на поток Server-Sent Events через fetch.
+ *
+ * EventSource не умеет передавать заголовок Authorization, поэтому поток
+ * читается из fetch по кускам. При обрыве соединения подписка сама
+ * переподключается, передавая Last-Event-ID, чтобы сервер дослал пропущенное.
+ * onOpen и onClose вызываются при каждом подключении и обрыве.
+ * Возвращает функцию отписки.
+ */
+export const openEventStream = (path, onEvent, { lastEventId = null, onOpen = null, onClose = null } = {}) => {
+  const controller = new AbortController();
+  let lastId = lastEventId;
+  let retryMs = DEFAULT_RETRY_MS;
+  let failures = 0;
+  let closed = false;
+
+  const connect = async () => {
+    while (!closed) {
+      try {
+        const headers = { Accept: 'text/event-stream' };
+        const initData = getInitData();
+        if (initData) headers['Authorization'] = `Bearer ${initData}`;
+        if (lastId) headers['Last-Event-ID'] = lastId;
+
+        const response = await fetch(`/api${path}`, { headers, signal: controller.signal });
+        if (!response.ok || !response.body) {
+          throw new Error(`Event stream failed with status ${response.status}`);
+        }
+        failures = 0;
+        if (onOpen) onOpen();
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        for (;;) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true }).replace(/\r\n?/g, '\n');
+          let boundary;
+          while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const event = parseBlock(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+            if (event.retry !== null) retryMs = event.retry;
+            if (event.id !== null) lastId = event.id;
+            if (event.data.length) {
+              try {
+                onEvent(event.type, JSON.parse(event.data.join('\n')));
+              } catch (error) {
+                console.error('Failed to handle stream event:', error);
+              }
+            }
+          }
+        }
+      } catch (error) {
+        if (closed) return;
+        failures += 1;
+        console.warn('Event stream disconnected:', error);
+      }
+      if (closed) return;
+      if (onClose) onClose();
+      // Экспоненциальная пауза при повторных ошибках
+      const delay = Math.min(retryMs * 2 ** Math.max(failures - 1, 0), MAX_RETRY_MS);
+      await new Promise(resolve => setTimeout(resolve, delay));
+    }
+  };
+
+  connect();
+  return () => {
+    closed = true;
+    controller.abort();
+  };
+};
@@ -1,16 +1,26 @@
 import os
 import logging
-import asyncio
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse
 
 # Импортируем наши модули
-from bot import run_bot
+from bot import (
+    run_bot, stop_bot, start_webhook, stop_webhook, register_webhook, webhook_router, BOT_UPDATE_MODE
+)
 from backend.database import init_db
-from backend.routers import notes, folders, graph, tree
+from backend.write_buffer import write_buffer, recover as recover_write_buffer
+from backend.maintenance import maintenance_job
+from backend.thumbnails import shutdown_thumbnail_pool
+from backend.events import event_hub, attach_relay, detach_relay
+from backend.relay import EventRelay
+from backend.notifications import outbox, close_bot
+from backend.inbox import inbox_writer
+from backend.cluster import WEB_CONCURRENCY, BOT_MODE, EVENT_RELAY, MULTI_PROCESS, LeaderRole
+from backend.fastjson import FastJSONResponse
+from backend.compression import CompressionMiddleware, PrecompressedStaticFiles
+from backend.routers import notes, folders, graph, tree, batch, attachments, messages, events
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,11 +32,13 @@ logger = logging.getLogger(__name__)
 # Задаем режим разработки через переменную окружения
 DEV_MODE = os.environ.get("DEV_MODE", "False").lower() == "true"
 
-# Инициализируем базу данных
-init_db()
+# Временные файлы моложе этого возраста (секунды) при старте не удаляются:
+# при нескольких процессах их может прямо сейчас писать другой процесс
+STALE_TEMP_AGE = 300
 
 # Создаем экземпляр FastAPI
-app = FastAPI(title="Notes Manager API")
+# Ответы сериализуются через orjson (см. backend/fastjson.py)
+app = FastAPI(title="Notes Manager API", default_response_class=FastJSONResponse)
 
 # Настройка CORS
 app.add_middleware(
@@ -37,14 +49,112 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Сжатие ответов API (gzip/brotli, см. backend/compression.py)
+app.add_middleware(CompressionMiddleware)
+
 # Подключаем роутеры API
 app.include_router(notes.router)
 app.include_router(folders.router)
 app.include_router(graph.router)
 app.include_router(tree.router)
+app.include_router(batch.router)
+app.include_router(attachments.router)
+app.include_router(messages.router)
+app.include_router(events.router)
+app.include_router(webhook_router)
+
+async def _start_maintenance():
+    maintenance_job.start()
+
+async def _stop_maintenance():
+    maintenance_job.stop()
+
+bot_application = None
+
+async def _start_bot():
+    global bot_application
+    if BOT_UPDATE_MODE == "webhook":
+        # Обновления принимают все процессы (start_bot_webhook), адрес регистрирует один
+        await register_webhook()
+        return
+    bot_application = await run_bot()
+    if bot_application:
+        logger.info("Telegram bot started successfully")
+    else:
+        logger.warning("Telegram bot initialization failed")
+
+async def _stop_bot():
+    global bot_application
+    if bot_application:
+        await stop_bot(bot_application)
+        bot_application = None
+
+# Службы, которые должны работать только в одном процессе (см. backend/cluster.py)
+maintenance_role = LeaderRole("maintenance", _start_maintenance, _stop_maintenance)
+bot_role = LeaderRole("bot", _start_bot, _stop_bot)
+
+@app.on_event("startup")
+async def init_database():
+    """Инициализируем базу данных (при старте, а не при импорте: модуль заново
+    импортируют процессы пула миниатюр, см. backend/thumbnails.py)"""
+    init_db()
+
+@app.on_event("startup")
+async def start_event_relay():
+    """При нескольких процессах события передаются через общую БД (backend/relay.py)"""
+    if EVENT_RELAY:
+        attach_relay(EventRelay())
+
+@app.on_event("startup")
+async def start_write_buffer():
+    """Дописывает версии, оставшиеся в журнале после прошлого запуска, и запускает фоновый сброс"""
+    recover_write_buffer(temp_min_age=STALE_TEMP_AGE if MULTI_PROCESS else 0)
+    write_buffer.start()
+
+@app.on_event("startup")
+async def start_leader_roles():
+    """Фоновая проверка (если задан MAINTENANCE_INTERVAL) и бот - только в одном процессе"""
+    maintenance_role.start()
+    if BOT_MODE == "leader":
+        bot_role.start()
+
+@app.on_event("startup")
+async def start_bot_webhook():
+    """В режиме вебхука обновления бота обрабатывает каждый процесс API"""
+    if BOT_MODE == "leader" and BOT_UPDATE_MODE == "webhook":
+        await start_webhook()
+
+@app.on_event("shutdown")
+async def stop_leader_roles():
+    # Сначала дописываем "Входящие" и досылаем уведомления: очередь и бот используют общий клиент
+    await inbox_writer.stop()
+    await outbox.stop()
+    await stop_webhook()
+    await bot_role.stop()
+    await maintenance_role.stop()
+    await close_bot()
+
+@app.on_event("shutdown")
+async def stop_write_buffer():
+    """Записывает в файлы все, что осталось в буфере отложенной записи"""
+    write_buffer.stop()
+
+@app.on_event("shutdown")
+async def stop_thumbnails():
+    shutdown_thumbnail_pool()
+
+@app.on_event("shutdown")
+async def stop_event_streams():
+    """Закрывает открытые SSE-потоки, чтобы остановка не ждала их"""
+    event_hub.close_all()
+
+@app.on_event("shutdown")
+async def stop_event_relay():
+    detach_relay()
 
 # Подключаем статические файлы React-приложения
-app.mount("/static", StaticFiles(directory="frontend/build/static"), name="static")
+# (с .br/.gz версиями из сборки и долгим кэшированием файлов с хешем в имени)
+app.mount("/static", PrecompressedStaticFiles(directory="frontend/build/static"), name="static")
 
 # Перенаправление корневого URL на React-приложение
 @app.get("/")
@@ -52,7 +162,7 @@ async def redirect_to_app():
     return RedirectResponse(url="/app/")
 
 # Подключаем статические файлы React-приложения
-app.mount("/app", StaticFiles(directory="frontend/build", html=True), name="app")
+app.mount("/app", PrecompressedStaticFiles(directory="frontend/build", html=True), name="app")
 
 # Проверка состояния API
 @app.get("/health")
@@ -64,49 +174,22 @@ async def health_check():
         "version": "1.0.0"
     }
 
-async def start_bot():
-    """Запускает Telegram бота в отдельной задаче."""
-    try:
-        # Запускаем бота в отдельном потоке
-        bot_updater = await run_bot()
-        if bot_updater:
-            logger.info("Telegram bot started successfully")
-        else:
-            logger.warning("Telegram bot initialization failed")
-    except Exception as e:
-        logger.error(f"Failed to start Telegram bot: {e}")
-
-async def start_server():
-    """Запускает веб-сервер в основном потоке."""
-    config = uvicorn.Config(
-        app=app, 
-        host="0.0.0.0", 
-        port=int(os.environ.get("PORT", 8000)),
-        log_level="info"
-    )
-    server = uvicorn.Server(config)
-    await server.serve()
-
-async def main():
-    """Основная функция для запуска всех компонентов."""
-    try:
-        # Выводим информацию о режиме работы
-        if DEV_MODE:
-            logger.info("Starting in DEVELOPMENT mode (single user mode)")
-        else:
-            logger.info("Starting in PRODUCTION mode (multi-user mode)")
-        
-        # Запускаем бота как отдельную задачу
-        bot_task = asyncio.create_task(start_bot())
-        
-        # Запускаем сервер в основном потоке
-        await start_server()
-        
-        # Ждем завершения задачи бота
-        await bot_task
-    except Exception as e:
-        logger.error(f"Error in main function: {str(e)}")
+def main():
+    """Запускает веб-сервер; при WEB_CONCURRENCY > 1 - в нескольких процессах."""
+    # Выводим информацию о режиме работы
+    if DEV_MODE:
+        logger.info("Starting in DEVELOPMENT mode (single user mode)")
+    else:
+        logger.info("Starting in PRODUCTION mode (multi-user mode)")
+
+    port = int(os.environ.get("PORT", 8000))
+    if WEB_CONCURRENCY > 1:
+        # Каждый процесс импортирует приложение заново, поэтому передаем его строкой
+        logger.info(f"Starting {WEB_CONCURRENCY} worker processes, bot mode: {BOT_MODE}")
+        uvicorn.run("server:app", host="0.0.0.0", port=port, workers=WEB_CONCURRENCY, log_level="info")
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
 
 if __name__ == "__main__":
     # Запускаем всю систему
-    asyncio.run(main())
\ No newline at end of file
+    main()